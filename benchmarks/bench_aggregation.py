@@ -0,0 +1,108 @@
+"""Benchmark of the aggregation of the regions by country.
+
+Compares the original region-by-region loop of AlertService.run with the
+CountryAggregator engine (NumPy and pure-Python backends), on synthetic data:
+
+    python -m benchmarks.bench_aggregation --regions 1000000 --countries 10000
+"""
+import argparse
+import json
+import random
+import time
+
+from wfp_food_security_alerts import aggregation
+from wfp_food_security_alerts.aggregation import CountryAggregator
+from wfp_food_security_alerts.regions import RegionArray
+
+
+def generate(countries: int, regions: int, seed: int = 0):
+    rnd = random.Random(seed)
+    region_ids = list(range(regions))
+    rnd.shuffle(region_ids)
+    # split the regions in countries of random size
+    cuts = sorted(rnd.sample(range(1, regions), countries - 1))
+    bounds = [0] + cuts + [regions]
+    regions_by_country = [
+        tuple(region_ids[bounds[n] : bounds[n + 1]]) for n in range(countries)
+    ]
+    population = dict((x, rnd.randint(1000, 100000)) for x in range(regions))
+    food_security = RegionArray((x, rnd.randint(0, 1000)) for x in range(regions))
+    food_security_days_ago = RegionArray(
+        (x, rnd.randint(0, 1000)) for x in range(regions)
+    )
+    return regions_by_country, [food_security, food_security_days_ago, population]
+
+
+def legacy(regions_by_country, datasets):
+    # the loop of AlertService.run before the aggregation engine
+    food_security, food_security_days_ago, population = datasets
+    results = []
+    for regions in regions_by_country:
+        data_not_found = False
+        totals = [0, 0, 0]
+        for region_id in regions:
+            food_security_region = food_security.get(region_id)
+            if food_security_region is None:
+                data_not_found = True
+                break
+            food_security_days_ago_region = food_security_days_ago.get(region_id)
+            if food_security_days_ago_region is None:
+                data_not_found = True
+                break
+            population_region = population.get(region_id)
+            if population_region is None:
+                data_not_found = True
+                break
+            totals[0] += food_security_region
+            totals[1] += food_security_days_ago_region
+            totals[2] += population_region
+        results.append(None if data_not_found else tuple(totals))
+    return results
+
+
+def measure(fn, repeat: int):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run(countries: int, regions: int, repeat: int) -> dict:
+    regions_by_country, datasets = generate(countries, regions)
+    results = {"countries": countries, "regions": regions, "timings": {}}
+    legacy_time, expected = measure(
+        lambda: legacy(regions_by_country, datasets), repeat
+    )
+    results["timings"]["legacy"] = legacy_time
+    backends = [("python", False)]
+    if aggregation.numpy is not None:
+        backends.append(("numpy", True))
+    for name, use_numpy in backends:
+        # the index is built once per run, and included in the timing
+        elapsed, totals = measure(
+            lambda: CountryAggregator(regions_by_country, use_numpy).aggregate(
+                datasets
+            ),
+            repeat,
+        )
+        assert totals == expected, "%s backend returned different totals" % name
+        results["timings"][name] = elapsed
+        results["speedup_%s" % name] = legacy_time / elapsed
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--countries", type=int, default=10000)
+    parser.add_argument("--regions", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(json.dumps(run(args.countries, args.regions, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
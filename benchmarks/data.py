@@ -0,0 +1,55 @@
+"""Synthetic countries, regions, population and food security data."""
+import random
+
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class Dataset(NamedTuple):
+    # regions of each country, by country id (1..countries)
+    regions_by_country: Dict[int, Tuple[int, ...]]
+    # population, food insecure people today and days_ago days ago, by region id
+    population: Dict[int, int]
+    food_security: Dict[int, int]
+    food_security_days_ago: Dict[int, int]
+
+    def country_by_region(self) -> Dict[int, int]:
+        return dict(
+            (region_id, country_id)
+            for country_id, regions in self.regions_by_country.items()
+            for region_id in regions
+        )
+
+
+def generate(countries: int, regions: int, seed: int = 0) -> Dataset:
+    # regions (0..regions - 1) are shuffled and split in countries of random
+    # size, each with at least one region; about 5% of the regions get an
+    # increase of food insecure people large enough to trigger an alert
+    if regions < countries:
+        raise ValueError('at least one region per country is needed')
+    rnd = random.Random(seed)
+    region_ids = list(range(regions))
+    rnd.shuffle(region_ids)
+    cuts = sorted(rnd.sample(range(1, regions), countries - 1))
+    bounds = [0] + cuts + [regions]
+    regions_by_country = dict(
+        (n + 1, tuple(region_ids[bounds[n] : bounds[n + 1]])) for n in range(countries)
+    )
+    population: Dict[int, int] = {}
+    food_security: Dict[int, int] = {}
+    food_security_days_ago: Dict[int, int] = {}
+    for region_id in range(regions):
+        people = rnd.randint(1000, 1000000)
+        before = rnd.randint(0, people // 4)
+        increase = people // 5 if rnd.random() < 0.05 else rnd.randint(0, people // 100)
+        population[region_id] = people
+        food_security_days_ago[region_id] = before
+        food_security[region_id] = min(before + increase, people)
+    return Dataset(
+        regions_by_country, population, food_security, food_security_days_ago
+    )
+
+
+def population_csv(dataset: Dataset) -> bytes:
+    lines: List[str] = ['region_id,population']
+    lines.extend('%d,%d' % item for item in dataset.population.items())
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
@@ -0,0 +1,210 @@
+"""Benchmarks of the alerting pipeline against local API and SMTP stand-ins.
+
+Runs AlertService.run, PopulationService.download and send_notifications on
+synthetic data, and prints (or writes) the results as JSON, so that they can be
+compared across commits:
+
+    python -m benchmarks.run --countries 100 --regions 10000 --output results.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from itertools import count
+from typing import Callable, Dict, List
+
+from wfp_food_security_alerts.alerts import AlertService
+from wfp_food_security_alerts.api import APIService
+from wfp_food_security_alerts.population import PopulationService
+from wfp_food_security_alerts.tests.smtpserver import SMTPServer
+
+from .data import Dataset, generate
+from .server import APIServer
+
+
+def measure(fn: Callable[[], int], repeat: int, memory: bool) -> dict:
+    # fn returns the number of items processed; the peak memory is measured in
+    # a separate run, as tracing allocations slows everything down
+    latencies: List[float] = []
+    items = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        items = fn()
+        latencies.append(time.perf_counter() - started)
+    result = {
+        "items": items,
+        "latency_min": min(latencies),
+        "latency_median": statistics.median(latencies),
+        "latency_max": max(latencies),
+        "throughput": items / statistics.median(latencies),
+    }
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def config(dataset: Dataset, api: APIServer, smtp: SMTPServer) -> dict:
+    return {
+        "countries": [
+            {"id": country_id, "emails": ["country%d@example.org" % country_id]}
+            for country_id in dataset.regions_by_country
+        ],
+        "global": {
+            "threshold": 5.0,
+            "days_ago": 30,
+            "emails": ["admin@example.org"],
+            "smtp": {
+                "sender": "alerts@example.org",
+                "host": "127.0.0.1",
+                "port": smtp.server_address[1],
+                "backoff": 0,
+            },
+            "api": dict(api.config(), retries=0),
+        },
+    }
+
+
+def bench_population_download(dataset, api, smtp, workdir, repeat, memory):
+    databases = count()
+
+    def download() -> int:
+        # a new database each time: a full download, not an incremental one
+        db = PopulationService()
+        db.connect(os.path.join(workdir, 'download-%d.sqlite3' % next(databases)))
+        try:
+            db.download(api.base_url + '/population.csv')
+            return len(dataset.population)
+        finally:
+            db.close()
+
+    return measure(download, repeat, memory)
+
+
+def bench_alerts_run(dataset, api, smtp, workdir, repeat, memory):
+    database = os.path.join(workdir, 'population.sqlite3')
+    db = PopulationService()
+    db.connect(database)
+    db.write_rows_to_sqlite(
+        {"region_id": k, "population": v} for k, v in dataset.population.items()
+    )
+    db.close()
+    c = config(dataset, api, smtp)
+    population = PopulationService()
+    population.connect(database, read_only=True)
+
+    def run() -> int:
+        svc = AlertService(c, APIService(c), population)
+        svc.run(dry_run=True)
+        return len(dataset.population)
+
+    try:
+        return measure(run, repeat, memory)
+    finally:
+        population.close()
+
+
+def bench_send_notifications(dataset, api, smtp, workdir, repeat, memory):
+    c = config(dataset, api, smtp)
+    notifications = [
+        {
+            "country_id": country_id,
+            "days_ago": 30,
+            "threshold": 5.0,
+            "recipients": "country%d@example.org" % country_id,
+            "population_country": 1000,
+            "food_security": 200,
+            "food_security_days_ago": 100,
+            "food_security_variation": 100,
+            "p_food_security": 20.0,
+            "p_food_security_days_ago": 10.0,
+            "p_food_security_variation": 10.0,
+        }
+        for country_id in dataset.regions_by_country
+    ]
+
+    def send() -> int:
+        svc = AlertService(c, APIService(c), PopulationService())
+        results = svc.send_notifications(notifications)
+        assert all(result.sent for result in results)
+        return len(results)
+
+    return measure(send, repeat, memory)
+
+
+BENCHMARKS = {
+    "population_download": bench_population_download,
+    "alerts_run": bench_alerts_run,
+    "send_notifications": bench_send_notifications,
+}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(
+    countries: int, regions: int, repeat: int, memory: bool, names: List[str]
+) -> dict:
+    dataset = generate(countries, regions)
+    results: Dict[str, object] = {
+        "revision": git_revision(),
+        "countries": countries,
+        "regions": regions,
+        "benchmarks": {},
+    }
+    api = APIServer(dataset).start()
+    smtp = SMTPServer().start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for name in names:
+                results["benchmarks"][name] = BENCHMARKS[name](  # type: ignore
+                    dataset, api, smtp, workdir, repeat, memory
+                )
+    finally:
+        smtp.stop()
+        api.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--countries", type=int, default=100)
+    parser.add_argument("--regions", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", dest="memory", action="store_false")
+    parser.add_argument(
+        "--benchmark", dest="names", action="append", choices=sorted(BENCHMARKS)
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+    results = run(
+        args.countries,
+        args.regions,
+        args.repeat,
+        args.memory,
+        args.names or list(BENCHMARKS),
+    )
+    data = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Local HTTP server emulating the external APIs, backed by a synthetic dataset."""
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import parse_qs, urlparse
+
+from .data import Dataset, population_csv
+
+
+class APIHandler(BaseHTTPRequestHandler):
+
+    server: 'APIServer'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # noqa: N802
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts == ['foodsecurity']:
+            days_ago = parse_qs(url.query).get('days_ago')
+            self.reply(self.server.foodsecurity(bool(days_ago)), 'application/json')
+        elif len(parts) == 3 and parts[0] == 'country' and parts[2] == 'regions':
+            regions = self.server.dataset.regions_by_country.get(int(parts[1]))
+            if regions is None:
+                self.send_error(404)
+                return
+            data = {"regions": [{"region_id": x} for x in regions]}
+            self.reply(json.dumps(data).encode('utf-8'), 'application/json')
+        elif len(parts) == 3 and parts[0] == 'region' and parts[2] == 'country':
+            country_id = self.server.country_by_region.get(int(parts[1]))
+            if country_id is None:
+                self.send_error(404)
+                return
+            data = {"country_id": country_id}
+            self.reply(json.dumps(data).encode('utf-8'), 'application/json')
+        elif parts == ['population.csv']:
+            self.reply(self.server.population_csv, 'text/csv; charset=utf-8')
+        else:
+            self.send_error(404)
+
+    def reply(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+
+class APIServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, dataset: Dataset, host: str = '127.0.0.1', port: int = 0):
+        super(APIServer, self).__init__((host, port), APIHandler)
+        self.dataset = dataset
+        self.country_by_region = dataset.country_by_region()
+        self.population_csv = population_csv(dataset)
+        self._foodsecurity: Dict[bool, bytes] = {}
+
+    @property
+    def base_url(self) -> str:
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def config(self) -> dict:
+        return {
+            "foodsecurity": self.base_url + '/foodsecurity',
+            "country_regions": self.base_url + '/country/%s/regions',
+            "region_country": self.base_url + '/region/%s/country',
+        }
+
+    def foodsecurity(self, days_ago: bool) -> bytes:
+        # the responses are serialized once, the first time they are requested
+        if days_ago not in self._foodsecurity:
+            data = (
+                self.dataset.food_security_days_ago
+                if days_ago
+                else self.dataset.food_security
+            )
+            self._foodsecurity[days_ago] = json.dumps(
+                [
+                    {"region_id": k, "food_insecure_people": v}
+                    for k, v in data.items()
+                ]
+            ).encode('utf-8')
+        return self._foodsecurity[days_ago]
+
+    def start(self) -> 'APIServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -18,7 +18,13 @@ setuptools.setup(
         'requests>=2.23.0',
         'pyyaml>=5.3.0',
     ],
-    packages=setuptools.find_packages(),
+    extras_require={
+        # vectorized aggregation of the regions by country
+        'numpy': ['numpy>=1.18'],
+        # reports in the Parquet format
+        'parquet': ['pyarrow>=7.0'],
+    },
+    packages=setuptools.find_packages(exclude=['benchmarks']),
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
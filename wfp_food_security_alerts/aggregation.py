@@ -0,0 +1,110 @@
+from array import array
+from typing import List, Mapping, Optional, Sequence, Tuple
+
+from .regions import MISSING, RegionArray
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # type: ignore
+
+
+class CountryAggregator(object):
+
+    # sums values of regions (food security, population, ...) by country: the
+    # region ids of all the countries are flattened once into a single array,
+    # with the offsets of the boundaries between countries; totals are then
+    # computed in a single vectorized pass when NumPy is available, or with a
+    # plain Python loop otherwise
+
+    _region_ids: array
+    _offsets: array
+    _use_numpy: bool
+
+    def __init__(
+        self, regions_by_country: Sequence[Sequence[int]], use_numpy: bool = True
+    ):
+        self._region_ids = array('q')
+        self._offsets = array('q', [0])
+        for regions in regions_by_country:
+            self._region_ids.extend(regions)
+            self._offsets.append(len(self._region_ids))
+        self._use_numpy = use_numpy and numpy is not None
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def aggregate(
+        self, datasets: Sequence[Mapping[int, int]]
+    ) -> List[Optional[Tuple[int, ...]]]:
+        # return, for each country, the totals of each dataset, or None if any
+        # of the regions of the country is missing from any of the datasets
+        columns = self.totals(datasets)
+        if not columns:
+            return [() for _ in range(len(self))]
+        return [None if None in row else row for row in zip(*columns)]
+
+    def totals(
+        self, datasets: Sequence[Mapping[int, int]]
+    ) -> List[List[Optional[int]]]:
+        # return, for each dataset, the totals of each country, or None for the
+        # countries with any of the regions missing from the dataset
+        if self._use_numpy:
+            return [self._totals_numpy(dataset) for dataset in datasets]
+        return [self._totals_python(dataset) for dataset in datasets]
+
+    def _totals_python(self, dataset: Mapping[int, int]) -> List[Optional[int]]:
+        # look up the values of all the regions at once, and then sum them up
+        # for each country, slice by slice
+        column = list(map(dataset.get, self._region_ids))
+        results: List[Optional[int]] = []
+        for n in range(len(self)):
+            segment = column[self._offsets[n] : self._offsets[n + 1]]
+            results.append(None if None in segment else sum(segment))  # type: ignore
+        return results
+
+    def _totals_numpy(self, dataset: Mapping[int, int]) -> List[Optional[int]]:
+        region_ids = numpy.frombuffer(self._region_ids, dtype=numpy.int64)
+        offsets = numpy.frombuffer(self._offsets, dtype=numpy.int64)
+        values = self._gather(dataset, region_ids)
+        missing = values == MISSING
+        values[missing] = 0
+        totals = self._segment_sums(values, offsets).tolist()
+        skipped = self._segment_sums(missing.astype(numpy.int64), offsets) > 0
+        return [
+            None if skip else total for total, skip in zip(totals, skipped.tolist())
+        ]
+
+    @staticmethod
+    def _gather(dataset: Mapping[int, int], region_ids):
+        # look up the values of the regions, with MISSING for the regions
+        # without data: in the array of a RegionArray, indexed by region id,
+        # or by binary search in the sorted keys of the other mappings, so
+        # that memory does not depend on the largest region id
+        values = numpy.full(len(region_ids), MISSING, dtype=numpy.int64)
+        if not isinstance(dataset, RegionArray):
+            count = len(dataset)
+            keys = numpy.fromiter(dataset.keys(), dtype=numpy.int64, count=count)
+            items = numpy.fromiter(dataset.values(), dtype=numpy.int64, count=count)
+            order = numpy.argsort(keys)
+            keys, items = keys[order], items[order]
+            positions = numpy.searchsorted(keys, region_ids)
+            found = positions < len(keys)
+            found[found] &= keys[positions[found]] == region_ids[found]
+            values[found] = items[positions[found]]
+            return values
+        dense = numpy.frombuffer(dataset.values_array, dtype=numpy.int64)
+        in_range = (region_ids >= 0) & (region_ids < len(dense))
+        values[in_range] = dense[region_ids[in_range]]
+        sparse = dataset.sparse_items()
+        if sparse:
+            # the few regions with ids too large for the dense array
+            out = numpy.flatnonzero(region_ids >= len(dense))
+            values[out] = [sparse.get(x, MISSING) for x in region_ids[out].tolist()]
+        return values
+
+    @staticmethod
+    def _segment_sums(values, offsets):
+        # sums of values[offsets[n]:offsets[n + 1]], also for empty segments
+        cumsum = numpy.concatenate(([0], numpy.cumsum(values, dtype=numpy.int64)))
+        return cumsum[offsets[1:]] - cumsum[offsets[:-1]]
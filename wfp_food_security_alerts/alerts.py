@@ -1,20 +1,58 @@
+import datetime
 import logging
-import smtplib
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import List
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional
 
+from .aggregation import CountryAggregator
 from .api import APIService
+from .delivery import (
+    DEFAULT_QUEUE_SIZE,
+    DeliveryQueue,
+    DeliveryResult,
+    SMTPDeliveryService,
+)
+from .digest import DigestTemplate, group_by_recipient, recipients_of
 from .logger import LoggerMixin
+from .metrics import Metrics, MetricsMixin
+from .outbox import OutboxService
 from .population import PopulationService
+from .report import (
+    MISSING_DATA,
+    MISSING_DATA_DAYS_AGO,
+    MISSING_POPULATION,
+    MISSING_REGIONS,
+    ReportWriter,
+)
+from .snapshots import SnapshotService
+from .state import AlertKey, AlertStateService
 
 
-class AlertService(LoggerMixin):
+STAGE_DURATION = 'wfp_stage_duration_seconds'
+
+# number of countries evaluated together, as their regions arrive
+DEFAULT_BATCH_SIZE = 64
+
+
+class Rule(NamedTuple):
+    days_ago: int
+    threshold: float
+
+
+class AlertService(LoggerMixin, MetricsMixin):
 
     _config: dict
     _api: APIService
     _population: PopulationService
+    _delivery: SMTPDeliveryService
+    _outbox: Optional[OutboxService]
+    _snapshots: Optional[SnapshotService]
+    _state: Optional[AlertStateService]
+    _report: Optional[ReportWriter]
+    _resolved: List[AlertKey]
+    _foodsecurity_data: Dict[int, Mapping[int, int]]
     _logger: logging.Logger
 
     NOTIFICATION_TEMPLATE = """Food security decreases significantly in country %(country_id)s.
@@ -35,76 +73,347 @@ Best regards,
 WFP
 """
 
-    def __init__(self, config: dict, api: APIService, population: PopulationService):
+    DIGEST_TEMPLATE = DigestTemplate()
+
+    def __init__(
+        self,
+        config: dict,
+        api: APIService,
+        population: PopulationService,
+        delivery: Optional[SMTPDeliveryService] = None,
+    ):
         super(AlertService, self).__init__()
         self._config = config
         self._api = api
         self._population = population
+        self._delivery = delivery or SMTPDeliveryService(config)
+        self._outbox = None
+        self._snapshots = None
+        self._state = None
+        self._report = None
+        self._resolved = []
+        self._foodsecurity_data = {}
+
+    def set_logger(self, logger: logging.Logger):
+        super(AlertService, self).set_logger(logger)
+        self._delivery.set_logger(logger)
+
+    def set_metrics(self, metrics: Metrics):
+        super(AlertService, self).set_metrics(metrics)
+        self._api.set_metrics(metrics)
+        self._population.set_metrics(metrics)
+        self._delivery.set_metrics(metrics)
+
+    def set_outbox(self, outbox: Optional[OutboxService]):
+        self._outbox = outbox
+
+    def set_snapshots(self, snapshots: Optional[SnapshotService]):
+        self._snapshots = snapshots
+
+    def set_state(self, state: Optional[AlertStateService]):
+        self._state = state
+
+    def set_report(self, report: Optional[ReportWriter]):
+        # every country and rule evaluated is written to the report, with its
+        # totals, the reason why it is skipped, and the alert decision
+        self._report = report
+
+    def set_foodsecurity_data(self, data: Optional[Dict[int, Mapping[int, int]]]):
+        # food security data already fetched, by days ago (0 is today), e.g. by
+        # the parent process of sharded evaluations
+        self._foodsecurity_data = data or {}
+
+    def prefetch_foodsecurity_data(self) -> Dict[int, Mapping[int, int]]:
+        # food security data of today and of every window of the rules
+        countries = self._config.get('countries') or []
+        data = {0: self.get_foodsecurity_data()}
+        for days_ago in self.get_windows([self.get_rules(x) for x in countries]):
+            data[days_ago] = self.get_foodsecurity_data(days_ago=days_ago)
+        return data
+
+    def get_foodsecurity_data(
+        self, days_ago: Optional[int] = None, today: Optional[datetime.date] = None
+    ) -> Mapping[int, int]:
+        prefetched = self._foodsecurity_data.get(days_ago or 0)
+        if prefetched is not None:
+            return prefetched
+        if self._snapshots is None:
+            return self._api.get_foodsecurity_data(days_ago=days_ago)
+        # past data is read from the local snapshots when available; today's
+        # data is always downloaded, and stored as a snapshot
+        day = (today or datetime.date.today()) - datetime.timedelta(
+            days=days_ago or 0
+        )
+        if days_ago:
+            snapshot = self._snapshots.get(day)
+            if snapshot is not None:
+                self.log_debug("using the food security snapshot of %s", day)
+                return snapshot
+        data = self._api.get_foodsecurity_data(days_ago=days_ago)
+        if len(data) > 0:
+            self._snapshots.store(day, data)
+            if not days_ago:
+                self._snapshots.prune(today)
+        return data
+
+    def get_rules(self, country: Optional[dict] = None) -> List[Rule]:
+        # the rules of a country override the global ones, which default to
+        # the global days_ago and threshold settings
+        settings = self._config['global']
+        rules = (country or {}).get('rules') or settings.get('rules')
+        if not rules:
+            return [Rule(settings['days_ago'], settings['threshold'])]
+        return [Rule(rule['days_ago'], rule['threshold']) for rule in rules]
+
+    @staticmethod
+    def get_windows(rules_by_country: List[List[Rule]]) -> List[int]:
+        # distinct windows (days ago) of the rules
+        return sorted(
+            set(rule.days_ago for rules in rules_by_country for rule in rules)
+        )
 
     def run(self, dry_run: bool = False) -> List[dict]:
-        # get setings from the configuration file
-        days_ago = self._config['global']['days_ago']
-        threshold = self._config['global']['threshold']
-        # get the food security data
-        food_security = self._api.get_foodsecurity_data()
-        food_security_days_ago = self._api.get_foodsecurity_data(days_ago=days_ago)
-        # process the countries defined in the configuration file,
-        # and add outgoing notifications to the list
-        notifications = []
+        # process the countries defined in the configuration file, and return
+        # the outgoing notifications
+        return list(self.stream(dry_run))
+
+    def stream(self, dry_run: bool = False) -> Iterator[dict]:
+        # process the countries defined in the configuration file, yielding the
+        # outgoing notifications as soon as they are found: the regions are
+        # fetched in the background, the countries are evaluated in batches as
+        # their regions arrive, and the notifications are rendered and sent
+        # while the evaluation goes on
         countries = self._config.get('countries') or []
-        for country in countries:
-            self.log_debug("evaluating alerts for country id = %s", country['id'])
-            data_not_found = False
-            food_security_country = 0
-            food_security_days_ago_country = 0
-            population_country = 0
-            # get the list of regions for the country, for each one...
-            regions = self._api.get_regions_by_country_id(country['id'])
-            for region_id in regions:
-                # get the food security data for the region
-                food_security_region = food_security.get(region_id)
-                if food_security_region is None:
-                    data_not_found = True
-                    break
-                # get the food security data for the region (N days ago)
-                food_security_days_ago_region = food_security_days_ago.get(region_id)
-                if food_security_days_ago_region is None:
-                    data_not_found = True
+        # get setings from the configuration file
+        rules_by_country = [self.get_rules(country) for country in countries]
+        windows = self.get_windows(rules_by_country)
+        settings = self._config.get('global') or {}
+        pipeline = settings.get('pipeline') or {}
+        batch_size = int(pipeline.get('batch_size') or DEFAULT_BATCH_SIZE)
+        if settings.get('all_countries'):
+            # the regions of every country are read from the reverse index,
+            # and all the countries are aggregated in a single pass
+            regions_by_country: Iterator[tuple] = self._iter_indexed_regions(
+                countries
+            )
+            batch_size = max(len(countries), 1)
+        else:
+            # start getting the list of regions for all the countries,
+            # concurrently
+            regions_by_country = self._api.iter_regions_by_country_ids(
+                [country['id'] for country in countries]
+            )
+        # get the food security data, once for each distinct window
+        with self._metrics.timer(STAGE_DURATION, stage='fetch_foodsecurity'):
+            datasets = [self.get_foodsecurity_data()] + [
+                self.get_foodsecurity_data(days_ago=days_ago) for days_ago in windows
+            ]
+        # the notifications are sent in the background, unless they are queued
+        # in the outbox or grouped in digests, at the end
+        delivery = None
+        if not dry_run and self._outbox is None and not self._is_digest():
+            delivery = DeliveryQueue(
+                self._delivery.send,
+                self.build_message,
+                int(pipeline.get('queue_size') or DEFAULT_QUEUE_SIZE),
+            ).start()
+        pending: List[dict] = []
+        resolved: List[AlertKey] = []
+        self._resolved = resolved
+        completed = False
+        try:
+            offset = 0
+            while True:
+                # wait for the regions of the next countries
+                with self._metrics.timer(STAGE_DURATION, stage='fetch_regions'):
+                    batch = list(islice(regions_by_country, batch_size))
+                if not batch:
                     break
-                # get the population from the local data storage
-                population_region = self._population.get_population_by_region_id(
+                indexes = range(offset, offset + len(batch))
+                offset += len(batch)
+                notifications = self._evaluate_batch(
+                    [countries[n] for n in indexes],
+                    [rules_by_country[n] for n in indexes],
+                    windows,
+                    batch,
+                    datasets,
+                    resolved,
+                )
+                # leave out the alerts already notified
+                for notification in self.suppress(notifications):
+                    if delivery is not None:
+                        delivery.put(notification)
+                    else:
+                        pending.append(notification)
+                    yield notification
+            completed = True
+        finally:
+            regions_by_country.close()  # type: ignore
+            # the notifications already in the delivery queue are sent anyway
+            if delivery is not None:
+                with self._metrics.timer(STAGE_DURATION, stage='delivery'):
+                    results = delivery.close()
+                self.log_debug(
+                    "sent %d of %d notifications",
+                    sum(1 for result in results if result.sent),
+                    len(results),
+                )
+                self._record(result.notification for result in results if result.sent)
+            # queue the notifications in the outbox, or send the digests
+            elif completed and not dry_run and len(pending) > 0:
+                with self._metrics.timer(STAGE_DURATION, stage='delivery'):
+                    self.deliver(pending)
+            # forget the alerts resolved
+            if completed and not dry_run:
+                self.clear_resolved(resolved)
+
+    def _iter_indexed_regions(self, countries: List[dict]) -> Iterator[tuple]:
+        # regions of the countries from the reverse index; the countries
+        # missing from it (the index is not built yet, or some of its regions
+        # could not be fetched) get their regions from the API or its cache,
+        # so that they are not skipped
+        index = self._api.get_region_index()
+        missing = [country['id'] for country in countries if country['id'] not in index]
+        fetched: Dict[int, tuple] = {}
+        if missing:
+            self.log_warning(
+                "%d countries missing from the region index, fetching their regions",
+                len(missing),
+            )
+            fetched = dict(zip(missing, self._api.get_regions_by_country_ids(missing)))
+        for country in countries:
+            regions = index.get(country['id'])
+            yield regions if regions is not None else fetched.get(country['id'], ())
+
+    def get_resolved(self) -> List[AlertKey]:
+        # alerts evaluated and not firing in the last run, to forget in the
+        # alert state when the run is not delivered by this service, e.g. by
+        # the parent process of sharded evaluations
+        return list(self._resolved)
+
+    def clear_resolved(self, resolved: Iterable[AlertKey]):
+        if self._state is not None:
+            self._state.clear(resolved)
+
+    def _evaluate_batch(
+        self,
+        countries: List[dict],
+        rules_by_country: List[List[Rule]],
+        windows: List[int],
+        regions_by_country: List[tuple],
+        datasets: List[Mapping[int, int]],
+        resolved: List[AlertKey],
+    ) -> List[dict]:
+        notifications: List[dict] = []
+        # get the population of the regions from the local data storage
+        with self._metrics.timer(STAGE_DURATION, stage='population_lookup'):
+            population = self._population.get_populations(
+                set(
                     region_id
+                    for regions in regions_by_country
+                    for region_id in regions
                 )
-                if population_region is None:
-                    data_not_found = True
-                    break
-                # sum up the values for the region in the total for the country
-                food_security_days_ago_country += food_security_days_ago_region
-                food_security_country += food_security_region
-                population_country += population_region
-            # if data for one of the regions is not found, skip the country
-            if data_not_found is True:
+            )
+        # sum up the values of the regions in the totals for the countries
+        with self._metrics.timer(STAGE_DURATION, stage='aggregation'):
+            aggregator = CountryAggregator(regions_by_country)
+            totals = aggregator.totals([datasets[0], population] + datasets[1:])
+        with self._metrics.timer(STAGE_DURATION, stage='evaluation'):
+            self._evaluate(
+                countries,
+                rules_by_country,
+                windows,
+                regions_by_country,
+                totals,
+                notifications,
+                resolved,
+            )
+        return notifications
+
+    def _evaluate(
+        self,
+        countries: List[dict],
+        rules_by_country: List[List[Rule]],
+        windows: List[int],
+        regions_by_country: List[tuple],
+        totals: List[List[Optional[int]]],
+        notifications: List[dict],
+        resolved: List[AlertKey],
+    ):
+        for n, country in enumerate(countries):
+            self.log_debug("evaluating alerts for country id = %s", country['id'])
+            food_security_country = totals[0][n]
+            population_country = totals[1][n]
+            # if the country has no regions, or data for one of its regions is
+            # not found, skip the country
+            if len(regions_by_country[n]) == 0:
+                skip_reason: Optional[str] = MISSING_REGIONS
+            elif population_country is None:
+                skip_reason = MISSING_POPULATION
+            elif food_security_country is None:
+                skip_reason = MISSING_DATA
+            else:
+                skip_reason = None
+            if skip_reason is not None:
+                self._metrics.inc('wfp_countries_skipped_total')
+                if self._report is not None:
+                    for rule in rules_by_country[n]:
+                        self._report.write(
+                            {
+                                "country_id": country['id'],
+                                "days_ago": rule.days_ago,
+                                "threshold": rule.threshold,
+                                "regions": len(regions_by_country[n]),
+                                "population_country": population_country,
+                                "food_security": food_security_country,
+                                "skip_reason": skip_reason,
+                                "alert": False,
+                                "suppressed": False,
+                            }
+                        )
                 continue
+            # narrowed by the skip reasons
+            assert food_security_country is not None and population_country is not None
+            self._metrics.inc('wfp_countries_evaluated_total')
             # translate absolute numbers to percentages
             p_food_security = (
                 float(food_security_country) / float(population_country or 1.0) * 100.0
             )
-            p_food_security_days_ago = (
-                float(food_security_days_ago_country)
-                / float(population_country or 1.0)
-                * 100.0
-            )
-            # evaluate the alert condition
-            alert = self.evaluate_alert_condition(
-                threshold, p_food_security, p_food_security_days_ago,
-            )
-            # if the alert is true, create a new notification dictionary and add it
-            # to the list of outgoing notifications
-            if alert is True:
-                notification = {
+            for rule in rules_by_country[n]:
+                food_security_days_ago_country = totals[
+                    2 + windows.index(rule.days_ago)
+                ][n]
+                # if data for one of the regions is not found, skip the rule
+                if food_security_days_ago_country is None:
+                    if self._report is not None:
+                        self._report.write(
+                            {
+                                "country_id": country['id'],
+                                "days_ago": rule.days_ago,
+                                "threshold": rule.threshold,
+                                "regions": len(regions_by_country[n]),
+                                "population_country": population_country,
+                                "food_security": food_security_country,
+                                "p_food_security": p_food_security,
+                                "skip_reason": MISSING_DATA_DAYS_AGO,
+                                "alert": False,
+                                "suppressed": False,
+                            }
+                        )
+                    continue
+                p_food_security_days_ago = (
+                    float(food_security_days_ago_country)
+                    / float(population_country or 1.0)
+                    * 100.0
+                )
+                # evaluate the alert condition
+                alert = self.evaluate_alert_condition(
+                    rule.threshold, p_food_security, p_food_security_days_ago,
+                )
+                evaluation = {
                     "country_id": country['id'],
-                    "days_ago": days_ago,
-                    "threshold": threshold,
+                    "days_ago": rule.days_ago,
+                    "threshold": rule.threshold,
                     "recipients": ', '.join(country['emails']),
                     "population_country": population_country,
                     "food_security": food_security_country,
@@ -116,49 +425,152 @@ WFP
                     "p_food_security_variation": p_food_security
                     - p_food_security_days_ago,
                 }
-                notifications.append(notification)
-                self.log_info("new notification: %r", notification)
-        # send the nodifications via SMTP
-        if len(notifications) > 0 and not dry_run:
-            self.send_notifications(notifications)
-        # return the notifications
+                if self._report is not None:
+                    self._report.write(
+                        dict(
+                            evaluation,
+                            regions=len(regions_by_country[n]),
+                            skip_reason=None,
+                            alert=alert,
+                            suppressed=alert and self._is_suppressed(evaluation),
+                        )
+                    )
+                # if the alert is true, the evaluation is a new notification, to
+                # add to the list of outgoing notifications
+                if alert is True:
+                    notifications.append(evaluation)
+                    self._metrics.inc('wfp_alerts_fired_total')
+                    self.log_info("new notification: %r", evaluation)
+                else:
+                    resolved.append(
+                        (country['id'], rule.days_ago, float(rule.threshold))
+                    )
+
+    def suppress(self, notifications: List[dict]) -> List[dict]:
+        # notifications to send, leaving out the alerts already notified
+        if self._state is None or len(notifications) == 0:
+            return notifications
+        notifications, suppressed = self._state.filter(notifications)
+        for notification, reason in suppressed:
+            self._metrics.inc('wfp_alerts_suppressed_total')
+            self.log_info(
+                "suppressed notification for country id = %s "
+                "(%d days ago, threshold %.2f): %s",
+                notification['country_id'],
+                notification['days_ago'],
+                notification['threshold'],
+                reason,
+            )
         return notifications
 
-    def send_notifications(self, notifications: List[dict]):
-        # connection to the SMTP server
-        smtp_host = self._config['global']['smtp']['host']
-        smtp_port = self._config['global']['smtp']['port']
-        try:
-            s = smtplib.SMTP(host=smtp_host, port=smtp_port)
-        except smtplib.SMTPConnectError as e:
-            self.log_error("unable to connect to the SMTP server: %s", e)
-            return
-        # (optional) log in to the SMTP server
-        smtp_username = self._config['global']['smtp'].get('username')
-        smtp_password = self._config['global']['smtp'].get('password')
-        if smtp_username and smtp_password:
-            try:
-                s.login(smtp_username, smtp_password)
-            except smtplib.SMTPAuthenticationError as e:
-                self.log_error("unable to log into the SMTP server: %s", e)
-                return
-        # send the notifications
-        for notification in notifications:
-            msg = MIMEMultipart()
-            msg['From'] = self._config['global']['smtp']['sender']
+    def _is_suppressed(self, notification: dict) -> bool:
+        # whether suppress() leaves the notification out, for the report
+        if self._state is None:
+            return False
+        return len(self._state.filter([notification])[0]) == 0
+
+    def deliver(self, notifications: List[dict]):
+        # send the notifications via SMTP, or queue them in the outbox, and
+        # remember the ones delivered (or queued) in the alert state
+        if self._outbox is not None:
+            self._outbox.enqueue(notifications)
+            delivered = notifications
+        else:
+            results = self.send_notifications(notifications)
+            delivered = [result.notification for result in results if result.sent]
+        self._record(delivered)
+
+    def _record(self, delivered: Iterable[dict]):
+        # remember the notifications delivered (or queued) in the alert state
+        if self._state is not None:
+            self._state.record(delivered)
+
+    def send_notifications(self, notifications: List[dict]) -> List[DeliveryResult]:
+        # send the notifications over a pool of SMTP connections, in parallel
+        if self._is_digest():
+            return self.send_digests(notifications)
+        messages = (
+            (notification, self.build_message(notification))
+            for notification in notifications
+        )
+        results = self._delivery.send(messages)
+        self.log_debug(
+            "sent %d of %d notifications",
+            sum(1 for result in results if result.sent),
+            len(results),
+        )
+        return results
+
+    def _is_digest(self) -> bool:
+        return bool((self._config.get('global') or {}).get('digest'))
+
+    def send_digests(self, notifications: List[dict]) -> List[DeliveryResult]:
+        # send one message per recipient (admins included) with all their
+        # notifications; a notification is sent when the digests of all the
+        # recipients of its country are, or the digests of the admins for the
+        # countries without recipients, so that a failed digest of an admin
+        # does not send the notifications again to the countries
+        admins = self._config['global']['emails']
+        groups = group_by_recipient(notifications, admins)
+        messages = (
+            (
+                {"recipient": recipient},
+                self.build_digest([notifications[n] for n in indexes], recipient),
+            )
+            for recipient, indexes in groups.items()
+        )
+        sent = self._delivery.send(messages)
+        recipients = [set(recipients_of(x) or admins) for x in notifications]
+        digests: List[List[DeliveryResult]] = [[] for _ in notifications]
+        for (recipient, indexes), result in zip(groups.items(), sent):
+            for n in indexes:
+                if recipient in recipients[n]:
+                    digests[n].append(result)
+        results = [
+            DeliveryResult(
+                notification,
+                all(r.sent for r in rs),
+                max((r.attempts for r in rs), default=0),
+                next((r.error for r in rs if r.error), None),
+            )
+            for notification, rs in zip(notifications, digests)
+        ]
+        self.log_debug(
+            "sent %d of %d digests for %d notifications",
+            sum(1 for result in sent if result.sent),
+            len(sent),
+            len(notifications),
+        )
+        return results
+
+    def build_digest(self, notifications: List[dict], recipient: str) -> MIMEMultipart:
+        msg = MIMEMultipart()
+        msg['From'] = self._config['global']['smtp']['sender']
+        msg['To'] = recipient
+        countries = len(set(x['country_id'] for x in notifications))
+        msg['Subject'] = "Food security decreases significantly in %d %s" % (
+            countries,
+            'country' if countries == 1 else 'countries',
+        )
+        msg.attach(MIMEText(self.DIGEST_TEMPLATE.render(notifications), 'plain'))
+        return msg
+
+    def build_message(self, notification: dict) -> MIMEMultipart:
+        msg = MIMEMultipart()
+        msg['From'] = self._config['global']['smtp']['sender']
+        # the countries without recipients are notified to the admins only
+        if notification['recipients']:
             msg['To'] = notification['recipients']
             msg['Cc'] = ', '.join(self._config['global']['emails'])
-            msg['Subject'] = (
-                "Food security decreases significantly in country %(country_id)s"
-                % notification
-            )
-            message = self.NOTIFICATION_TEMPLATE % notification
-            msg.attach(MIMEText(message, 'plain'))
-            try:
-                s.send_message(msg)
-            except smtplib.SMTPResponseException as e:
-                self.log_error("unable to send the email message: %s", e)
-        s.close()
+        else:
+            msg['To'] = ', '.join(self._config['global']['emails'])
+        msg['Subject'] = (
+            "Food security decreases significantly in country %(country_id)s"
+            % notification
+        )
+        message = self.NOTIFICATION_TEMPLATE % notification
+        msg.attach(MIMEText(message, 'plain'))
+        return msg
 
     def evaluate_alert_condition(
         self, threshold: float, p_food_security: float, p_food_security_days_ago: float
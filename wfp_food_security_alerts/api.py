@@ -1,45 +1,293 @@
+import codecs
 import requests
+import time
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
 from json import loads
 from operator import itemgetter
-from typing import Dict, Optional
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
 
 from .logger import LoggerMixin
+from .metrics import Metrics, MetricsMixin
+from .regions import RegionArray, iter_json_array
+from .topology import TopologyEntry, TopologyService
+from .transport import HTTPTransport
 
 
-class APIService(LoggerMixin):
+DEFAULT_MAX_CONCURRENCY = 8
+
+# size of the chunks read from the network while streaming the responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# number of regions stored in the reverse index between commits
+INDEX_COMMIT_SIZE = 1000
+
+
+class APIService(LoggerMixin, MetricsMixin):
 
     _config: dict
+    _transport: HTTPTransport
+    _topology: Optional[TopologyService]
 
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, transport: Optional[HTTPTransport] = None):
         super(APIService, self).__init__()
         self._config = config
+        self._transport = transport or HTTPTransport(config)
+        self._topology = None
+
+    def set_logger(self, logger):
+        super(APIService, self).set_logger(logger)
+        self._transport.set_logger(logger)
 
-    def get_foodsecurity_data(self, days_ago: Optional[int] = None) -> Dict[int, int]:
+    def set_metrics(self, metrics: Metrics):
+        super(APIService, self).set_metrics(metrics)
+        self._transport.set_metrics(metrics)
+
+    def set_topology(self, topology: Optional[TopologyService]):
+        self._topology = topology
+
+    @property
+    def max_concurrency(self) -> int:
+        api = self._config.get('global', {}).get('api') or {}
+        return max(int(api.get('max_concurrency') or DEFAULT_MAX_CONCURRENCY), 1)
+
+    def get_foodsecurity_data(
+        self, days_ago: Optional[int] = None
+    ) -> Mapping[int, int]:
         url = self._config['global']['api']['foodsecurity']
         if days_ago is not None:
             url += '?days_ago=%d' % days_ago
+        # the response is parsed while it is streamed, into a compact array
+        data = RegionArray()
         try:
-            r = requests.get(url)
-            r.raise_for_status()
+            with closing(
+                self._transport.get(url, endpoint='foodsecurity', stream=True)
+            ) as r:
+                r.raise_for_status()
+                decoder = codecs.getincrementaldecoder(r.encoding or 'utf-8')()
+                chunks = (
+                    decoder.decode(self._count_bytes(chunk, 'foodsecurity'))
+                    for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+                )
+                for x in iter_json_array(chunks):
+                    try:
+                        data[x['region_id']] = x['food_insecure_people']
+                    except (KeyError, TypeError, ValueError):
+                        self.log_warning("skipping invalid food security data: %r", x)
         except (
             requests.exceptions.HTTPError,
             requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
         ) as e:
             self.log_error('unable to download the data from API %s', e)
-            return {}
-        data = loads(r.content)
-        return dict((x['region_id'], x['food_insecure_people']) for x in data)
+            return RegionArray()
+        except ValueError as e:
+            # the response is not a JSON array
+            self.log_error('unable to decode the data from API: %s', e)
+            return RegionArray()
+        return data
 
     def get_regions_by_country_id(self, country_id: int) -> tuple:
+        return self.get_regions_by_country_ids([country_id])[0]
+
+    def get_regions_by_country_ids(
+        self, country_ids: Iterable[int], refresh: bool = False
+    ) -> List[tuple]:
+        return list(self.iter_regions_by_country_ids(country_ids, refresh))
+
+    def iter_regions_by_country_ids(
+        self, country_ids: Iterable[int], refresh: bool = False
+    ) -> Iterator[tuple]:
+        # regions found in the topology cache and still fresh are used as they
+        # are, unless a refresh is requested; the others are fetched concurrently,
+        # with at most max_concurrency requests in flight, revalidating the
+        # cached entries with conditional requests; the requests start at once,
+        # and the regions of each country are yielded as soon as they arrive
+        country_ids = list(country_ids)
+        topology = self._topology
+        cached = [
+            topology.get(country_id) if topology is not None else None
+            for country_id in country_ids
+        ]
+        results: List[Optional[tuple]] = [
+            entry.regions
+            if entry is not None
+            and topology is not None
+            and not refresh
+            and topology.is_fresh(entry)
+            else None
+            for entry in cached
+        ]
+        pending = [n for n, regions in enumerate(results) if regions is None]
+        executor = None
+        futures: Dict[int, Future] = {}
+        if pending:
+            executor = ThreadPoolExecutor(
+                max_workers=min(self.max_concurrency, len(pending))
+            )
+            for n in pending:
+                futures[n] = executor.submit(
+                    self._fetch_regions, country_ids[n], cached[n]
+                )
+        return self._iter_regions(country_ids, cached, results, futures, executor)
+
+    def _iter_regions(
+        self,
+        country_ids: List[int],
+        cached: List[Optional[TopologyEntry]],
+        results: List[Optional[tuple]],
+        futures: Dict[int, Future],
+        executor: Optional[ThreadPoolExecutor],
+    ) -> Iterator[tuple]:
+        # results (and errors) are collected in the same order as the country
+        # ids, so the output is deterministic; the topology cache is only used
+        # by the consumer's thread
+        try:
+            for n, country_id in enumerate(country_ids):
+                if n in futures:
+                    yield self._regions_or_cached(
+                        country_id, futures[n].result, cached[n]
+                    )
+                else:
+                    yield results[n]  # type: ignore
+        finally:
+            if executor is not None:
+                for future in futures.values():
+                    future.cancel()
+                executor.shutdown(wait=True)
+            if self._topology is not None:
+                self._topology.commit()
+
+    def _fetch_regions(
+        self, country_id: int, cached: Optional[TopologyEntry] = None
+    ) -> TopologyEntry:
         url = self._config['global']['api']['country_regions']
         url = url % country_id
+        headers = {}
+        if cached is not None and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached is not None and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        r = self._transport.get(url, endpoint='country_regions', headers=headers)
+        if r.status_code == 304 and cached is not None:
+            return cached._replace(fetched_at=time.time())
+        r.raise_for_status()
+        data = loads(self._count_bytes(r.content, 'country_regions'))
+        regions = data.get('regions') or {}
+        return TopologyEntry(
+            tuple(map(itemgetter('region_id'), regions)),
+            r.headers.get('ETag'),
+            r.headers.get('Last-Modified'),
+            time.time(),
+        )
+
+    def _count_bytes(self, data: bytes, endpoint: str) -> bytes:
+        self._metrics.inc(
+            'wfp_http_downloaded_bytes_total', len(data), endpoint=endpoint
+        )
+        return data
+
+    def _regions_or_cached(
+        self,
+        country_id: int,
+        fetch: Callable[[], TopologyEntry],
+        cached: Optional[TopologyEntry],
+    ) -> tuple:
         try:
-            r = requests.get(url)
-            r.raise_for_status()
-        except requests.exceptions.HTTPError as e:
+            entry = fetch()
+        except (
+            requests.exceptions.HTTPError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as e:
             self.log_error('unable to download the data from API: %s', e)
-            return tuple()
-        data = loads(r.content)
-        regions = data.get('regions') or {}
-        return tuple(map(itemgetter('region_id'), regions))
+            # stale regions are better than no regions at all
+            return cached.regions if cached is not None else tuple()
+        if self._topology is not None:
+            self._topology.store(country_id, entry)
+        return entry.regions
+
+    def get_country_by_region_id(self, region_id: int) -> Optional[int]:
+        # None for the regions which do not belong to a country; the country
+        # id is expected at the top level of the response, or in its country
+        url = self._config['global']['api']['region_country']
+        r = self._transport.get(url % region_id, endpoint='region_country')
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        data = loads(self._count_bytes(r.content, 'region_country'))
+        country_id = data.get('country_id')
+        if country_id is None and isinstance(data.get('country'), dict):
+            country_id = data['country'].get('country_id', data['country'].get('id'))
+        return int(country_id) if country_id is not None else None
+
+    def build_region_index(
+        self, region_ids: Iterable[int], refresh: bool = False
+    ) -> int:
+        # fetch the country of the regions missing from the reverse index, or
+        # expired (all of them if a refresh is requested), with at most
+        # max_concurrency requests in flight; the countries are stored as they
+        # arrive and committed regularly, so that an interrupted build resumes
+        # where it stopped; the regions which cannot be fetched are skipped
+        topology = self._topology
+        if topology is None:
+            raise ValueError('the region index requires a topology cache')
+        region_ids = list(region_ids)
+        if not refresh:
+            region_ids = topology.stale_regions(region_ids)
+        self.log_debug("fetching the country of %d regions", len(region_ids))
+        stored = done = 0
+        pending: Deque[Tuple[int, Future]] = deque()
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            for region_id in region_ids:
+                future = executor.submit(self.get_country_by_region_id, region_id)
+                pending.append((region_id, future))
+                if len(pending) >= 4 * self.max_concurrency:
+                    stored += self._store_region_country(topology, *pending.popleft())
+                    done += 1
+                    if done % INDEX_COMMIT_SIZE == 0:
+                        topology.commit()
+            while pending:
+                stored += self._store_region_country(topology, *pending.popleft())
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            topology.commit()
+        return stored
+
+    def _store_region_country(
+        self, topology: TopologyService, region_id: int, future: Future
+    ) -> int:
+        try:
+            country_id = future.result()
+        except (
+            requests.exceptions.HTTPError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            ValueError,
+        ) as e:
+            self.log_error('unable to download the data from API: %s', e)
+            return 0
+        topology.store_region_country(region_id, country_id, time.time())
+        return 1
+
+    def get_region_index(self) -> Dict[int, tuple]:
+        # regions of each country, according to the reverse index
+        if self._topology is None:
+            return {}
+        return self._topology.get_region_index()
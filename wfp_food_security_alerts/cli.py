@@ -1,52 +1,237 @@
 import click
+import logging
+import signal
 
-from typing import Optional
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Tuple
 
-from .alerts import AlertService
-from .api import APIService
-from .config import read_config_file
 from .logger import setup as setup_logger
-from .population import PopulationService
+from .metrics import NULL_METRICS, Metrics
+
+# the services, and their dependencies (requests, yaml, smtplib, email), are
+# imported by the commands which use them, to keep the startup fast
+if TYPE_CHECKING:  # pragma: no cover
+    from .alerts import AlertService
+    from .outbox import OutboxService
+    from .population import PopulationService
+    from .shards import ShardResult
+    from .snapshots import SnapshotService
+    from .state import AlertKey, AlertStateService
+    from .topology import TopologyService
 
 
 @click.group()
 @click.option(
     "--db-population",
-    help="path to the SQLite database where population data is stored",
+    help="path to the SQLite database where population data is stored "
+    "(or to a binary index, if it ends with .popidx)",
     required=True,
 )
 @click.option(
     "--debug/--no-debug", help="enable debug mode: verbose logging", default=False,
 )
+@click.option(
+    "--log-format",
+    type=click.Choice(['text', 'json']),
+    help="format of the log lines: plain text, or JSON objects",
+    default='text',
+)
+@click.option(
+    "--metrics",
+    type=click.STRING,
+    help="write the metrics of the run to this file (Prometheus textfile, or .json)",
+    default=None,
+)
 @click.pass_context
 def cli(
     ctx: Optional[click.Context] = None,
     db_population: str = None,
     debug: bool = False,
+    log_format: str = 'text',
+    metrics: Optional[str] = None,
     **kw,
 ):
     if ctx is not None:
         ctx.ensure_object(dict)
         ctx.obj['db_population'] = db_population
         ctx.obj['debug'] = debug
+        ctx.obj['log_format'] = log_format
+        ctx.obj['metrics'] = NULL_METRICS
+        if metrics is not None:
+            # the metrics are written when the command exits, even on failure
+            registry = Metrics()
+            ctx.obj['metrics'] = registry
+            ctx.call_on_close(lambda: registry.write(metrics))
 
 
 @cli.command()
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    help="parse the CSV by chunks in this many processes",
+    default=1,
+)
 @click.argument('url', required=True)
 @click.pass_context
-def download_population(ctx: click.Context, url: str):
+def download_population(ctx: click.Context, url: str, workers: int = 1):
     """Download the population data and stores it in a local database
 
     URL is the URL of the CSV containing the population data (region_id, population).
     The CSV is expected to be comma separated, UTF-8 encoded, and included the header.
     """
+    from .population import PopulationService
+
     db_population = ctx.obj['db_population']
     debug = ctx.obj['debug']
-    logger = setup_logger(debug)
+    logger = setup_logger(debug, ctx.obj['log_format'])
     svc = PopulationService()
     svc.set_logger(logger=logger)
+    svc.set_metrics(ctx.obj['metrics'])
     svc.connect(db_population)
-    svc.download(url)
+    svc.download(url, workers)
+
+
+@cli.command()
+@click.option(
+    "-c",
+    "--config",
+    type=click.STRING,
+    help="configuration file (yaml format), see README.md for the format",
+    required=True,
+)
+@click.option(
+    "--dry-run/--no-dry-run",
+    help="enable dry-run mode: no notification is sent, only output is produced",
+    default=False,
+)
+@click.option(
+    "--outbox/--no-outbox",
+    help="queue the notifications in the outbox, see the deliver command",
+    default=False,
+)
+@click.option(
+    "--shard",
+    type=click.STRING,
+    help="evaluate only the countries of the shard i/N (0 <= i < N)",
+    default=None,
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    help="evaluate the countries in N shards, in parallel worker processes",
+    default=1,
+)
+@click.option(
+    "--output",
+    type=click.STRING,
+    help="write the notifications to this file instead of sending them",
+    default=None,
+)
+@click.option(
+    "--report",
+    type=click.STRING,
+    help="write every country evaluated to this file (.jsonl, .csv or .parquet)",
+    default=None,
+)
+@click.pass_context
+def send_alerts(
+    ctx: click.Context,
+    config: str,
+    dry_run: bool = False,
+    outbox: bool = False,
+    shard: Optional[str] = None,
+    workers: int = 1,
+    output: Optional[str] = None,
+    report: Optional[str] = None,
+):
+    """Evaluate the alerts, and send the notifications
+
+    With --shard i/N, only the countries of the i-th shard are evaluated; with
+    --output, the notifications are written to a file, to be sent by the merge
+    command once all the shards are done. With --workers N, the shards are
+    evaluated by N local processes, and their notifications are merged. With
+    --report, the totals and the decision of every country and rule evaluated
+    are written to a file, also for the countries skipped or below threshold.
+    """
+    from .config import read_config_file
+    from .population import PopulationService
+    from .report import open_report
+    from .shards import parse_shard, select_shard, write_notifications
+
+    if shard is not None and workers > 1:
+        raise click.UsageError("--shard and --workers are mutually exclusive")
+    if report is not None and workers > 1:
+        raise click.UsageError("--report and --workers are mutually exclusive")
+    try:
+        selected = parse_shard(shard) if shard is not None else (0, 1)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--shard')
+
+    debug = ctx.obj['debug']
+    logger = setup_logger(debug, ctx.obj['log_format'])
+    #
+    db_population = ctx.obj['db_population']
+    population = PopulationService()
+    population.set_logger(logger=logger)
+    population.connect(db_population, read_only=True)
+    #
+    #
+    config_data = read_config_file(config)
+    if config_data is None:
+        raise click.Abort()
+    topology = connect_topology(db_population, config_data)
+    config_data = select_shard(expand_countries(config_data, topology), selected)
+    #
+    outbox_svc = connect_outbox(db_population, config_data) if outbox else None
+    snapshots = connect_snapshots(db_population, config_data)
+    state = connect_state(db_population, config_data)
+    svc = build_alert_service(
+        config_data, logger, population, topology, snapshots, outbox_svc, state
+    )
+    svc.set_metrics(ctx.obj['metrics'])
+    report_writer = None
+    try:
+        if report is not None:
+            try:
+                report_writer = open_report(report)
+            except ValueError as e:
+                raise click.BadParameter(str(e), param_hint='--report')
+            svc.set_report(report_writer)
+        if workers > 1:
+            notifications, resolved = run_workers(
+                svc,
+                db_population,
+                config_data,
+                workers,
+                debug,
+                ctx.obj['log_format'],
+                ctx.obj['metrics'],
+            )
+            notifications = svc.suppress(notifications)
+            if not dry_run and output is None:
+                if len(notifications) > 0:
+                    svc.deliver(notifications)
+                svc.clear_resolved(resolved)
+        else:
+            notifications = svc.run(dry_run or output is not None)
+            resolved = svc.get_resolved()
+        if output is not None:
+            # the alerts resolved are forgotten by the merge command
+            write_notifications(output, selected, notifications, resolved)
+            logger.info("%d notifications written to %s", len(notifications), output)
+        if report_writer is not None:
+            report_writer.close()
+            logger.info("report written to %s", report)
+            report_writer = None
+    finally:
+        if report_writer is not None:
+            report_writer.abort()
+        if outbox_svc is not None:
+            outbox_svc.close()
+        if state is not None:
+            state.close()
+        snapshots.close()
+        topology.close()
+        population.close()
 
 
 @cli.command()
@@ -62,28 +247,493 @@ def download_population(ctx: click.Context, url: str):
     help="enable dry-run mode: no notification is sent, only output is produced",
     default=False,
 )
+@click.option(
+    "--outbox/--no-outbox",
+    help="queue the notifications in the outbox, see the deliver command",
+    default=False,
+)
+@click.option(
+    "--http-port",
+    type=click.INT,
+    help="listen on localhost:PORT for on-demand runs (POST /run)",
+    default=None,
+)
 @click.pass_context
-def send_alerts(ctx: click.Context, config: str, dry_run: bool = False):
+def serve(
+    ctx: click.Context,
+    config: str,
+    dry_run: bool = False,
+    outbox: bool = False,
+    http_port: Optional[int] = None,
+):
+    """Evaluate the alerts on a schedule, as a long-running process
+
+    The schedule is the cron expression global.serve.schedule of the config
+    file, which is reloaded when it changes; a run can also be triggered with
+    SIGUSR1, or with a POST request to /run when --http-port is given.
+    """
+    from .config import read_config_file
+    from .daemon import AlertDaemon
+    from .population import PopulationService
+
     debug = ctx.obj['debug']
-    logger = setup_logger(debug)
+    logger = setup_logger(debug, ctx.obj['log_format'])
     #
     db_population = ctx.obj['db_population']
     population = PopulationService()
     population.set_logger(logger=logger)
-    population.connect(db_population)
+    population.connect(db_population, read_only=True)
     #
+    config_data = read_config_file(config)
+    if config_data is None:
+        raise click.Abort()
+    #
+    # the databases and their caches stay open between the runs, while the
+    # services are rebuilt when the configuration changes
+    topology = connect_topology(db_population, config_data)
+    outbox_svc = connect_outbox(db_population, config_data) if outbox else None
+    snapshots = connect_snapshots(db_population, config_data)
+    state = connect_state(db_population, config_data)
+    daemon = AlertDaemon(
+        config,
+        lambda data: build_alert_service(
+            expand_countries(data, topology),
+            logger,
+            population,
+            topology,
+            snapshots,
+            outbox_svc,
+            state,
+        ),
+        dry_run=dry_run,
+        before_run=population.reload,
+    )
+    daemon.set_logger(logger=logger)
+    signal.signal(signal.SIGUSR1, lambda *args: daemon.trigger())
+    signal.signal(signal.SIGTERM, lambda *args: daemon.stop())
+    signal.signal(signal.SIGINT, lambda *args: daemon.stop())
+    try:
+        daemon.serve_forever(http_port)
+    finally:
+        if outbox_svc is not None:
+            outbox_svc.close()
+        if state is not None:
+            state.close()
+        snapshots.close()
+        topology.close()
+        population.close()
+
+
+@cli.command()
+@click.option(
+    "-c",
+    "--config",
+    type=click.STRING,
+    help="configuration file (yaml format), see README.md for the format",
+    required=True,
+)
+@click.option(
+    "--days", type=click.INT, help="number of days to backfill", default=30,
+)
+@click.pass_context
+def backfill_snapshots(ctx: click.Context, config: str, days: int):
+    """Download the food security snapshots missing for the last days
+
+    The snapshots are stored next to the population database, and used instead
+    of the API to get the food security data of the past days.
+    """
+    from .api import APIService
+    from .config import read_config_file
+
+    debug = ctx.obj['debug']
+    logger = setup_logger(debug, ctx.obj['log_format'])
     #
     config_data = read_config_file(config)
     if config_data is None:
         raise click.Abort()
     #
+    snapshots = connect_snapshots(ctx.obj['db_population'], config_data)
+    snapshots.set_logger(logger=logger)
     api = APIService(config_data)
+    api.set_logger(logger=logger)
+    try:
+        stored = snapshots.backfill(api.get_foodsecurity_data, range(days + 1))
+        logger.debug("stored %d food security snapshots", stored)
+    finally:
+        snapshots.close()
+
+
+@cli.command()
+@click.option(
+    "-c",
+    "--config",
+    type=click.STRING,
+    help="configuration file (yaml format), see README.md for the format",
+    required=True,
+)
+@click.pass_context
+def deliver(ctx: click.Context, config: str):
+    """Deliver the notifications queued in the outbox
+
+    The outbox is stored next to the population database; failed notifications
+    are retried by the next runs, and dead-lettered after too many attempts.
+    """
+    from .alerts import AlertService
+    from .api import APIService
+    from .config import read_config_file
+    from .population import PopulationService
+
+    debug = ctx.obj['debug']
+    logger = setup_logger(debug, ctx.obj['log_format'])
+    #
+    config_data = read_config_file(config)
+    if config_data is None:
+        raise click.Abort()
+    #
+    outbox = connect_outbox(ctx.obj['db_population'], config_data)
+    outbox.set_logger(logger=logger)
+    svc = AlertService(
+        config_data, api=APIService(config_data), population=PopulationService()
+    )
+    svc.set_logger(logger=logger)
+    svc.set_metrics(ctx.obj['metrics'])
+    try:
+        stats = outbox.drain(svc.send_notifications)
+        logger.info(
+            "outbox: %d sent, %d pending, %d dead",
+            stats['sent'],
+            stats['pending'],
+            stats['dead'],
+        )
+    finally:
+        outbox.close()
+
+
+@cli.command()
+@click.option(
+    "-c",
+    "--config",
+    type=click.STRING,
+    help="configuration file (yaml format), see README.md for the format",
+    required=True,
+)
+@click.pass_context
+def refresh_regions(ctx: click.Context, config: str):
+    """Download the regions of the configured countries into the topology cache
+
+    The cache is stored next to the population database; entries already in the
+    cache are revalidated with conditional requests.
+    """
+    from .api import APIService
+    from .config import read_config_file
+
+    debug = ctx.obj['debug']
+    logger = setup_logger(debug, ctx.obj['log_format'])
+    #
+    config_data = read_config_file(config)
+    if config_data is None:
+        raise click.Abort()
+    #
+    topology = connect_topology(ctx.obj['db_population'], config_data)
+    api = APIService(config_data)
+    api.set_logger(logger=logger)
+    api.set_topology(topology)
+    try:
+        countries = config_data.get('countries') or []
+        regions = api.get_regions_by_country_ids(
+            [country['id'] for country in countries], refresh=True
+        )
+        logger.debug(
+            "cached %d regions for %d countries", sum(map(len, regions)), len(regions)
+        )
+    finally:
+        topology.close()
+
+
+@cli.command()
+@click.option(
+    "-c",
+    "--config",
+    type=click.STRING,
+    help="configuration file (yaml format), see README.md for the format",
+    required=True,
+)
+@click.option(
+    "--refresh/--no-refresh",
+    help="fetch the country of every region, not only of the missing ones",
+    default=False,
+)
+@click.pass_context
+def build_region_index(ctx: click.Context, config: str, refresh: bool = False):
+    """Build the index with the country of each region of the population
+
+    The index is stored in the topology cache next to the population database,
+    and used to evaluate every country when global.all_countries is set; only
+    the regions missing from the index, or expired, are fetched again.
+    """
+    from .api import APIService
+    from .config import read_config_file
+    from .population import PopulationService
+
+    debug = ctx.obj['debug']
+    logger = setup_logger(debug, ctx.obj['log_format'])
+    #
+    config_data = read_config_file(config)
+    if config_data is None:
+        raise click.Abort()
+    #
+    db_population = ctx.obj['db_population']
+    population = PopulationService()
+    population.set_logger(logger=logger)
+    population.connect(db_population, read_only=True)
+    topology = connect_topology(db_population, config_data)
+    api = APIService(config_data)
+    api.set_logger(logger=logger)
+    api.set_metrics(ctx.obj['metrics'])
+    api.set_topology(topology)
+    try:
+        stored = api.build_region_index(population.get_region_ids(), refresh)
+        index = topology.get_region_index()
+        logger.info(
+            "indexed %d regions: %d regions in %d countries",
+            stored,
+            sum(map(len, index.values())),
+            len(index),
+        )
+    finally:
+        topology.close()
+        population.close()
+
+
+@cli.command()
+@click.option(
+    "-c",
+    "--config",
+    type=click.STRING,
+    help="configuration file (yaml format), see README.md for the format",
+    required=True,
+)
+@click.option(
+    "--dry-run/--no-dry-run",
+    help="enable dry-run mode: no notification is sent, only output is produced",
+    default=False,
+)
+@click.option(
+    "--outbox/--no-outbox",
+    help="queue the notifications in the outbox, see the deliver command",
+    default=False,
+)
+@click.argument('files', nargs=-1, required=True)
+@click.pass_context
+def merge(
+    ctx: click.Context,
+    config: str,
+    files: Tuple[str, ...],
+    dry_run: bool = False,
+    outbox: bool = False,
+):
+    """Merge the notifications of the shards, and send them
+
+    FILES are the files written by send-alerts --shard i/N --output FILE; the
+    notifications are deduplicated and sent once, after checking that no shard
+    is missing.
+    """
+    from .alerts import AlertService
+    from .api import APIService
+    from .config import read_config_file
+    from .population import PopulationService
+    from .shards import merge_notifications, missing_shards, read_notifications
+
+    debug = ctx.obj['debug']
+    logger = setup_logger(debug, ctx.obj['log_format'])
+    #
+    config_data = read_config_file(config)
+    if config_data is None:
+        raise click.Abort()
+    #
+    shards, groups, resolved = zip(*(read_notifications(path) for path in files))
+    missing = missing_shards(shards)
+    if missing:
+        raise click.ClickException(
+            "missing shards: %s" % ', '.join('%d/%d' % shard for shard in missing)
+        )
+    notifications = merge_notifications(config_data, groups)
+    for notification in notifications:
+        logger.info("new notification: %r", notification)
+    #
+    db_population = ctx.obj['db_population']
+    outbox_svc = connect_outbox(db_population, config_data) if outbox else None
+    state = connect_state(db_population, config_data)
+    svc = AlertService(
+        config_data, api=APIService(config_data), population=PopulationService()
+    )
+    svc.set_logger(logger=logger)
+    svc.set_metrics(ctx.obj['metrics'])
+    svc.set_outbox(outbox_svc)
+    svc.set_state(state)
+    try:
+        notifications = svc.suppress(notifications)
+        if not dry_run:
+            if len(notifications) > 0:
+                svc.deliver(notifications)
+            svc.clear_resolved(key for keys in resolved for key in keys)
+    finally:
+        if outbox_svc is not None:
+            outbox_svc.close()
+        if state is not None:
+            state.close()
+
+
+def build_alert_service(
+    config_data: dict,
+    logger: logging.Logger,
+    population: 'PopulationService',
+    topology: 'TopologyService',
+    snapshots: Optional['SnapshotService'],
+    outbox: Optional['OutboxService'] = None,
+    state: Optional['AlertStateService'] = None,
+) -> 'AlertService':
+    from .alerts import AlertService
+    from .api import APIService
+
+    api = APIService(config_data)
+    api.set_logger(logger=logger)
+    api.set_topology(topology)
     svc = AlertService(config_data, api=api, population=population)
     svc.set_logger(logger=logger)
+    svc.set_outbox(outbox)
+    svc.set_snapshots(snapshots)
+    svc.set_state(state)
+    return svc
+
+
+def run_workers(
+    svc: 'AlertService',
+    db_population: str,
+    config_data: dict,
+    workers: int,
+    debug: bool,
+    log_format: str,
+    metrics: Metrics = NULL_METRICS,
+) -> Tuple[List[dict], List['AlertKey']]:
+    # the food security data is downloaded once, and handed to the workers,
+    # which fetch the regions of their countries and evaluate them; the
+    # notifications and the alerts resolved of all the shards are returned,
+    # and the metrics of the workers are added to the ones of the run
+    from concurrent.futures import ProcessPoolExecutor
+    from .shards import merge_notifications
+
+    data = svc.prefetch_foodsecurity_data()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                evaluate_shard,
+                db_population,
+                config_data,
+                (index, workers),
+                data,
+                debug,
+                log_format,
+                metrics is not NULL_METRICS,
+            )
+            for index in range(workers)
+        ]
+        results = [f.result() for f in futures]
+    for result in results:
+        if result.metrics is not None:
+            metrics.merge(result.metrics)
+    notifications = merge_notifications(
+        config_data, [result.notifications for result in results]
+    )
+    return notifications, [key for result in results for key in result.resolved]
+
+
+def evaluate_shard(
+    db_population: str,
+    config_data: dict,
+    shard: Tuple[int, int],
+    foodsecurity_data: Dict[int, Mapping[int, int]],
+    debug: bool,
+    log_format: str,
+    record_metrics: bool = False,
+) -> 'ShardResult':
+    # entry point of the worker processes: the notifications are returned to
+    # the parent process, which delivers them, with the alerts resolved
+    from .logger import shutdown as shutdown_logger
+    from .population import PopulationService
+    from .shards import ShardResult, select_shard
+
+    logger = setup_logger(debug, log_format)
+    population = PopulationService()
+    population.set_logger(logger=logger)
+    population.connect(db_population, read_only=True)
+    topology = connect_topology(db_population, config_data)
+    svc = build_alert_service(
+        select_shard(config_data, shard), logger, population, topology, None
+    )
+    svc.set_foodsecurity_data(foodsecurity_data)
+    metrics = Metrics() if record_metrics else None
+    if metrics is not None:
+        svc.set_metrics(metrics)
     try:
-        svc.run(dry_run)
+        notifications = svc.run(dry_run=True)
+        return ShardResult(notifications, svc.get_resolved(), metrics)
     finally:
+        topology.close()
         population.close()
+        # the worker processes exit without running the atexit handlers
+        shutdown_logger()
+
+
+def expand_countries(config_data: dict, topology: 'TopologyService') -> dict:
+    # with global.all_countries, every country of the reverse index is evaluated
+    if not (config_data.get('global') or {}).get('all_countries'):
+        return config_data
+    from .topology import with_all_countries
+
+    return with_all_countries(config_data, topology.get_region_index())
+
+
+def connect_topology(db_population: str, config_data: dict) -> 'TopologyService':
+    from .population import sibling_database
+    from .topology import TopologyService
+
+    ttl = ((config_data.get('global') or {}).get('topology') or {}).get('ttl')
+    topology = TopologyService(ttl=ttl)
+    topology.connect(sibling_database(db_population, 'topology'))
+    return topology
+
+
+def connect_outbox(db_population: str, config_data: dict) -> 'OutboxService':
+    from .outbox import OutboxService
+    from .population import sibling_database
+
+    outbox = OutboxService(config_data)
+    outbox.connect(sibling_database(db_population, 'outbox'))
+    return outbox
+
+
+def connect_snapshots(db_population: str, config_data: dict) -> 'SnapshotService':
+    from .population import sibling_database
+    from .snapshots import SnapshotService
+
+    snapshots = SnapshotService(config_data)
+    snapshots.connect(sibling_database(db_population, 'snapshots'))
+    return snapshots
+
+
+def connect_state(
+    db_population: str, config_data: dict
+) -> Optional['AlertStateService']:
+    # the alerts are suppressed only when the suppression settings are given
+    if 'suppression' not in (config_data.get('global') or {}):
+        return None
+    from .population import sibling_database
+    from .state import AlertStateService
+
+    state = AlertStateService(config_data)
+    state.connect(sibling_database(db_population, 'state'))
+    return state
 
 
 def cli_with_env():  # pragma: no cover
@@ -0,0 +1,270 @@
+import datetime
+import json
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional, Set
+
+from .alerts import AlertService
+from .config import read_config_file
+from .logger import LoggerMixin
+
+
+DEFAULT_SCHEDULE = '0 6 * * *'
+DEFAULT_RELOAD_INTERVAL = 5.0
+
+# name, minimum and maximum value of the fields of a cron expression
+CRON_FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day of month', 1, 31),
+    ('month', 1, 12),
+    ('day of week', 0, 7),
+)
+
+
+class CronSchedule(object):
+
+    # schedule defined by a cron expression (minute, hour, day of month, month
+    # and day of week), supporting *, ranges (a-b), lists (a,b) and steps (*/n,
+    # a-b/n, and a/n from a to the maximum)
+
+    _fields: List[Set[int]]
+    _any_day_of_month: bool
+    _any_day_of_week: bool
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != len(CRON_FIELDS):
+            raise ValueError('invalid cron expression: %r' % expression)
+        self._fields = [
+            self._parse_field(part, *field) for part, field in zip(parts, CRON_FIELDS)
+        ]
+        # sunday is both 0 and 7
+        if 7 in self._fields[4]:
+            self._fields[4].add(0)
+        self._any_day_of_month = parts[2] == '*'
+        self._any_day_of_week = parts[4] == '*'
+
+    @staticmethod
+    def _parse_field(value: str, name: str, minimum: int, maximum: int) -> Set[int]:
+        result: Set[int] = set()
+        for item in value.split(','):
+            expression, _, step = item.partition('/')
+            if expression == '*':
+                start, end = minimum, maximum
+            elif '-' in expression:
+                start, end = map(int, expression.split('-', 1))
+            else:
+                start = end = int(expression)
+                if step:
+                    end = maximum
+            if start < minimum or end > maximum or start > end:
+                raise ValueError('invalid %s in cron expression: %r' % (name, item))
+            result.update(range(start, end + 1, int(step) if step else 1))
+        return result
+
+    def _matches_day(self, dt: datetime.datetime) -> bool:
+        day_of_month = dt.day in self._fields[2]
+        day_of_week = (dt.weekday() + 1) % 7 in self._fields[4]
+        # when both the day of month and the day of week are restricted, the
+        # schedule matches either of them, as in cron
+        if not self._any_day_of_month and not self._any_day_of_week:
+            return day_of_month or day_of_week
+        return day_of_month and day_of_week
+
+    def matches(self, dt: datetime.datetime) -> bool:
+        return (
+            dt.minute in self._fields[0]
+            and dt.hour in self._fields[1]
+            and dt.month in self._fields[3]
+            and self._matches_day(dt)
+        )
+
+    def next_after(self, dt: datetime.datetime) -> datetime.datetime:
+        # first minute matching the schedule, strictly after dt
+        dt = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = dt + datetime.timedelta(days=366 * 4)
+        while dt < limit:
+            if dt.month not in self._fields[3] or not self._matches_day(dt):
+                # skip to the beginning of the next day
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif dt.hour not in self._fields[1]:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in self._fields[0]:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError('the cron expression never matches')
+
+
+class AlertDaemon(LoggerMixin):
+
+    # long-running process evaluating the alerts on a schedule, or on demand;
+    # the services are built by the factory once per configuration, so that
+    # connection pools and caches stay warm between runs, and the configuration
+    # file is reloaded when it changes
+
+    _config_path: str
+    _factory: Callable[[dict], AlertService]
+    _dry_run: bool
+    _before_run: Optional[Callable[[], object]]
+    _config: Optional[dict]
+    _config_mtime: Optional[int]
+    _service: Optional[AlertService]
+    _schedule: CronSchedule
+    _reload_interval: float
+    _trigger: threading.Event
+    _stopped: threading.Event
+    _lock: threading.Lock
+    _http: Optional[ThreadingHTTPServer]
+    last_run: Optional[dict]
+
+    def __init__(
+        self,
+        config_path: str,
+        factory: Callable[[dict], AlertService],
+        dry_run: bool = False,
+        before_run: Optional[Callable[[], object]] = None,
+    ):
+        super(AlertDaemon, self).__init__()
+        self._config_path = config_path
+        self._factory = factory
+        self._dry_run = dry_run
+        # called at the start of each run, e.g. to reopen the data files
+        # replaced by another process since the previous one
+        self._before_run = before_run
+        self._config = None
+        self._config_mtime = None
+        self._service = None
+        self._schedule = CronSchedule(DEFAULT_SCHEDULE)
+        self._reload_interval = DEFAULT_RELOAD_INTERVAL
+        self._trigger = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._http = None
+        self.last_run = None
+
+    @property
+    def http_port(self) -> Optional[int]:
+        return self._http.server_address[1] if self._http is not None else None
+
+    def reload(self) -> bool:
+        # (re)load the configuration file if it changed since the last time,
+        # keeping the current configuration if the new one is not valid
+        try:
+            mtime = os.stat(self._config_path).st_mtime_ns
+        except OSError as e:
+            self.log_error("unable to read the config file: %s", e)
+            return False
+        if mtime == self._config_mtime:
+            return False
+        config = read_config_file(self._config_path, logger=self._logger)
+        self._config_mtime = mtime
+        if config is None:
+            return False
+        serve = (config.get('global') or {}).get('serve') or {}
+        try:
+            schedule = CronSchedule(serve.get('schedule') or DEFAULT_SCHEDULE)
+        except ValueError as e:
+            self.log_error("invalid schedule in the config file: %s", e)
+            return False
+        with self._lock:
+            self._config = config
+            self._schedule = schedule
+            self._reload_interval = float(
+                serve.get('reload_interval') or DEFAULT_RELOAD_INTERVAL
+            )
+            self._service = self._factory(config)
+        self.log_info("configuration loaded from %s", self._config_path)
+        return True
+
+    def trigger(self):
+        self._trigger.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._trigger.set()
+
+    def run_once(self) -> Optional[List[dict]]:
+        with self._lock:
+            service = self._service
+        if service is None:
+            return None
+        started = datetime.datetime.now()
+        try:
+            if self._before_run is not None:
+                self._before_run()
+            notifications = service.run(self._dry_run)
+        except Exception as e:  # pylint: disable=broad-except
+            # the daemon must survive the failure of a single run
+            self.log_error("evaluation failed: %s", e)
+            self.last_run = {"started": started.isoformat(), "error": str(e)}
+            return None
+        self.last_run = {
+            "started": started.isoformat(),
+            "notifications": len(notifications),
+        }
+        return notifications
+
+    def serve_forever(self, http_port: Optional[int] = None):
+        self.reload()
+        if http_port is not None:
+            self.start_http(http_port)
+        try:
+            while not self._stopped.is_set():
+                now = datetime.datetime.now()
+                next_run = self._schedule.next_after(now)
+                timeout = min((next_run - now).total_seconds(), self._reload_interval)
+                triggered = self._trigger.wait(timeout)
+                if self._stopped.is_set():
+                    break
+                self.reload()
+                if triggered:
+                    self._trigger.clear()
+                    self.log_info("evaluation triggered on demand")
+                    self.run_once()
+                elif datetime.datetime.now() >= next_run:
+                    self.run_once()
+        finally:
+            self.stop_http()
+
+    def start_http(self, port: int, host: str = '127.0.0.1'):
+        daemon = self
+
+        class TriggerHandler(BaseHTTPRequestHandler):
+            def do_GET(self):  # noqa: N802
+                if self.path != '/health':
+                    self.send_error(404)
+                    return
+                self.reply(200, {"status": "ok", "last_run": daemon.last_run})
+
+            def do_POST(self):  # noqa: N802
+                if self.path != '/run':
+                    self.send_error(404)
+                    return
+                daemon.trigger()
+                self.reply(202, {"status": "triggered"})
+
+            def reply(self, code: int, data: dict):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=W0622
+                daemon.log_debug("http trigger: " + format, *args)
+
+        self._http = ThreadingHTTPServer((host, port), TriggerHandler)
+        self._http.daemon_threads = True
+        threading.Thread(target=self._http.serve_forever, daemon=True).start()
+        self.log_info("listening for triggers on http://%s:%d/run", host, self.http_port)
+
+    def stop_http(self):
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+            self._http = None
@@ -0,0 +1,224 @@
+import queue
+import smtplib
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.message import Message
+from typing import Callable, Iterable, List, NamedTuple, Optional, Tuple
+
+from .logger import LoggerMixin
+from .metrics import MetricsMixin
+
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_QUEUE_SIZE = 64
+
+
+class DeliveryResult(NamedTuple):
+    notification: dict
+    sent: bool
+    attempts: int
+    error: Optional[str] = None
+
+
+class TransientDeliveryError(Exception):
+    pass
+
+
+class SMTPDeliveryService(LoggerMixin, MetricsMixin):
+
+    # sends email messages in parallel over a pool of SMTP connections: each
+    # worker borrows a connection (opening it when needed), and drops it when it
+    # fails; transient failures (dropped connections, 4xx replies) are retried
+    # on a new connection, and at most max_in_flight messages are queued
+
+    _config: dict
+    _pool_size: int
+    _max_in_flight: int
+    _retries: int
+    _backoff: float
+    _connections: 'queue.LifoQueue[smtplib.SMTP]'
+
+    def __init__(self, config: dict):
+        super(SMTPDeliveryService, self).__init__()
+        self._config = config
+        smtp = (config.get('global') or {}).get('smtp') or {}
+        self._pool_size = max(int(smtp.get('pool_size') or DEFAULT_POOL_SIZE), 1)
+        self._max_in_flight = max(
+            int(smtp.get('max_in_flight') or self._pool_size * 2), 1
+        )
+        self._retries = int(smtp.get('retries', DEFAULT_RETRIES))
+        self._backoff = float(smtp.get('backoff', DEFAULT_BACKOFF))
+        self._connections = queue.LifoQueue()
+
+    def send(self, messages: Iterable[Tuple[dict, Message]]) -> List[DeliveryResult]:
+        # deliver the (notification, message) pairs, returning one result per
+        # notification, in the same order
+        in_flight = threading.BoundedSemaphore(self._max_in_flight)
+        futures: List[Future] = []
+        with ThreadPoolExecutor(max_workers=self._pool_size) as executor:
+            for notification, message in messages:
+                in_flight.acquire()
+                future = executor.submit(self._deliver, notification, message)
+                future.add_done_callback(lambda _: in_flight.release())
+                futures.append(future)
+        self.close()
+        return [future.result() for future in futures]
+
+    def close(self):
+        while True:
+            try:
+                connection = self._connections.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, OSError):
+                connection.close()
+
+    def _deliver(self, notification: dict, message: Message) -> DeliveryResult:
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                with self._metrics.timer('wfp_mail_send_duration_seconds'):
+                    self._send_message(message)
+                self._metrics.inc('wfp_mails_sent_total')
+                return DeliveryResult(notification, True, attempts)
+            except TransientDeliveryError as e:
+                if attempts > self._retries:
+                    self.log_error("unable to send the email message: %s", e)
+                    self._metrics.inc('wfp_mails_failed_total')
+                    return DeliveryResult(notification, False, attempts, str(e))
+                self.log_warning("unable to send the email message, retrying: %s", e)
+                self._metrics.inc('wfp_mails_retried_total')
+                time.sleep(self._backoff * 2 ** (attempts - 1))
+            except smtplib.SMTPException as e:
+                self.log_error("unable to send the email message: %s", e)
+                self._metrics.inc('wfp_mails_failed_total')
+                return DeliveryResult(notification, False, attempts, str(e))
+
+    def _send_message(self, message: Message):
+        connection = self._get_connection()
+        try:
+            connection.send_message(message)
+        except smtplib.SMTPResponseException as e:
+            if 400 <= e.smtp_code < 500:
+                self._discard(connection)
+                raise TransientDeliveryError(e)
+            # a permanent failure for this message: the connection is still good
+            self._release(connection)
+            raise
+        except smtplib.SMTPServerDisconnected as e:
+            self._discard(connection)
+            raise TransientDeliveryError(e)
+        except smtplib.SMTPException:
+            # e.g. all the recipients refused: a permanent failure for this
+            # message, checked before OSError as SMTPException derives from it
+            self._release(connection)
+            raise
+        except OSError as e:
+            self._discard(connection)
+            raise TransientDeliveryError(e)
+        self._release(connection)
+
+    def _get_connection(self) -> smtplib.SMTP:
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            pass
+        smtp = self._config['global']['smtp']
+        try:
+            connection = smtplib.SMTP(
+                host=smtp['host'],
+                port=smtp['port'],
+                timeout=float(smtp.get('timeout') or DEFAULT_TIMEOUT),
+            )
+        except (smtplib.SMTPException, OSError) as e:
+            raise TransientDeliveryError(
+                'unable to connect to the SMTP server: %s' % e
+            )
+        # (optional) log in to the SMTP server
+        smtp_username = smtp.get('username')
+        smtp_password = smtp.get('password')
+        if smtp_username and smtp_password:
+            try:
+                connection.login(smtp_username, smtp_password)
+            except smtplib.SMTPException:
+                connection.close()
+                raise
+        return connection
+
+    def _release(self, connection: smtplib.SMTP):
+        self._connections.put(connection)
+
+    @staticmethod
+    def _discard(connection: smtplib.SMTP):
+        try:
+            connection.close()
+        except OSError:  # pragma: no cover
+            pass
+
+
+class DeliveryQueue(object):
+
+    # background delivery of notifications produced while the evaluation is
+    # still running: the notifications go through a bounded queue, so that the
+    # producer blocks when the delivery falls behind, and are rendered and sent
+    # by a single thread feeding the SMTP connection pool
+
+    _send: Callable[[Iterable[Tuple[dict, Message]]], List[DeliveryResult]]
+    _render: Callable[[dict], Message]
+    _queue: 'queue.Queue[Optional[dict]]'
+    _thread: threading.Thread
+    _results: List[DeliveryResult]
+    _error: Optional[BaseException]
+    _drained: bool
+
+    def __init__(
+        self,
+        send: Callable[[Iterable[Tuple[dict, Message]]], List[DeliveryResult]],
+        render: Callable[[dict], Message],
+        maxsize: int = DEFAULT_QUEUE_SIZE,
+    ):
+        self._send = send
+        self._render = render
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._results = []
+        self._error = None
+        self._drained = False
+
+    def start(self) -> 'DeliveryQueue':
+        self._thread.start()
+        return self
+
+    def put(self, notification: dict):
+        self._queue.put(notification)
+
+    def close(self) -> List[DeliveryResult]:
+        # wait for the notifications already queued to be delivered
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._results
+
+    def _messages(self) -> Iterable[Tuple[dict, Message]]:
+        for notification in iter(self._queue.get, None):
+            yield notification, self._render(notification)
+        self._drained = True
+
+    def _run(self):
+        try:
+            self._results = self._send(self._messages())
+        except BaseException as e:  # pylint: disable=broad-except
+            self._error = e
+            # keep consuming, so that the producer is never blocked
+            if not self._drained:
+                for _ in iter(self._queue.get, None):
+                    pass
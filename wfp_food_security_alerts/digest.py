@@ -0,0 +1,66 @@
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+# columns of the digest table: title, key and format of the value
+DIGEST_COLUMNS: Sequence[Tuple[str, str, str]] = (
+    ('country', 'country_id', '%(country_id)10s'),
+    ('days ago', 'days_ago', '%(days_ago)10d'),
+    ('population', 'population_country', '%(population_country)12d'),
+    ('% then', 'p_food_security_days_ago', '%(p_food_security_days_ago)10.2f'),
+    ('% today', 'p_food_security', '%(p_food_security)10.2f'),
+    ('variation', 'p_food_security_variation', '%(p_food_security_variation)10.2f'),
+    ('threshold', 'threshold', '%(threshold)10.2f'),
+)
+
+
+class DigestTemplate(object):
+
+    # plain-text table of notifications, one row per country and rule; the
+    # header and the row format are built once, and rendering a digest is a
+    # single % operation per row
+
+    header: str
+    row_format: str
+
+    TEXT = """Food security decreases significantly in %(count)d of your countries.
+
+%(table)s
+
+Best regards,
+WFP
+"""
+
+    def __init__(self, columns: Sequence[Tuple[str, str, str]] = DIGEST_COLUMNS):
+        widths = [len(fmt % {key: 0}) for _, key, fmt in columns]
+        self.header = '  '.join(
+            title.rjust(width) for (title, _, _), width in zip(columns, widths)
+        )
+        self.header += '\n' + '  '.join('-' * width for width in widths)
+        self.row_format = '  '.join(fmt for _, _, fmt in columns)
+
+    def render(self, notifications: Sequence[dict]) -> str:
+        row_format = self.row_format
+        rows = [row_format % notification for notification in notifications]
+        return self.TEXT % {
+            # several rules of a country are notified in several rows
+            "count": len(set(x['country_id'] for x in notifications)),
+            "table": self.header + '\n' + '\n'.join(rows),
+        }
+
+
+def recipients_of(notification: dict) -> List[str]:
+    # the recipients of the country of a notification, without the admins
+    return [x.strip() for x in notification['recipients'].split(',') if x.strip()]
+
+
+def group_by_recipient(
+    notifications: Sequence[dict], admins: Iterable[str] = ()
+) -> Dict[str, List[int]]:
+    # indexes of the notifications of each recipient, in the order of the
+    # notifications; the admins get all of them
+    admins = list(admins)
+    groups: Dict[str, List[int]] = {}
+    for n, notification in enumerate(notifications):
+        for recipient in dict.fromkeys(recipients_of(notification) + admins):
+            groups.setdefault(recipient, []).append(n)
+    return groups
@@ -1,5 +1,9 @@
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import sys
 
 from typing import Optional
@@ -8,6 +12,14 @@ from typing import Optional
 LOGGING_NAME = 'wfp-food-security-alerts'
 LOGGING_FORMAT: str = '%(asctime)s [%(levelname)s] %(message)s'
 
+TEXT = 'text'
+JSON = 'json'
+
+# the records are written to the stream by a background thread, so that
+# logging does not block the caller on a slow stdout
+_listener: Optional[logging.handlers.QueueListener] = None
+_listener_format: Optional[str] = None
+
 
 class LoggerMixin(object):
 
@@ -19,29 +31,83 @@ class LoggerMixin(object):
     def set_logger(self, logger: logging.Logger):
         self._logger = logger
 
+    # the level is checked first, so that disabled messages cost neither the
+    # formatting of their arguments nor a trip through the logging machinery
+
     def log_debug(self, *args, **kw):
-        if self._logger is not None:
+        if self._logger is not None and self._logger.isEnabledFor(logging.DEBUG):
             self._logger.debug(*args, **kw)
 
     def log_info(self, *args, **kw):
-        if self._logger is not None:
+        if self._logger is not None and self._logger.isEnabledFor(logging.INFO):
             self._logger.info(*args, **kw)
 
     def log_warning(self, *args, **kw):
-        if self._logger is not None:
+        if self._logger is not None and self._logger.isEnabledFor(logging.WARNING):
             self._logger.warning(*args, **kw)
 
     def log_error(self, *args, **kw):
-        if self._logger is not None:
+        if self._logger is not None and self._logger.isEnabledFor(logging.ERROR):
             self._logger.error(*args, **kw)
 
 
-def setup(debug: bool = False) -> logging.Logger:
-    logger = logging.getLogger('%s[%s]' % (LOGGING_NAME, os.getpid()))
-    logger.setLevel(logging.DEBUG if debug else logging.INFO)
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.DEBUG if debug else logging.INFO)
-    formatter = logging.Formatter(LOGGING_FORMAT)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+class JSONFormatter(logging.Formatter):
+
+    # one JSON object per line, for log collectors
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+def setup(debug: bool = False, log_format: str = TEXT) -> logging.Logger:
+    # calling setup again only updates the level, or the format, of the
+    # same logger: handlers are never stacked up
+    global _listener, _listener_format
+    level = logging.DEBUG if debug else logging.INFO
+    logger = logging.getLogger(LOGGING_NAME)
+    logger.setLevel(level)
+    logger.propagate = False
+    if _listener is None or _listener_format != log_format:
+        shutdown()
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(
+            JSONFormatter() if log_format == JSON else logging.Formatter(LOGGING_FORMAT)
+        )
+        records: 'queue.SimpleQueue[logging.LogRecord]' = queue.SimpleQueue()
+        logger.addHandler(logging.handlers.QueueHandler(records))
+        _listener = logging.handlers.QueueListener(records, handler)
+        _listener_format = log_format
+        _listener.start()
     return logger
+
+
+def shutdown():
+    # flush the pending records, and detach the queue from the logger
+    if _listener is not None:
+        _listener.stop()
+    _detach()
+
+
+def _detach():
+    global _listener, _listener_format
+    _listener = None
+    _listener_format = None
+    logger = logging.getLogger(LOGGING_NAME)
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+
+
+atexit.register(shutdown)
+# the listener thread does not survive a fork: the child process starts over
+# with its own pipeline, at its next setup
+os.register_at_fork(after_in_child=_detach)
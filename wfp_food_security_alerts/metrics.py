@@ -0,0 +1,248 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# upper bounds (in seconds) of the buckets of the duration histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# help texts of the metrics recorded by the services
+DESCRIPTIONS = {
+    'wfp_http_requests_total': 'HTTP requests, by endpoint and status',
+    'wfp_http_retries_total': 'HTTP requests retried, by endpoint',
+    'wfp_http_request_duration_seconds': 'latency of the HTTP requests',
+    'wfp_http_downloaded_bytes_total': 'bytes downloaded, by endpoint',
+    'wfp_population_rows_ingested_total': 'population rows written to the database',
+    'wfp_population_rows_rejected_total': 'invalid population rows, by reason',
+    'wfp_population_ingest_duration_seconds': 'duration of the population ingests',
+    'wfp_population_lookups_total': 'regions looked up in the population database',
+    'wfp_stage_duration_seconds': 'duration of the stages of the alert runs',
+    'wfp_countries_evaluated_total': 'countries evaluated',
+    'wfp_countries_skipped_total': 'countries skipped because of missing data',
+    'wfp_alerts_fired_total': 'alerts fired',
+    'wfp_alerts_suppressed_total': 'alerts suppressed as already notified',
+    'wfp_mails_sent_total': 'email messages sent',
+    'wfp_mails_failed_total': 'email messages which could not be sent',
+    'wfp_mails_retried_total': 'email messages retried after a transient failure',
+    'wfp_mail_send_duration_seconds': 'duration of the SMTP transactions',
+}
+
+
+class Histogram(object):
+
+    buckets: Tuple[float, ...]
+    counts: List[int]
+    sum: float
+    count: int
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        # counts are per bucket here, and cumulated when exported
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: 'Histogram'):
+        # the histograms have the same buckets
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+
+class Metrics(object):
+
+    # in-memory registry of counters and histograms, exported at the end of a
+    # run in the Prometheus textfile format or as JSON
+
+    _lock: threading.Lock
+    _counters: Dict[str, Dict[Labels, float]]
+    _histograms: Dict[str, Dict[Labels, Histogram]]
+    _help: Dict[str, str]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = dict(DESCRIPTIONS)
+
+    def __getstate__(self) -> dict:
+        # the registries of the worker processes are sent to the parent
+        # process, without their lock
+        with self._lock:
+            state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def merge(self, other: 'Metrics'):
+        # add the counters and histograms of another registry, e.g. of a
+        # worker process, to this one
+        with self._lock:
+            for name, values in other._counters.items():
+                counters = self._counters.setdefault(name, {})
+                for key, value in values.items():
+                    counters[key] = counters.get(key, 0) + value
+            for name, histograms in other._histograms.items():
+                merged = self._histograms.setdefault(name, {})
+                for key, h in histograms.items():
+                    if key not in merged:
+                        merged[key] = Histogram(h.buckets)
+                    merged[key].merge(h)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            if key not in histograms:
+                histograms[key] = Histogram()
+            histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def counter(self, name: str, **labels) -> float:
+        key = self._key(labels)
+        with self._lock:
+            return self._counters.get(name, {}).get(key, 0)
+
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        key = self._key(labels)
+        with self._lock:
+            return self._histograms.get(name, {}).get(key)
+
+    @staticmethod
+    def _key(labels: Dict[str, object]) -> Labels:
+        # the label values are strings, as in the exported formats, so that
+        # e.g. status=200 and status='error' can be sorted together
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+        items = labels + extra
+        if not items:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in items
+        )
+
+    def to_prometheus(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for name in sorted(self._counters):
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (name, self._help[name]))
+                lines.append('# TYPE %s counter' % name)
+                for labels, value in sorted(self._counters[name].items()):
+                    lines.append('%s%s %r' % (name, self._format_labels(labels), value))
+            for name in sorted(self._histograms):
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (name, self._help[name]))
+                lines.append('# TYPE %s histogram' % name)
+                for labels, h in sorted(self._histograms[name].items()):
+                    cumulated = 0
+                    for bound, count in zip(h.buckets, h.counts):
+                        cumulated += count
+                        le = self._format_labels(labels, (('le', repr(bound)),))
+                        lines.append('%s_bucket%s %d' % (name, le, cumulated))
+                    le = self._format_labels(labels, (('le', '+Inf'),))
+                    lines.append('%s_bucket%s %d' % (name, le, h.count))
+                    lines.append(
+                        '%s_sum%s %r' % (name, self._format_labels(labels), h.sum)
+                    )
+                    lines.append(
+                        '%s_count%s %d' % (name, self._format_labels(labels), h.count)
+                    )
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(
+                    (name, [dict(labels=dict(k), value=v) for k, v in values.items()])
+                    for name, values in self._counters.items()
+                ),
+                "histograms": dict(
+                    (
+                        name,
+                        [
+                            dict(labels=dict(k), count=h.count, sum=h.sum)
+                            for k, h in values.items()
+                        ],
+                    )
+                    for name, values in self._histograms.items()
+                ),
+            }
+
+    def write(self, path: str):
+        # the file is replaced atomically, as the node exporter may read it at
+        # any time; a .json extension selects the JSON format
+        if path.endswith('.json'):
+            data = json.dumps(self.to_json(), indent=2) + '\n'
+        else:
+            data = self.to_prometheus()
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+class NullMetrics(Metrics):
+
+    # metrics disabled: every operation is a no-op
+
+    def inc(self, name: str, value: float = 1, **labels):
+        pass
+
+    def observe(self, name: str, value: float, **labels):
+        pass
+
+    def merge(self, other: Metrics):
+        pass
+
+    def timer(self, name: str, **labels):  # type: ignore
+        return NULL_CONTEXT
+
+
+NULL_CONTEXT = nullcontext()
+
+NULL_METRICS = NullMetrics()
+
+
+class MetricsMixin(object):
+
+    _metrics: Metrics = NULL_METRICS
+
+    def set_metrics(self, metrics: Metrics):
+        self._metrics = metrics
@@ -0,0 +1,146 @@
+import json
+import sqlite3
+import time
+
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .delivery import DeliveryResult
+from .logger import LoggerMixin
+
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF = 60.0
+
+PENDING = 'pending'
+SENT = 'sent'
+DEAD = 'dead'
+
+
+class OutboxService(LoggerMixin):
+
+    # durable queue of outgoing notifications: the evaluation enqueues them,
+    # and the delivery drains them in batches; failed notifications are
+    # rescheduled with an exponential backoff, and dead-lettered after
+    # max_attempts attempts
+
+    _db: Optional[sqlite3.Connection]
+    _batch_size: int
+    _max_attempts: int
+    _backoff: float
+
+    def __init__(self, config: Optional[dict] = None):
+        super(OutboxService, self).__init__()
+        outbox = ((config or {}).get('global') or {}).get('outbox') or {}
+        self._db = None
+        self._batch_size = int(outbox.get('batch_size') or DEFAULT_BATCH_SIZE)
+        self._max_attempts = int(outbox.get('max_attempts') or DEFAULT_MAX_ATTEMPTS)
+        self._backoff = float(outbox.get('backoff', DEFAULT_BACKOFF))
+
+    def connect(self, db_outbox: str) -> sqlite3.Connection:
+        db = sqlite3.connect(db_outbox)
+        db.execute("PRAGMA journal_mode = WAL;")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "notification TEXT, status TEXT, attempts INTEGER, next_attempt_at REAL, "
+            "created_at REAL, updated_at REAL, last_error TEXT);"
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);"
+        )
+        db.commit()
+        self._db = db
+        return db
+
+    def close(self):
+        self._db.close()
+        self._db = None
+
+    def enqueue(self, notifications: Iterable[dict], now: Optional[float] = None) -> int:
+        assert self._db is not None
+        now = time.time() if now is None else now
+        c = self._db.executemany(
+            "INSERT INTO outbox (notification, status, attempts, next_attempt_at, "
+            "created_at, updated_at) VALUES (?, ?, 0, ?, ?, ?);",
+            (
+                (json.dumps(notification), PENDING, now, now, now)
+                for notification in notifications
+            ),
+        )
+        self._db.commit()
+        self.log_debug("enqueued %d notifications in the outbox", c.rowcount)
+        return c.rowcount
+
+    def due(
+        self, limit: Optional[int] = None, now: Optional[float] = None
+    ) -> List[Tuple[int, dict]]:
+        assert self._db is not None
+        now = time.time() if now is None else now
+        c = self._db.execute(
+            "SELECT id, notification FROM outbox "
+            "WHERE status = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?;",
+            [PENDING, now, limit or self._batch_size],
+        )
+        return [(row[0], json.loads(row[1])) for row in c.fetchall()]
+
+    def mark_sent(self, ids: Sequence[int], now: Optional[float] = None):
+        assert self._db is not None
+        now = time.time() if now is None else now
+        self._db.executemany(
+            "UPDATE outbox SET status = ?, attempts = attempts + 1, updated_at = ?, "
+            "last_error = NULL WHERE id = ?;",
+            ((SENT, now, id_) for id_ in ids),
+        )
+
+    def mark_failed(self, id_: int, error: Optional[str], now: Optional[float] = None):
+        assert self._db is not None
+        now = time.time() if now is None else now
+        c = self._db.execute("SELECT attempts FROM outbox WHERE id = ?;", [id_])
+        attempts = c.fetchone()[0] + 1
+        if attempts >= self._max_attempts:
+            self.log_error(
+                "giving up on notification %d after %d attempts: %s",
+                id_,
+                attempts,
+                error,
+            )
+            status, next_attempt_at = DEAD, None
+        else:
+            status = PENDING
+            next_attempt_at = now + self._backoff * 2 ** (attempts - 1)
+        self._db.execute(
+            "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, "
+            "updated_at = ?, last_error = ? WHERE id = ?;",
+            [status, attempts, next_attempt_at, now, error, id_],
+        )
+
+    def drain(
+        self,
+        send: Callable[[List[dict]], List[DeliveryResult]],
+        now: Optional[float] = None,
+    ) -> Dict[str, int]:
+        # deliver the due notifications, batch by batch, until none is left;
+        # notifications rescheduled in the meantime are not due yet
+        assert self._db is not None
+        now = time.time() if now is None else now
+        stats = {SENT: 0, PENDING: 0, DEAD: 0}
+        while True:
+            batch = self.due(now=now)
+            if not batch:
+                break
+            results = send([notification for _, notification in batch])
+            self.mark_sent([id_ for (id_, _), r in zip(batch, results) if r.sent], now)
+            stats[SENT] += sum(1 for r in results if r.sent)
+            for (id_, _), result in zip(batch, results):
+                if not result.sent:
+                    self.mark_failed(id_, result.error, now)
+            self._db.commit()
+        counts = self.counts()
+        stats[PENDING] = counts.get(PENDING, 0)
+        stats[DEAD] = counts.get(DEAD, 0)
+        return stats
+
+    def counts(self) -> Dict[str, int]:
+        assert self._db is not None
+        c = self._db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status;")
+        return dict(c.fetchall())
@@ -1,87 +1,533 @@
 import csv
+import hashlib
 import logging
+import os
 import requests
 import sqlite3
+import tempfile
+import time
 
 from contextlib import closing
-from typing import Iterator, Optional
+from itertools import islice
+from typing import IO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote
 
 from .logger import LoggerMixin
+from .metrics import Metrics, MetricsMixin
+from .population_index import (
+    PopulationIndex,
+    PopulationIndexError,
+    is_population_index,
+    write_population_index,
+)
+from .population_ingest import (
+    MAX_VALUE,
+    NOT_INTEGER,
+    OUT_OF_RANGE,
+    WRONG_COLUMNS,
+    ingest,
+)
+from .transport import HTTPTransport
 
 
-class PopulationService(LoggerMixin):
+# number of region ids looked up with a single SELECT ... IN (...) statement,
+# below the SQLite default limit of host parameters
+LOOKUP_CHUNK_SIZE = 500
 
-    _db: sqlite3.Connection
+# number of rows inserted with a single executemany() call
+INSERT_BATCH_SIZE = 10000
 
-    def __init__(self):
+# size of the memory-mapped I/O window for read-only connections
+MMAP_SIZE = 256 * 1024 * 1024
+
+# size of the chunks read from the network while downloading the population
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# downloads larger than this are spooled to disk instead of memory
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+
+class PopulationSource(NamedTuple):
+    url: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    sha256: Optional[str] = None
+
+
+class PopulationChanges(NamedTuple):
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+
+
+def _pairs(iterator: Iterable[dict]) -> Iterator[Tuple[int, int]]:
+    return ((row['region_id'], row['population']) for row in iterator)
+
+
+def sibling_database(db_population: str, name: str) -> str:
+    # auxiliary databases are stored next to the population database, e.g.
+    # population.sqlite3 -> population.topology.sqlite3; they are SQLite
+    # databases also when the population is stored in a binary index
+    root, ext = os.path.splitext(db_population)
+    if is_population_index(db_population):
+        ext = '.sqlite3'
+    return '%s.%s%s' % (root, name, ext or '.sqlite3')
+
+
+class PopulationService(LoggerMixin, MetricsMixin):
+
+    # the population is stored in a SQLite database, or in a memory-mapped
+    # binary index when the file name ends with .popidx
+
+    _db: Optional[sqlite3.Connection]
+    _index: Optional[PopulationIndex]
+    _index_path: Optional[str]
+    _transport: HTTPTransport
+
+    def __init__(self, transport: Optional[HTTPTransport] = None):
         super(PopulationService, self).__init__()
         self._db = None
+        self._index = None
+        self._index_path = None
+        self._transport = transport or HTTPTransport()
 
-    def connect(self, db_population: str) -> sqlite3.Connection:
-        db = sqlite3.connect(db_population)
+    def set_logger(self, logger: logging.Logger):
+        super(PopulationService, self).set_logger(logger)
+        self._transport.set_logger(logger)
+
+    def set_metrics(self, metrics: Metrics):
+        super(PopulationService, self).set_metrics(metrics)
+        self._transport.set_metrics(metrics)
+
+    def connect(
+        self, db_population: str, read_only: bool = False
+    ) -> Optional[sqlite3.Connection]:
+        if is_population_index(db_population):
+            # the index is written by download() if it does not exist yet
+            self._index_path = db_population
+            if read_only or os.path.exists(db_population):
+                self._index = PopulationIndex(db_population)
+            return None
+        if read_only:
+            # the alerting path only reads the population: open the database in
+            # read-only mode and let SQLite memory-map it
+            db = sqlite3.connect('file:%s?mode=ro' % quote(db_population), uri=True)
+            db.execute("PRAGMA mmap_size = %d;" % MMAP_SIZE)
+        else:
+            db = sqlite3.connect(db_population)
         self._db = db
         return db
 
+    def reload(self) -> bool:
+        # reopen the population index if its file was replaced since it was
+        # mapped, e.g. by download-population in another process: the
+        # long-running processes call it before each run
+        if self._index_path is None:
+            return False
+        try:
+            st = os.stat(self._index_path)
+        except OSError:
+            return False
+        if self._index is not None and self._index.identity == (
+            st.st_ino,
+            st.st_mtime_ns,
+        ):
+            return False
+        try:
+            index = PopulationIndex(self._index_path)
+        except (OSError, PopulationIndexError) as e:
+            self.log_error('unable to reload the population index: %s', e)
+            return False
+        if self._index is not None:
+            self._index.close()
+        self._index = index
+        self.log_info("population index reloaded from %s", self._index_path)
+        return True
+
     def close(self):
+        if self._index_path is not None:
+            if self._index is not None:
+                self._index.close()
+            self._index = None
+            self._index_path = None
+            return
         self._db.close()
         self._db = None
 
-    def download(self, url: str,) -> int:
-        iterator = self.get_rows_from_url(url)
-        return self.write_rows_to_sqlite(iterator)
+    def download(self, url: str, workers: int = 1) -> PopulationChanges:
+        # the population data changes rarely: the source is downloaded only if
+        # it was modified since the last download, and written to the database
+        # only if its content changed, upserting only the changed regions; the
+        # CSV is parsed by chunks, in a pool of processes if workers > 1
+        source = self.get_source(url)
+        headers = {}
+        if source is not None and source.etag:
+            headers['If-None-Match'] = source.etag
+        if source is not None and source.last_modified:
+            headers['If-Modified-Since'] = source.last_modified
+        self.log_debug("downloading population data from %s", url)
+        try:
+            with closing(
+                self._transport.get(
+                    url, endpoint='population', stream=True, headers=headers
+                )
+            ) as r:
+                if r.status_code == 304 and source is not None:
+                    self.log_info("population data not modified since last download")
+                    return PopulationChanges()
+                r.raise_for_status()
+                spool, sha256 = self._spool(r)
+        except (
+            requests.exceptions.HTTPError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as e:
+            self.log_error('unable to download the data: %s', e)
+            return PopulationChanges()
+        new_source = PopulationSource(
+            url, r.headers.get('ETag'), r.headers.get('Last-Modified'), sha256
+        )
+        with spool:
+            if source is not None and source.sha256 == sha256:
+                self.log_info("population data not changed since last download")
+                self._store_source(new_source)
+                if self._db is not None:
+                    self._db.commit()
+                return PopulationChanges()
+            rows = self.read_population(spool, workers)
+            try:
+                if self._index_path is not None:
+                    changes = self._write_index(rows, new_source)
+                else:
+                    changes = self._upsert(rows, new_source)
+            except ValueError as e:
+                # the header is parsed lazily, with the first chunk: the
+                # current data is kept
+                if self._db is not None:
+                    self._db.rollback()
+                self.log_error('unable to read the population data: %s', e)
+                return PopulationChanges()
+        self.log_info(
+            "population data updated: %d inserted, %d updated, %d deleted",
+            changes.inserted,
+            changes.updated,
+            changes.deleted,
+        )
+        return changes
+
+    def _spool(self, r: requests.Response) -> Tuple[IO[bytes], str]:
+        # spool the response to a temporary file, hashing it on the way
+        digest = hashlib.sha256()
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            spool.write(chunk)
+        self._metrics.inc(
+            'wfp_http_downloaded_bytes_total', spool.tell(), endpoint='population'
+        )
+        spool.seek(0)
+        return spool, digest.hexdigest()
+
+    def read_population(
+        self, f: IO[bytes], workers: int = 1
+    ) -> Iterator[Tuple[int, int]]:
+        # (region id, population) rows of a CSV file; invalid rows are skipped,
+        # and reported by chunk
+        first = 1
+        for n, chunk in enumerate(ingest(f, workers)):
+            for line, reason, row in chunk.reported:
+                if reason == WRONG_COLUMNS:
+                    message = "skipping line %d, wrong number of columns: %s"
+                elif reason == OUT_OF_RANGE:
+                    message = "ignoring line %d, negative or too large values: %s"
+                else:
+                    message = "ignoring line %d, unable to convert values to int: %s"
+                self.log_warning(message, first + line + 1, row)
+            if chunk.rejected:
+                self.log_warning(
+                    "chunk %d (lines %d-%d): %d rows rejected, %d with a wrong "
+                    "number of columns, %d with values which are not integers, "
+                    "%d with negative or too large values",
+                    n,
+                    first + 1,
+                    first + chunk.rows,
+                    chunk.rejected,
+                    chunk.wrong_columns,
+                    chunk.not_integer,
+                    chunk.out_of_range,
+                )
+                self._metrics.inc(
+                    'wfp_population_rows_rejected_total',
+                    chunk.wrong_columns,
+                    reason=WRONG_COLUMNS,
+                )
+                self._metrics.inc(
+                    'wfp_population_rows_rejected_total',
+                    chunk.not_integer,
+                    reason=NOT_INTEGER,
+                )
+                self._metrics.inc(
+                    'wfp_population_rows_rejected_total',
+                    chunk.out_of_range,
+                    reason=OUT_OF_RANGE,
+                )
+            first += chunk.rows
+            yield from zip(chunk.region_ids, chunk.populations)
 
     def get_rows_from_url(
         self, url: str, logger: Optional[logging.Logger] = None
     ) -> Iterator[dict]:
         self.log_debug("downloading population data from %s", url)
         try:
-            with closing(requests.get(url, stream=True)) as r:
+            with closing(
+                self._transport.get(url, endpoint='population', stream=True)
+            ) as r:
                 r.raise_for_status()
                 lines = r.iter_lines(decode_unicode=True)
-                reader = csv.reader(lines, delimiter=',', quotechar='"')
-                header = None
-                for n, row in enumerate(reader):
-                    if header is None:
-                        header = row
-                        continue
-                    elif len(row) != len(header):
-                        self.log_warning(
-                            "skipping line %d, wrong number of columns: %s", n + 1, row
-                        )
-                        continue
-                    try:
-                        values = map(int, row)
-                    except (ValueError, TypeError):
-                        self.log_warning(
-                            "ignoring line %d, unable to convert values to int: %s",
-                            n + 1,
-                            row,
-                        )
-                    data = dict(zip(header, values))
-                    yield data
-        except requests.exceptions.HTTPError as e:
+                yield from self.get_rows_from_lines(lines)
+        except (
+            requests.exceptions.HTTPError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as e:
             self.log_error('unable to download the data: %s', e)
 
+    def get_rows_from_lines(self, lines: Iterable[str]) -> Iterator[dict]:
+        reader = csv.reader(lines, delimiter=',', quotechar='"')
+        header = None
+        for n, row in enumerate(reader):
+            if header is None:
+                header = row
+                continue
+            elif len(row) != len(header):
+                self.log_warning(
+                    "skipping line %d, wrong number of columns: %s", n + 1, row
+                )
+                continue
+            try:
+                values = list(map(int, row))
+            except (ValueError, TypeError):
+                self.log_warning(
+                    "ignoring line %d, unable to convert values to int: %s",
+                    n + 1,
+                    row,
+                )
+                continue
+            data = dict(zip(header, values))
+            if not all(
+                0 <= data.get(column, 0) <= MAX_VALUE
+                for column in ('region_id', 'population')
+            ):
+                self.log_warning(
+                    "ignoring line %d, negative or too large values: %s", n + 1, row
+                )
+                continue
+            yield data
+
     def write_rows_to_sqlite(
         self, iterator: Iterator[dict], logger: Optional[logging.Logger] = None,
     ) -> int:
+        assert self._db is not None
+        n = self._write_rows_to_shadow_table(_pairs(iterator))
+        # swap the tables atomically, in a single transaction
+        self._db.execute("BEGIN IMMEDIATE;")
         self._db.execute("DROP TABLE IF EXISTS population;")
+        self._db.execute("ALTER TABLE population_new RENAME TO population;")
+        self._db.commit()
+        return n
+
+    def upsert_rows_to_sqlite(
+        self, iterator: Iterator[dict], source: Optional[PopulationSource] = None,
+    ) -> PopulationChanges:
+        return self._upsert(_pairs(iterator), source)
+
+    def _upsert(
+        self, rows: Iterable[Tuple[int, int]], source: Optional[PopulationSource]
+    ) -> PopulationChanges:
+        assert self._db is not None
+        self._write_rows_to_shadow_table(rows)
+        # apply only the differences to the live table, in a single transaction,
+        # together with the metadata of the source
+        self._db.execute("BEGIN IMMEDIATE;")
+        if not self._has_table('population'):
+            inserted = self._db.execute("SELECT COUNT(*) FROM population_new;")
+            changes = PopulationChanges(inserted=inserted.fetchone()[0])
+            self._db.execute("ALTER TABLE population_new RENAME TO population;")
+        else:
+            deleted = self._db.execute(
+                "DELETE FROM population WHERE region_id NOT IN "
+                "(SELECT region_id FROM population_new);"
+            )
+            updated = self._db.execute(
+                "UPDATE population SET population = (SELECT n.population "
+                "FROM population_new n WHERE n.region_id = population.region_id) "
+                "WHERE EXISTS (SELECT 1 FROM population_new n "
+                "WHERE n.region_id = population.region_id "
+                "AND n.population IS NOT population.population);"
+            )
+            inserted = self._db.execute(
+                "INSERT INTO population (region_id, population) "
+                "SELECT region_id, population FROM population_new "
+                "WHERE region_id NOT IN (SELECT region_id FROM population);"
+            )
+            changes = PopulationChanges(
+                inserted.rowcount, updated.rowcount, deleted.rowcount
+            )
+            self._db.execute("DROP TABLE population_new;")
+        if source is not None:
+            self._store_source(source)
+        self._db.commit()
+        return changes
+
+    def _write_rows_to_shadow_table(self, rows: Iterable[Tuple[int, int]]) -> int:
+        assert self._db is not None
+        started = time.perf_counter()
+        # rows are streamed into a shadow table in batches, so that memory usage
+        # does not depend on the size of the data set, and readers keep seeing
+        # the current population table until the new one is swapped in
+        self._db.execute("PRAGMA journal_mode = WAL;")
+        self._db.execute("PRAGMA synchronous = NORMAL;")
+        self._db.execute("DROP TABLE IF EXISTS population_new;")
         self._db.execute(
-            "CREATE TABLE IF NOT EXISTS population (region_id INTEGER PRIMARY KEY, population INTEGER);"
+            "CREATE TABLE population_new (region_id INTEGER PRIMARY KEY, population INTEGER);"
         )
-        n = -1
-        for n, row in enumerate(iterator):
-            self._db.execute(
-                "INSERT INTO population (region_id, population) VALUES (?, ?);",
-                [row['region_id'], row['population']],
+        n = 0
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, INSERT_BATCH_SIZE))
+            if not batch:
+                break
+            self._db.executemany(
+                "INSERT INTO population_new (region_id, population) VALUES (?, ?);",
+                batch,
             )
-        self.log_debug("inserted %d records into the population database", n + 1)
+            n += len(batch)
         self._db.commit()
-        return n + 1
+        elapsed = time.perf_counter() - started
+        self._metrics.inc('wfp_population_rows_ingested_total', n)
+        self._metrics.observe('wfp_population_ingest_duration_seconds', elapsed)
+        self.log_debug(
+            "inserted %d records into the population database (%.0f rows/s)",
+            n,
+            n / elapsed if elapsed > 0 else 0.0,
+        )
+        return n
+
+    def write_rows_to_index(
+        self, iterator: Iterator[dict], source: Optional[PopulationSource] = None
+    ) -> PopulationChanges:
+        return self._write_index(_pairs(iterator), source)
+
+    def _write_index(
+        self, rows: Iterable[Tuple[int, int]], source: Optional[PopulationSource]
+    ) -> PopulationChanges:
+        # the index is rewritten as a whole, and swapped with the previous one;
+        # the changes are counted against the previous one, once per region
+        assert self._index_path is not None
+        started = time.perf_counter()
+        previous = self._index
+        populations: Dict[int, int] = dict(rows)
+        inserted = updated = 0
+        for region_id, population in populations.items():
+            old = previous.get(region_id) if previous is not None else None
+            if old is None:
+                inserted += 1
+            elif old != population:
+                updated += 1
+        metadata = source._asdict() if source is not None else {}
+        n = write_population_index(self._index_path, populations.items(), metadata)
+        deleted = (len(previous) if previous is not None else 0) - (n - inserted)
+        if previous is not None:
+            previous.close()
+        self._index = PopulationIndex(self._index_path)
+        elapsed = time.perf_counter() - started
+        self._metrics.inc('wfp_population_rows_ingested_total', n)
+        self._metrics.observe('wfp_population_ingest_duration_seconds', elapsed)
+        self.log_debug(
+            "wrote %d records into the population index (%.0f rows/s)",
+            n,
+            n / elapsed if elapsed > 0 else 0.0,
+        )
+        return PopulationChanges(inserted, updated, deleted)
+
+    def _has_table(self, name: str) -> bool:
+        assert self._db is not None
+        c = self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", [name]
+        )
+        return c.fetchone() is not None
+
+    def get_source(self, url: str) -> Optional[PopulationSource]:
+        if self._index_path is not None:
+            if self._index is None or self._index.metadata.get('url') != url:
+                return None
+            return PopulationSource(**self._index.metadata)
+        assert self._db is not None
+        # the metadata is meaningless if the population table has been removed
+        if not self._has_table('population_source') or not self._has_table(
+            'population'
+        ):
+            return None
+        c = self._db.execute(
+            "SELECT url, etag, last_modified, sha256 FROM population_source "
+            "WHERE url = ?;",
+            [url],
+        )
+        row = c.fetchone()
+        return PopulationSource(*row) if row is not None else None
+
+    def _store_source(self, source: PopulationSource):
+        if self._index_path is not None:
+            assert self._index is not None
+            write_population_index(
+                self._index_path, self._index.items(), source._asdict()
+            )
+            self._index.close()
+            self._index = PopulationIndex(self._index_path)
+            return
+        assert self._db is not None
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS population_source (url TEXT PRIMARY KEY, "
+            "etag TEXT, last_modified TEXT, sha256 TEXT);"
+        )
+        self._db.execute(
+            "INSERT OR REPLACE INTO population_source "
+            "(url, etag, last_modified, sha256) VALUES (?, ?, ?, ?);",
+            list(source),
+        )
+
+    def get_region_ids(self) -> List[int]:
+        if self._index is not None:
+            return [region_id for region_id, _ in self._index.items()]
+        assert self._db is not None
+        c = self._db.execute("SELECT region_id FROM population ORDER BY region_id;")
+        return [row[0] for row in c]
 
     def get_population_by_region_id(self, region_id: int) -> Optional[int]:
+        if self._index is not None:
+            return self._index.get(region_id)
+        assert self._db is not None
         c = self._db.execute(
             "SELECT population FROM population WHERE region_id = ?;", [region_id]
         )
         row = c.fetchone()
         return row[0] if row is not None else None
+
+    def get_populations(self, region_ids: Iterable[int]) -> Dict[int, int]:
+        # look up the population of many regions with a few chunked queries;
+        # regions without population data are not included in the result
+        region_ids = list(region_ids)
+        self._metrics.inc('wfp_population_lookups_total', len(region_ids))
+        if self._index is not None:
+            return self._index.get_many(region_ids)
+        assert self._db is not None
+        populations: Dict[int, int] = {}
+        for i in range(0, len(region_ids), LOOKUP_CHUNK_SIZE):
+            chunk = region_ids[i : i + LOOKUP_CHUNK_SIZE]
+            c = self._db.execute(
+                "SELECT region_id, population FROM population WHERE region_id IN (%s);"
+                % ', '.join('?' * len(chunk)),
+                chunk,
+            )
+            populations.update(c.fetchall())
+        return populations
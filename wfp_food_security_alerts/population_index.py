@@ -0,0 +1,216 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from array import array
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from .regions import MISSING
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # type: ignore
+
+
+# file extension selecting the binary population index instead of SQLite
+INDEX_EXTENSION = '.popidx'
+
+MAGIC = b'WFPPOP\x00\x00'
+VERSION = 1
+
+# layouts of the payload: region ids and populations as two sorted int64
+# arrays (binary search), or populations directly indexed by region id, with
+# MISSING for the regions without data
+SORTED = 0
+DENSE = 1
+
+# the dense layout is used when it is at most this many times larger than
+# the sorted one
+DENSE_MAX_RATIO = 2
+
+# magic, version, layout, crc32 of the payload and of the metadata, number of
+# regions, length of the arrays, length of the metadata (JSON)
+HEADER = struct.Struct('<8sHHIqqq')
+
+
+class PopulationIndexError(Exception):
+    pass
+
+
+def is_population_index(path: str) -> bool:
+    return os.path.splitext(path)[1] == INDEX_EXTENSION
+
+
+def write_population_index(
+    path: str, rows: Iterable[Tuple[int, int]], metadata: Optional[dict] = None
+) -> int:
+    # write the (region id, population) rows, replacing the file atomically:
+    # readers which mapped the previous file keep reading it until they close
+    # it; the last population of a region wins, and the rows which cannot be
+    # indexed (negative ids or populations, which the parsers reject) are
+    # skipped
+    populations: Dict[int, int] = {}
+    for region_id, population in rows:
+        if region_id >= 0 and population >= 0:
+            populations[region_id] = population
+    region_ids = array('q', sorted(populations))
+    count = len(region_ids)
+    length = region_ids[-1] + 1 if count else 0
+    if length <= DENSE_MAX_RATIO * 2 * count:
+        layout = DENSE
+        payload = array('q', [MISSING]) * length
+        for region_id, population in populations.items():
+            payload[region_id] = population
+    else:
+        layout, length = SORTED, count
+        payload = region_ids + array('q', map(populations.__getitem__, region_ids))
+    if payload.itemsize != 8:  # pragma: no cover
+        raise PopulationIndexError('64-bit integers are not supported')
+    data = payload.tobytes()
+    meta = json.dumps(metadata or {}).encode('utf-8')
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        layout,
+        zlib.crc32(meta, zlib.crc32(data)),
+        count,
+        length,
+        len(meta),
+    )
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        f.write(data)
+        f.write(meta)
+    os.replace(tmp, path)
+    return count
+
+
+class PopulationIndex(object):
+
+    # read-only, memory-mapped population index: lookups read the mapped
+    # arrays in place, without copying nor parsing them
+
+    metadata: dict
+    layout: int
+    identity: Tuple[int, int]
+    _count: int
+    _file: Optional[object]
+    _mmap: Optional[mmap.mmap]
+    _region_ids: memoryview
+    _populations: memoryview
+
+    def __init__(self, path: str, verify: bool = True):
+        self._file = open(path, 'rb')
+        # inode and modification time of the file mapped, to tell whether the
+        # path was replaced since
+        st = os.fstat(self._file.fileno())
+        self.identity = (st.st_ino, st.st_mtime_ns)
+        try:
+            data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            self._file.close()
+            raise PopulationIndexError('%s is not a population index' % path)
+        self._mmap = data
+        try:
+            self._load(data, path, verify)
+        except Exception:
+            self.close()
+            raise
+
+    def _load(self, data: mmap.mmap, path: str, verify: bool):
+        if len(data) < HEADER.size:
+            raise PopulationIndexError('%s is not a population index' % path)
+        header = HEADER.unpack_from(data)
+        magic, version, layout, crc, count, length, meta_length = header
+        if magic != MAGIC:
+            raise PopulationIndexError('%s is not a population index' % path)
+        if version != VERSION:
+            raise PopulationIndexError(
+                'unsupported version %d of the population index %s' % (version, path)
+            )
+        size = length * 8 * (2 if layout == SORTED else 1)
+        if len(data) != HEADER.size + size + meta_length:
+            raise PopulationIndexError('the population index %s is truncated' % path)
+        view = memoryview(data)[HEADER.size :]
+        if verify and zlib.crc32(view[size:], zlib.crc32(view[:size])) != crc:
+            view.release()
+            raise PopulationIndexError('checksum mismatch in %s' % path)
+        self.metadata = json.loads(bytes(view[size:]).decode('utf-8'))
+        self.layout = layout
+        self._count = count
+        values = view[:size].cast('q')
+        view.release()
+        if layout == SORTED:
+            self._region_ids = values[:length]
+            self._populations = values[length:]
+        else:
+            self._region_ids = values[:0]
+            self._populations = values
+
+    def close(self):
+        for name in ('_region_ids', '_populations'):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()  # type: ignore
+            self._file = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def get(self, region_id: int) -> Optional[int]:
+        if self.layout == DENSE:
+            if 0 <= region_id < len(self._populations):
+                value = self._populations[region_id]
+                return value if value != MISSING else None
+            return None
+        n = bisect.bisect_left(self._region_ids, region_id)  # type: ignore
+        if n < len(self._region_ids) and self._region_ids[n] == region_id:
+            return self._populations[n]
+        return None
+
+    def get_many(self, region_ids: Iterable[int]) -> Dict[int, int]:
+        # regions without population data are not included in the result
+        region_ids = list(region_ids)
+        if numpy is not None and len(region_ids) > 0:
+            return self._get_many_numpy(region_ids)
+        result = {}
+        for region_id in region_ids:
+            value = self.get(region_id)
+            if value is not None:
+                result[region_id] = value
+        return result
+
+    def _get_many_numpy(self, region_ids: list) -> Dict[int, int]:
+        keys = numpy.array(region_ids, dtype=numpy.int64)
+        populations = numpy.frombuffer(self._populations, dtype=numpy.int64)
+        values = numpy.full(len(keys), MISSING, dtype=numpy.int64)
+        if self.layout == DENSE:
+            found = (keys >= 0) & (keys < len(populations))
+            values[found] = populations[keys[found]]
+        else:
+            ids = numpy.frombuffer(self._region_ids, dtype=numpy.int64)
+            positions = numpy.searchsorted(ids, keys)
+            found = positions < len(ids)
+            found[found] &= ids[positions[found]] == keys[found]
+            values[found] = populations[positions[found]]
+        found = values != MISSING
+        return dict(zip(keys[found].tolist(), values[found].tolist()))
+
+    def items(self) -> Iterator[Tuple[int, int]]:
+        if self.layout == DENSE:
+            for region_id, value in enumerate(self._populations):
+                if value != MISSING:
+                    yield region_id, value
+        else:
+            yield from zip(self._region_ids, self._populations)
@@ -0,0 +1,140 @@
+import csv
+import io
+
+from array import array
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import IO, Deque, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+
+# size of the chunks of CSV parsed by the workers: a chunk is extended to the
+# end of its last line
+INGEST_CHUNK_SIZE = 4 * 1024 * 1024
+
+# at most this many invalid rows of each chunk are reported individually, the
+# others are only counted
+MAX_REPORTED_ROWS = 10
+
+# reasons why a row is rejected
+WRONG_COLUMNS = 'wrong_columns'
+NOT_INTEGER = 'not_integer'
+OUT_OF_RANGE = 'out_of_range'
+
+# region ids and populations are stored as signed 64 bits integers
+MAX_VALUE = 2 ** 63 - 1
+
+
+class ChunkResult(NamedTuple):
+    # the valid rows of a chunk, as two typed arrays, with the rejected rows
+    # counted by reason; the line numbers of the reported rows are relative to
+    # the first row of the chunk
+    region_ids: array
+    populations: array
+    rows: int
+    wrong_columns: int
+    not_integer: int
+    out_of_range: int
+    reported: List[Tuple[int, str, List[str]]]
+
+    @property
+    def rejected(self) -> int:
+        return self.wrong_columns + self.not_integer + self.out_of_range
+
+
+def parse_header(line: bytes) -> List[str]:
+    header = next(csv.reader([line.decode('utf-8')]), [])
+    for column in ('region_id', 'population'):
+        if column not in header:
+            raise ValueError('missing column %r in the population data' % column)
+    return header
+
+
+def parse_chunk(data: bytes, header: Sequence[str]) -> ChunkResult:
+    # entry point of the worker processes: the chunk is made of whole lines,
+    # so that it can be decoded on its own; every value must be an integer,
+    # and the region id and population must fit in the arrays, and not be
+    # negative
+    region_column = header.index('region_id')
+    population_column = header.index('population')
+    columns = len(header)
+    region_ids, populations = array('q'), array('q')
+    wrong_columns = not_integer = out_of_range = 0
+    reported: List[Tuple[int, str, List[str]]] = []
+    n = -1
+    reader = csv.reader(io.StringIO(data.decode('utf-8'), newline=''))
+    for n, row in enumerate(reader):
+        if len(row) != columns:
+            wrong_columns += 1
+            reason = WRONG_COLUMNS
+        else:
+            try:
+                values = list(map(int, row))
+                region_id = values[region_column]
+                population = values[population_column]
+                if not (0 <= region_id <= MAX_VALUE and 0 <= population <= MAX_VALUE):
+                    raise OverflowError
+            except ValueError:
+                not_integer += 1
+                reason = NOT_INTEGER
+            except OverflowError:
+                out_of_range += 1
+                reason = OUT_OF_RANGE
+            else:
+                region_ids.append(region_id)
+                populations.append(population)
+                continue
+        if len(reported) < MAX_REPORTED_ROWS:
+            reported.append((n, reason, row))
+    return ChunkResult(
+        region_ids,
+        populations,
+        n + 1,
+        wrong_columns,
+        not_integer,
+        out_of_range,
+        reported,
+    )
+
+
+def iter_chunks(f: IO[bytes], chunk_size: int = INGEST_CHUNK_SIZE) -> Iterator[bytes]:
+    # split the file on line boundaries
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            return
+        if not data.endswith(b'\n'):
+            data += f.readline()
+        yield data
+
+
+def ingest(
+    f: IO[bytes],
+    workers: int = 1,
+    chunk_size: int = INGEST_CHUNK_SIZE,
+    header: Optional[Sequence[str]] = None,
+) -> Iterator[ChunkResult]:
+    # parse the CSV by chunks, in order; with several workers the chunks are
+    # parsed in a process pool, and a bounded number of them is in flight, so
+    # that memory usage does not depend on the size of the file
+    if header is None:
+        line = f.readline()
+        if not line:
+            return
+        header = parse_header(line)
+    chunks = iter_chunks(f, chunk_size)
+    if workers <= 1:
+        for data in chunks:
+            yield parse_chunk(data, header)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: Deque[Future] = deque()
+        try:
+            for data in chunks:
+                pending.append(executor.submit(parse_chunk, data, header))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
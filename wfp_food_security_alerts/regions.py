@@ -0,0 +1,170 @@
+from array import array
+from collections.abc import Mapping
+from json import JSONDecoder
+from operator import index
+from typing import Dict, Iterable, Iterator
+
+
+# marker for the regions without a value in a RegionArray
+MISSING = -1
+
+# region ids and values are stored as signed 64 bits integers
+MAX_VALUE = 2 ** 63 - 1
+
+# the array indexed by region id is extended to a region only while it has at
+# most this many slots per region with a value, or fewer slots than the
+# minimum size: the regions with larger ids are kept in a dict, so that memory
+# does not depend on the largest region id
+DENSE_MAX_RATIO = 4
+DENSE_MIN_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+
+
+class RegionArray(Mapping):
+
+    # compact mapping of region ids to non-negative integer values (e.g. the
+    # number of food insecure people): values are stored in a typed array
+    # directly indexed by region id, with MISSING for the regions without data,
+    # and the few regions with ids too large for the array in a dict; it can be
+    # used wherever a dict of region ids to values was used before
+
+    _values: array
+    _sparse: Dict[int, int]
+    _count: int
+
+    def __init__(self, items: Iterable = ()):
+        self._values = array('q')
+        self._sparse = {}
+        self._count = 0
+        for region_id, value in items:
+            self[region_id] = value
+
+    @property
+    def values_array(self) -> array:
+        # the values of the regions indexed by the array, see sparse_items()
+        return self._values
+
+    def sparse_items(self) -> Dict[int, int]:
+        return self._sparse
+
+    @classmethod
+    def frombytes(cls, data: bytes) -> 'RegionArray':
+        result = cls()
+        values = result._values
+        values.frombytes(data)
+        if values and values[-1] < MISSING:
+            # trailer of the regions out of the array, see tobytes()
+            n = MISSING - values[-1]
+            pairs = values[len(values) - 1 - 2 * n : -1]
+            result._sparse = dict(zip(pairs[::2], pairs[1::2]))
+            del values[len(values) - 1 - 2 * n :]
+        result._count = len(values) - values.count(MISSING) + len(result._sparse)
+        return result
+
+    def tobytes(self) -> bytes:
+        # the array, followed, if there are regions out of the array, by their
+        # (region id, value) pairs and by MISSING minus their number: values
+        # are never lower than MISSING, so that the arrays without trailer
+        # keep their format
+        if not self._sparse:
+            return self._values.tobytes()
+        trailer = array('q')
+        for region_id, value in sorted(self._sparse.items()):
+            trailer.extend((region_id, value))
+        trailer.append(MISSING - len(self._sparse))
+        return self._values.tobytes() + trailer.tobytes()
+
+    def __setitem__(self, region_id: int, value: int):
+        # TypeError if the region id or the value is not an integer
+        region_id, value = index(region_id), index(value)
+        if not (0 <= region_id <= MAX_VALUE and 0 <= value <= MAX_VALUE):
+            raise ValueError('invalid region value: %r = %r' % (region_id, value))
+        size = len(self._values)
+        if region_id >= size:
+            limit = max(DENSE_MIN_SIZE, DENSE_MAX_RATIO * (self._count + 1))
+            if region_id >= limit:
+                if region_id not in self._sparse:
+                    self._count += 1
+                self._sparse[region_id] = value
+                return
+            # grow geometrically, to amortize the cost of the reallocations
+            grow = min(max(region_id + 1 - size, size // 2), limit - size)
+            self._values.extend(array('q', [MISSING]) * grow)
+            self._move_sparse()
+        if self._values[region_id] == MISSING:
+            self._count += 1
+        self._values[region_id] = value
+
+    def _move_sparse(self):
+        # the regions which now fit in the array are moved to it
+        size = len(self._values)
+        for region_id in [x for x in self._sparse if x < size]:
+            self._values[region_id] = self._sparse.pop(region_id)
+
+    def __getitem__(self, region_id: int) -> int:
+        value = self.get(region_id)
+        if value is None:
+            raise KeyError(region_id)
+        return value
+
+    def get(self, region_id: int, default=None):
+        # faster than the Mapping implementation, which relies on KeyError
+        if 0 <= region_id < len(self._values):
+            value = self._values[region_id]
+            if value != MISSING:
+                return value
+            return default
+        return self._sparse.get(region_id, default)
+
+    def __contains__(self, region_id) -> bool:
+        return isinstance(region_id, int) and self.get(region_id) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        yield from (
+            region_id
+            for region_id, value in enumerate(self._values)
+            if value != MISSING
+        )
+        yield from sorted(self._sparse)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __repr__(self) -> str:
+        return 'RegionArray(%r)' % dict(self.items())
+
+
+def iter_json_array(chunks: Iterable[str]) -> Iterator:
+    # incrementally decode the items of a top-level JSON array from a stream of
+    # text chunks, keeping in memory only the part not decoded yet
+    decoder = JSONDecoder()
+    buffer = ''
+    started = False
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError('expected a JSON array at position %d' % pos)
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            if buffer[pos] == ',':
+                pos += 1
+                continue
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # the item is not complete yet: wait for the next chunk
+                break
+            yield item
+        buffer = buffer[pos:]
+    raise ValueError('unexpected end of the JSON array')
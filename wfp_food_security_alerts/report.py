@@ -0,0 +1,180 @@
+import abc
+import csv
+import json
+import os
+
+from typing import IO, Any, Dict, List, Sequence, Tuple, Type
+
+try:
+    import pyarrow  # type: ignore
+    import pyarrow.parquet  # type: ignore
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+
+# columns of the report, with their types, one row per country and rule; the
+# alerts left out by the suppression settings are reported with alert and
+# suppressed set
+REPORT_COLUMNS: Sequence[Tuple[str, str]] = (
+    ('country_id', 'int'),
+    ('days_ago', 'int'),
+    ('threshold', 'float'),
+    ('regions', 'int'),
+    ('population_country', 'int'),
+    ('food_security', 'int'),
+    ('food_security_days_ago', 'int'),
+    ('food_security_variation', 'int'),
+    ('p_food_security', 'float'),
+    ('p_food_security_days_ago', 'float'),
+    ('p_food_security_variation', 'float'),
+    ('skip_reason', 'str'),
+    ('alert', 'bool'),
+    ('suppressed', 'bool'),
+)
+
+# reasons why a country, or one of its rules, is not evaluated
+MISSING_REGIONS = 'missing_regions'
+MISSING_POPULATION = 'missing_population'
+MISSING_DATA = 'missing_data'
+MISSING_DATA_DAYS_AGO = 'missing_data_days_ago'
+
+# number of rows of each row group of the Parquet files
+PARQUET_ROW_GROUP_SIZE = 4096
+
+
+def project(row: Dict[str, Any]) -> Dict[str, Any]:
+    # the columns of the report, in order, None for the missing ones
+    return dict((name, row.get(name)) for name, _ in REPORT_COLUMNS)
+
+
+class ReportWriter(abc.ABC):
+
+    # rows are written as they come, to a temporary file which replaces the
+    # report when it is closed, so that a report is never read half written
+
+    path: str
+    _tmp: str
+
+    def __init__(self, path: str):
+        self.path = path
+        self._tmp = '%s.%d.tmp' % (path, os.getpid())
+
+    @abc.abstractmethod
+    def write(self, row: Dict[str, Any]):
+        pass
+
+    def close(self):
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+
+class JSONLinesReportWriter(ReportWriter):
+
+    _file: IO[str]
+
+    def __init__(self, path: str):
+        super(JSONLinesReportWriter, self).__init__(path)
+        self._file = open(self._tmp, 'w')
+
+    def write(self, row: Dict[str, Any]):
+        self._file.write(json.dumps(project(row)) + '\n')
+
+    def close(self):
+        self._file.close()
+        super(JSONLinesReportWriter, self).close()
+
+    def abort(self):
+        self._file.close()
+        super(JSONLinesReportWriter, self).abort()
+
+
+class CSVReportWriter(ReportWriter):
+
+    _file: IO[str]
+    _writer: csv.DictWriter
+
+    def __init__(self, path: str):
+        super(CSVReportWriter, self).__init__(path)
+        self._file = open(self._tmp, 'w', newline='')
+        self._writer = csv.DictWriter(
+            self._file, [name for name, _ in REPORT_COLUMNS], extrasaction='ignore'
+        )
+        self._writer.writeheader()
+
+    def write(self, row: Dict[str, Any]):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+        super(CSVReportWriter, self).close()
+
+    def abort(self):
+        self._file.close()
+        super(CSVReportWriter, self).abort()
+
+
+class ParquetReportWriter(ReportWriter):
+
+    # the rows are buffered, and written by row groups of bounded size
+
+    _schema: Any
+    _writer: Any
+    _rows: List[Dict[str, Any]]
+
+    TYPES = {'int': 'int64', 'float': 'float64', 'str': 'string', 'bool': 'bool_'}
+
+    def __init__(self, path: str):
+        if pyarrow is None:
+            raise ValueError('pyarrow is required to write Parquet reports')
+        super(ParquetReportWriter, self).__init__(path)
+        self._schema = pyarrow.schema(
+            [
+                (name, getattr(pyarrow, self.TYPES[kind])())
+                for name, kind in REPORT_COLUMNS
+            ]
+        )
+        self._writer = pyarrow.parquet.ParquetWriter(self._tmp, self._schema)
+        self._rows = []
+
+    def write(self, row: Dict[str, Any]):
+        self._rows.append(project(row))
+        if len(self._rows) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            table = pyarrow.Table.from_pylist(self._rows, schema=self._schema)
+            self._writer.write_table(table)
+            self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+        super(ParquetReportWriter, self).close()
+
+    def abort(self):
+        self._writer.close()
+        super(ParquetReportWriter, self).abort()
+
+
+WRITERS: Dict[str, Type[ReportWriter]] = {
+    '.jsonl': JSONLinesReportWriter,
+    '.json': JSONLinesReportWriter,
+    '.csv': CSVReportWriter,
+    '.parquet': ParquetReportWriter,
+}
+
+
+def open_report(path: str) -> ReportWriter:
+    # the format is given by the extension of the file
+    extension = os.path.splitext(path)[1]
+    writer = WRITERS.get(extension.lower())
+    if writer is None:
+        raise ValueError(
+            'unknown report format %r, expected one of: %s'
+            % (extension, ', '.join(sorted(WRITERS)))
+        )
+    return writer(path)
@@ -0,0 +1,127 @@
+import json
+import os
+import zlib
+
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from .metrics import Metrics
+from .state import AlertKey
+
+
+Shard = Tuple[int, int]
+
+
+class ShardResult(NamedTuple):
+    # outcome of the evaluation of a shard: the notifications to send, the
+    # alerts resolved, to forget in the alert state, and the metrics of the
+    # evaluation when they are recorded
+    notifications: List[dict]
+    resolved: List[AlertKey]
+    metrics: Optional[Metrics] = None
+
+
+def parse_shard(value: str) -> Shard:
+    # "i/N" is the i-th of N shards, counting from 0
+    index, _, count = value.partition('/')
+    try:
+        shard = int(index), int(count)
+    except ValueError:
+        raise ValueError('invalid shard %r, expected i/N' % value)
+    if shard[1] < 1 or not 0 <= shard[0] < shard[1]:
+        raise ValueError('invalid shard %r, expected 0 <= i < N' % value)
+    return shard
+
+
+def shard_of(country_id: int, count: int) -> int:
+    # stable across processes and machines, unlike hash()
+    return zlib.crc32(str(country_id).encode('utf-8')) % count
+
+
+def select_shard(config: dict, shard: Shard) -> dict:
+    # copy of the configuration restricted to the countries of the shard
+    index, count = shard
+    result = dict(config)
+    result['countries'] = [
+        country
+        for country in config.get('countries') or []
+        if shard_of(country['id'], count) == index
+    ]
+    return result
+
+
+def write_notifications(
+    path: str,
+    shard: Shard,
+    notifications: Iterable[dict],
+    resolved: Iterable[AlertKey] = (),
+):
+    # JSON lines: a header naming the shard, with the alerts resolved, then
+    # one notification per line; the file is replaced atomically, so that a
+    # merge never reads half of it
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    header = {"shard": list(shard), "resolved": [list(key) for key in resolved]}
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(header) + '\n')
+        for notification in notifications:
+            f.write(json.dumps(notification) + '\n')
+    os.replace(tmp, path)
+
+
+def read_notifications(
+    path: str,
+) -> Tuple[Optional[Shard], List[dict], List[AlertKey]]:
+    shard = None
+    notifications = []
+    resolved: List[AlertKey] = []
+    with open(path) as f:
+        for n, line in enumerate(f):
+            data = json.loads(line)
+            if n == 0 and 'shard' in data:
+                shard = tuple(data['shard'])
+                resolved = [tuple(key) for key in data.get('resolved') or []]
+            else:
+                notifications.append(data)
+    return shard, notifications, resolved  # type: ignore
+
+
+def missing_shards(shards: Iterable[Optional[Shard]]) -> List[Shard]:
+    # shards not found among the given ones, for each number of shards seen
+    found = set(shard for shard in shards if shard is not None)
+    return [
+        (index, count)
+        for count in sorted(set(count for _, count in found))
+        for index in range(count)
+        if (index, count) not in found
+    ]
+
+
+def merge_notifications(config: dict, groups: Sequence[List[dict]]) -> List[dict]:
+    # one notification per country and rule, ordered as a single process
+    # would: by country as configured, then by rule
+    order: Dict[int, int] = dict(
+        (country['id'], n) for n, country in enumerate(config.get('countries') or [])
+    )
+    seen = set()
+    merged = []
+    for notifications in groups:
+        for notification in notifications:
+            key = (
+                notification['country_id'],
+                notification['days_ago'],
+                notification['threshold'],
+            )
+            if key not in seen:
+                seen.add(key)
+                merged.append(notification)
+
+    def position(notification: dict) -> Tuple[int, int]:
+        # the countries which are not configured (see global.all_countries)
+        # come last, by id, as in a single process
+        country_id = notification['country_id']
+        if country_id in order:
+            return order[country_id], 0
+        return len(order), country_id
+
+    # the sort is stable: the rules of a country keep their order
+    merged.sort(key=position)
+    return merged
@@ -0,0 +1,107 @@
+import datetime
+import sqlite3
+import time
+import zlib
+
+from typing import Callable, Iterable, List, Mapping, Optional
+
+from .logger import LoggerMixin
+from .regions import RegionArray
+
+
+DEFAULT_RETENTION_DAYS = 400
+
+
+class SnapshotService(LoggerMixin):
+
+    # local time series of the food security data: one compressed snapshot of
+    # the whole data set per day, so that past values can be read locally
+    # instead of being downloaded again
+
+    _db: Optional[sqlite3.Connection]
+    _retention_days: int
+
+    def __init__(self, config: Optional[dict] = None):
+        super(SnapshotService, self).__init__()
+        snapshots = ((config or {}).get('global') or {}).get('snapshots') or {}
+        self._db = None
+        self._retention_days = int(
+            snapshots.get('retention_days') or DEFAULT_RETENTION_DAYS
+        )
+
+    def connect(self, db_snapshots: str) -> sqlite3.Connection:
+        db = sqlite3.connect(db_snapshots)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots "
+            "(day TEXT PRIMARY KEY, created_at REAL, data BLOB);"
+        )
+        db.commit()
+        self._db = db
+        return db
+
+    def close(self):
+        self._db.close()
+        self._db = None
+
+    def get(self, day: datetime.date) -> Optional[RegionArray]:
+        assert self._db is not None
+        c = self._db.execute(
+            "SELECT data FROM snapshots WHERE day = ?;", [day.isoformat()]
+        )
+        row = c.fetchone()
+        if row is None:
+            return None
+        return RegionArray.frombytes(zlib.decompress(row[0]))
+
+    def has(self, day: datetime.date) -> bool:
+        assert self._db is not None
+        c = self._db.execute(
+            "SELECT 1 FROM snapshots WHERE day = ?;", [day.isoformat()]
+        )
+        return c.fetchone() is not None
+
+    def store(self, day: datetime.date, data: Mapping[int, int]):
+        assert self._db is not None
+        if not isinstance(data, RegionArray):
+            data = RegionArray(data.items())
+        self._db.execute(
+            "INSERT OR REPLACE INTO snapshots (day, created_at, data) VALUES (?, ?, ?);",
+            [day.isoformat(), time.time(), zlib.compress(data.tobytes())],
+        )
+        self._db.commit()
+
+    def days(self) -> List[datetime.date]:
+        assert self._db is not None
+        c = self._db.execute("SELECT day FROM snapshots ORDER BY day;")
+        return [datetime.date.fromisoformat(row[0]) for row in c.fetchall()]
+
+    def prune(self, today: Optional[datetime.date] = None) -> int:
+        # remove the snapshots older than the retention period
+        assert self._db is not None
+        today = today or datetime.date.today()
+        oldest = today - datetime.timedelta(days=self._retention_days)
+        c = self._db.execute(
+            "DELETE FROM snapshots WHERE day < ?;", [oldest.isoformat()]
+        )
+        self._db.commit()
+        return c.rowcount
+
+    def backfill(
+        self,
+        fetch: Callable[[Optional[int]], Mapping[int, int]],
+        days_ago: Iterable[int],
+        today: Optional[datetime.date] = None,
+    ) -> int:
+        # download and store the snapshots missing for the given days
+        today = today or datetime.date.today()
+        stored = 0
+        for n in days_ago:
+            day = today - datetime.timedelta(days=n)
+            if self.has(day):
+                continue
+            data = fetch(n or None)
+            if len(data) == 0:
+                continue
+            self.store(day, data)
+            stored += 1
+        return stored
@@ -0,0 +1,141 @@
+import sqlite3
+import time
+
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .logger import LoggerMixin
+
+
+DEFAULT_RENOTIFY_INTERVAL = 7 * 24 * 3600
+
+# an alert is identified by its country and rule (days ago, threshold)
+AlertKey = Tuple[int, int, float]
+
+
+class AlertState(NamedTuple):
+    fired_at: float
+    p_food_security: float
+    p_food_security_days_ago: float
+    p_food_security_variation: float
+
+
+def alert_key(notification: dict) -> AlertKey:
+    return (
+        notification['country_id'],
+        notification['days_ago'],
+        float(notification['threshold']),
+    )
+
+
+class AlertStateService(LoggerMixin):
+
+    # last notification sent for each country and rule, used to suppress the
+    # alerts already notified: an alert is notified again after renotify_interval
+    # seconds, or at once if it escalates (its variation increases); with
+    # escalation_only, only escalations are notified again; alerts which do
+    # not fire anymore are forgotten, and notified again when they come back
+
+    _db: Optional[sqlite3.Connection]
+    _renotify_interval: float
+    _escalation_only: bool
+
+    def __init__(self, config: Optional[dict] = None):
+        super(AlertStateService, self).__init__()
+        suppression = ((config or {}).get('global') or {}).get('suppression') or {}
+        self._db = None
+        self._renotify_interval = float(
+            suppression.get('renotify_interval', DEFAULT_RENOTIFY_INTERVAL)
+        )
+        self._escalation_only = bool(suppression.get('escalation_only', False))
+
+    def connect(self, db_state: str) -> sqlite3.Connection:
+        db = sqlite3.connect(db_state)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS alert_state (country_id INTEGER, "
+            "days_ago INTEGER, threshold REAL, fired_at REAL, p_food_security REAL, "
+            "p_food_security_days_ago REAL, p_food_security_variation REAL, "
+            "PRIMARY KEY (country_id, days_ago, threshold));"
+        )
+        db.commit()
+        self._db = db
+        return db
+
+    def close(self):
+        self._db.close()
+        self._db = None
+
+    def get(self, keys: Iterable[AlertKey]) -> Dict[AlertKey, AlertState]:
+        assert self._db is not None
+        result = {}
+        for key in keys:
+            c = self._db.execute(
+                "SELECT fired_at, p_food_security, p_food_security_days_ago, "
+                "p_food_security_variation FROM alert_state "
+                "WHERE country_id = ? AND days_ago = ? AND threshold = ?;",
+                key,
+            )
+            row = c.fetchone()
+            if row is not None:
+                result[key] = AlertState(*row)
+        return result
+
+    def suppression_reason(
+        self, notification: dict, state: Optional[AlertState], now: float
+    ) -> Optional[str]:
+        # None if the notification must be sent, else why it is suppressed
+        if state is None:
+            return None
+        if notification['p_food_security_variation'] > state.p_food_security_variation:
+            return None
+        if self._escalation_only:
+            return "no escalation since %s" % time.ctime(state.fired_at)
+        if now - state.fired_at >= self._renotify_interval:
+            return None
+        return "already notified on %s" % time.ctime(state.fired_at)
+
+    def filter(
+        self, notifications: List[dict], now: Optional[float] = None
+    ) -> Tuple[List[dict], List[Tuple[dict, str]]]:
+        # split the notifications in the ones to send, and the suppressed ones
+        # with the reason why
+        now = time.time() if now is None else now
+        states = self.get(alert_key(notification) for notification in notifications)
+        send, suppressed = [], []
+        for notification in notifications:
+            reason = self.suppression_reason(
+                notification, states.get(alert_key(notification)), now
+            )
+            if reason is None:
+                send.append(notification)
+            else:
+                suppressed.append((notification, reason))
+        return send, suppressed
+
+    def record(self, notifications: Iterable[dict], now: Optional[float] = None):
+        assert self._db is not None
+        now = time.time() if now is None else now
+        self._db.executemany(
+            "INSERT OR REPLACE INTO alert_state (country_id, days_ago, threshold, "
+            "fired_at, p_food_security, p_food_security_days_ago, "
+            "p_food_security_variation) VALUES (?, ?, ?, ?, ?, ?, ?);",
+            (
+                alert_key(notification)
+                + (
+                    now,
+                    notification['p_food_security'],
+                    notification['p_food_security_days_ago'],
+                    notification['p_food_security_variation'],
+                )
+                for notification in notifications
+            ),
+        )
+        self._db.commit()
+
+    def clear(self, keys: Iterable[AlertKey]):
+        assert self._db is not None
+        self._db.executemany(
+            "DELETE FROM alert_state "
+            "WHERE country_id = ? AND days_ago = ? AND threshold = ?;",
+            keys,
+        )
+        self._db.commit()
@@ -0,0 +1,111 @@
+import email
+import socketserver
+import threading
+
+from typing import List, Optional
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+
+    # minimal SMTP dialogue: enough for smtplib to deliver messages, with hooks
+    # to simulate dropped connections and transient failures
+
+    server: 'SMTPServer'
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost SMTP stand-in')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii').strip().split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 8BITMIME')
+            elif command == 'RCPT' and self.server.refuses(line.decode('ascii')):
+                self.reply('550 no such user')
+            elif command in ('HELO', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'MAIL':
+                if self.server.should_drop():
+                    # close the connection without a reply
+                    return
+                if self.server.should_fail():
+                    self.reply('451 try again later')
+                    continue
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b'.\r\n':
+                        break
+                    data.append(line[1:] if line.startswith(b'..') else line)
+                self.server.add_message(b''.join(data))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 command not implemented')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        super(SMTPServer, self).__init__((host, port), SMTPHandler)
+        self.lock = threading.Lock()
+        self.messages: List[email.message.Message] = []
+        self.connections = 0
+        # number of MAIL commands to answer by dropping the connection or with
+        # a transient error, before behaving again
+        self.drop = 0
+        self.fail = 0
+        # recipients refused with a permanent error, and RCPT commands seen
+        self.refused: List[str] = []
+        self.recipients = 0
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def should_drop(self) -> bool:
+        with self.lock:
+            if self.drop > 0:
+                self.drop -= 1
+                return True
+            return False
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            if self.fail > 0:
+                self.fail -= 1
+                return True
+            return False
+
+    def refuses(self, line: str) -> bool:
+        with self.lock:
+            self.recipients += 1
+            return any('<%s>' % address in line for address in self.refused)
+
+    def add_message(self, data: bytes):
+        with self.lock:
+            self.messages.append(email.message_from_bytes(data))
+
+    def start(self) -> 'SMTPServer':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,67 @@
+import pytest
+
+from wfp_food_security_alerts import aggregation
+from wfp_food_security_alerts.aggregation import CountryAggregator
+from wfp_food_security_alerts.regions import RegionArray
+
+
+BACKENDS = [
+    False,
+    pytest.param(
+        True,
+        marks=pytest.mark.skipif(
+            aggregation.numpy is None, reason="numpy is not installed"
+        ),
+    ),
+]
+
+
+@pytest.mark.parametrize("use_numpy", BACKENDS)
+def test_aggregate(use_numpy):
+    regions_by_country = [(1, 2), (), (3, 4), (5,), (2, 100000)]
+    food_security = RegionArray([(1, 10), (2, 20), (3, 30), (4, 40), (5, 50)])
+    food_security_days_ago = {1: 5, 2: 15, 3: 25, 5: 45}
+    population = {1: 100, 2: 200, 3: 300, 4: 400, 5: 500}
+    aggregator = CountryAggregator(regions_by_country, use_numpy=use_numpy)
+    assert len(aggregator) == 5
+    totals = aggregator.aggregate([food_security, food_security_days_ago, population])
+    assert totals == [
+        (30, 20, 300),
+        (0, 0, 0),
+        # region 4 has no data 30 days ago
+        None,
+        (50, 45, 500),
+        # region 100000 does not exist
+        None,
+    ]
+    assert all(type(x) is int for x in totals[0])
+    assert aggregator.totals([food_security_days_ago, population]) == [
+        [20, 0, None, 45, None],
+        [300, 0, 700, 500, None],
+    ]
+
+
+@pytest.mark.parametrize("use_numpy", BACKENDS)
+def test_aggregate_no_countries(use_numpy):
+    aggregator = CountryAggregator([], use_numpy=use_numpy)
+    assert aggregator.aggregate([{1: 1}]) == []
+
+
+@pytest.mark.parametrize("use_numpy", BACKENDS)
+def test_aggregate_sparse_regions(use_numpy):
+    regions_by_country = [(1, 10 ** 12), (10 ** 12 + 1,)]
+    food_security = RegionArray([(1, 10), (10 ** 12, 20)])
+    aggregator = CountryAggregator(regions_by_country, use_numpy=use_numpy)
+    assert aggregator.totals([food_security]) == [[30, None]]
+
+
+@pytest.mark.parametrize("use_numpy", BACKENDS)
+def test_aggregate_large_region_ids(use_numpy):
+    # the memory does not depend on the largest region id, also for dicts
+    aggregator = CountryAggregator([(1, 2 ** 33), (2,)], use_numpy=use_numpy)
+    food_security = RegionArray([(1, 10), (2 ** 33, 20)])
+    population = {1: 100, 2 ** 33: 200, -1: 300}
+    assert aggregator.totals([food_security, population]) == [
+        [30, None],
+        [300, None],
+    ]
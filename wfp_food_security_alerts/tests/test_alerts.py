@@ -1,9 +1,20 @@
-from wfp_food_security_alerts.alerts import AlertService
+import datetime
+import json
+import os
+
+from wfp_food_security_alerts.alerts import AlertService, Rule
 from wfp_food_security_alerts.api import APIService
+from wfp_food_security_alerts.delivery import DeliveryResult
+from wfp_food_security_alerts.metrics import Metrics, MetricsMixin
 from wfp_food_security_alerts.population import PopulationService
+from wfp_food_security_alerts.report import open_report
+from wfp_food_security_alerts.snapshots import SnapshotService
+from wfp_food_security_alerts.state import AlertStateService
+from wfp_food_security_alerts.tests.smtpserver import SMTPServer
+from wfp_food_security_alerts.topology import with_all_countries
 
 
-class MockedAPIService:
+class MockedAPIService(MetricsMixin):
     def __init__(
         self, foodsecurity_data: dict, foodsecurity_data_days_ago: dict, regions: dict
     ):
@@ -21,14 +32,26 @@ class MockedAPIService:
     def get_regions_by_country_id(self, country_id: int):
         return self._regions
 
+    def get_regions_by_country_ids(self, country_ids: list):
+        return [self.get_regions_by_country_id(x) for x in country_ids]
+
+    def iter_regions_by_country_ids(self, country_ids: list):
+        for country_id in country_ids:
+            yield self.get_regions_by_country_id(country_id)
+
 
-class MockedPopulationService:
+class MockedPopulationService(MetricsMixin):
     def __init__(self, population: dict):
         self._population = population
 
     def get_population_by_region_id(self, region_id: int):
         return self._population[region_id]
 
+    def get_populations(self, region_ids):
+        return dict(
+            (x, self._population[x]) for x in region_ids if x in self._population
+        )
+
 
 def test_evaluate_alert_condition_true(tmpdir):
     c = {}
@@ -90,3 +113,521 @@ def test_run_notification_not_triggered():
     svc = AlertService(c, a, p)
     notifications = svc.run(dry_run=True)
     assert notifications == []
+
+
+def test_send_notifications():
+    server = SMTPServer().start()
+    try:
+        c = {
+            "global": {
+                "emails": ["admin@example.org"],
+                "smtp": {
+                    "sender": "sender@example.org",
+                    "host": "127.0.0.1",
+                    "port": server.port,
+                },
+            },
+        }
+        svc = AlertService(c, APIService(c), PopulationService())
+        notification = {
+            'country_id': 1,
+            'days_ago': 30,
+            'food_security': 100,
+            'food_security_days_ago': 90,
+            'food_security_variation': 10,
+            'p_food_security': 100.0,
+            'p_food_security_days_ago': 90.0,
+            'p_food_security_variation': 10.0,
+            'population_country': 100,
+            'recipients': 'email@example.org',
+            'threshold': 10.0,
+        }
+        results = svc.send_notifications([notification])
+        assert [(r.notification, r.sent) for r in results] == [(notification, True)]
+        assert len(server.messages) == 1
+        msg = server.messages[0]
+        assert msg['To'] == 'email@example.org'
+        assert msg['Cc'] == 'admin@example.org'
+    finally:
+        server.stop()
+
+
+def test_send_digests():
+    server = SMTPServer().start()
+    try:
+        c = {
+            "global": {
+                "emails": ["admin@example.org"],
+                "digest": True,
+                "smtp": {
+                    "sender": "sender@example.org",
+                    "host": "127.0.0.1",
+                    "port": server.port,
+                },
+            },
+        }
+        svc = AlertService(c, APIService(c), PopulationService())
+        notifications = [
+            {
+                'country_id': country_id,
+                'days_ago': 30,
+                'food_security': 100,
+                'food_security_days_ago': 90,
+                'food_security_variation': 10,
+                'p_food_security': 100.0,
+                'p_food_security_days_ago': 90.0,
+                'p_food_security_variation': 10.0,
+                'population_country': 100,
+                'recipients': recipients,
+                'threshold': 10.0,
+            }
+            for country_id, recipients in (
+                (1, 'email1@example.org'),
+                (2, 'email1@example.org, email2@example.org'),
+            )
+        ]
+        results = svc.send_notifications(notifications)
+        assert [r.sent for r in results] == [True, True]
+        # one message per recipient, instead of one per notification
+        messages = dict((msg['To'], msg) for msg in server.messages)
+        assert sorted(messages) == [
+            'admin@example.org',
+            'email1@example.org',
+            'email2@example.org',
+        ]
+        assert messages['admin@example.org']['Cc'] is None
+        assert messages['email2@example.org']['Subject'] == (
+            "Food security decreases significantly in 1 country"
+        )
+        assert messages['admin@example.org']['Subject'].endswith("in 2 countries")
+    finally:
+        server.stop()
+
+
+def test_send_digests_admin_refused():
+    server = SMTPServer().start()
+    server.refused = ['admin@example.org']
+    try:
+        c = {
+            "global": {
+                "emails": ["admin@example.org"],
+                "digest": True,
+                "smtp": {
+                    "sender": "sender@example.org",
+                    "host": "127.0.0.1",
+                    "port": server.port,
+                },
+            },
+        }
+        svc = AlertService(c, APIService(c), PopulationService())
+        notifications = [
+            {
+                'country_id': country_id,
+                'days_ago': 30,
+                'food_security': 100,
+                'food_security_days_ago': 90,
+                'food_security_variation': 10,
+                'p_food_security': 100.0,
+                'p_food_security_days_ago': 90.0,
+                'p_food_security_variation': 10.0,
+                'population_country': 100,
+                'recipients': recipients,
+                'threshold': 10.0,
+            }
+            for country_id, recipients in ((1, 'email1@example.org'), (2, ''))
+        ]
+        # the notifications of the countries are sent even if the digest of
+        # the admins is not, except for the countries without recipients
+        results = svc.send_notifications(notifications)
+        assert [r.sent for r in results] == [True, False]
+        assert [msg['To'] for msg in server.messages] == ['email1@example.org']
+    finally:
+        server.stop()
+
+
+def test_run_notification_outbox():
+    c = {
+        "countries": [{"id": 1, "emails": ["email@example.org"]}],
+        "global": {"threshold": 10.0, "days_ago": 30, "emails": ["admin@example.org"]},
+    }
+    a = MockedAPIService(
+        foodsecurity_data={100: 100},
+        foodsecurity_data_days_ago={100: 90},
+        regions=[100],
+    )
+    p = MockedPopulationService(population={100: 100})
+
+    class MockedOutboxService:
+        notifications: list = []
+
+        def enqueue(self, notifications):
+            self.notifications.extend(notifications)
+
+    outbox = MockedOutboxService()
+    svc = AlertService(c, a, p)
+    svc.set_outbox(outbox)
+    notifications = svc.run()
+    assert len(notifications) == 1
+    assert outbox.notifications == notifications
+
+
+def test_get_foodsecurity_data_snapshots(tmpdir):
+    today = datetime.date(2020, 4, 8)
+    c = {"global": {"days_ago": 30}}
+    a = MockedAPIService(
+        foodsecurity_data={100: 100}, foodsecurity_data_days_ago={100: 90}, regions=[]
+    )
+    snapshots = SnapshotService()
+    snapshots.connect(os.path.join(tmpdir, 'snapshots.sqlite3'))
+    try:
+        svc = AlertService(c, a, MockedPopulationService({}))
+        svc.set_snapshots(snapshots)
+        # the snapshot is missing: fall back to the API, and store it
+        assert svc.get_foodsecurity_data(days_ago=30, today=today) == {100: 90}
+        assert svc.get_foodsecurity_data(today=today) == {100: 100}
+        assert snapshots.days() == [datetime.date(2020, 3, 9), today]
+        # the snapshot is available: no API call
+        a._foodsecurity_data_days_ago = {}
+        assert svc.get_foodsecurity_data(days_ago=30, today=today) == {100: 90}
+    finally:
+        snapshots.close()
+
+
+def test_run_rules():
+    c = {
+        "countries": [
+            {"id": 1, "emails": ["email1@example.org"]},
+            {
+                "id": 2,
+                "emails": ["email2@example.org"],
+                "rules": [{"days_ago": 90, "threshold": 1.0}],
+            },
+        ],
+        "global": {
+            "threshold": 10.0,
+            "days_ago": 30,
+            "rules": [
+                {"days_ago": 7, "threshold": 5.0},
+                {"days_ago": 30, "threshold": 10.0},
+            ],
+            "emails": ["admin@example.org"],
+        },
+    }
+    requested = []
+
+    class MockedWindowsAPIService(MockedAPIService):
+        def get_foodsecurity_data(self, days_ago: int = None):
+            requested.append(days_ago)
+            return {None: {100: 100}, 7: {100: 98}, 30: {100: 90}, 90: {}}[days_ago]
+
+    a = MockedWindowsAPIService({}, {}, regions=[100])
+    p = MockedPopulationService(population={100: 100})
+    svc = AlertService(c, a, p)
+    assert svc.get_rules(c['countries'][1]) == [Rule(90, 1.0)]
+    notifications = svc.run(dry_run=True)
+    # each window is fetched once
+    assert requested == [None, 7, 30, 90]
+    # only the 30 days rule fires for country 1; no data for country 2
+    assert [(x['country_id'], x['days_ago']) for x in notifications] == [(1, 30)]
+    assert notifications[0]['threshold'] == 10.0
+    assert notifications[0]['food_security_days_ago'] == 90
+
+
+def test_run_metrics():
+    c = {
+        "countries": [
+            {"id": 1, "emails": ["email@example.org"]},
+            {"id": 2, "emails": ["email@example.org"], "rules": []},
+        ],
+        "global": {"threshold": 10.0, "days_ago": 30, "emails": ["admin@example.org"]},
+    }
+    a = MockedAPIService(
+        foodsecurity_data={100: 100},
+        foodsecurity_data_days_ago={100: 90},
+        regions=[100],
+    )
+    p = MockedPopulationService(population={100: 100})
+    m = Metrics()
+    svc = AlertService(c, a, p)
+    svc.set_metrics(m)
+    svc.run(dry_run=True)
+    assert m.counter('wfp_countries_evaluated_total') == 2
+    assert m.counter('wfp_countries_skipped_total') == 0
+    assert m.counter('wfp_alerts_fired_total') == 2
+    for stage in ('fetch_foodsecurity', 'fetch_regions', 'aggregation', 'evaluation'):
+        assert m.histogram('wfp_stage_duration_seconds', stage=stage).count >= 1
+    # nothing is delivered in dry-run mode
+    assert m.histogram('wfp_stage_duration_seconds', stage='delivery') is None
+
+
+def test_run_prefetched_foodsecurity_data():
+    c = {
+        "countries": [{"id": 1, "emails": ["email@example.org"]}],
+        "global": {"threshold": 10.0, "days_ago": 30, "emails": ["admin@example.org"]},
+    }
+    requested = []
+
+    class MockedCountingAPIService(MockedAPIService):
+        def get_foodsecurity_data(self, days_ago: int = None):
+            requested.append(days_ago)
+            return super().get_foodsecurity_data(days_ago)
+
+    a = MockedCountingAPIService({100: 100}, {100: 90}, regions=[100])
+    p = MockedPopulationService(population={100: 100})
+    data = AlertService(c, a, p).prefetch_foodsecurity_data()
+    assert requested == [None, 30]
+    svc = AlertService(c, a, p)
+    svc.set_foodsecurity_data(data)
+    assert len(svc.run(dry_run=True)) == 1
+    assert requested == [None, 30]
+
+
+def test_run_suppression(tmpdir):
+    c = {
+        "countries": [{"id": 1, "emails": ["email@example.org"]}],
+        "global": {
+            "threshold": 10.0,
+            "days_ago": 30,
+            "emails": ["admin@example.org"],
+            "suppression": {"renotify_interval": 3600},
+            "smtp": {"sender": "sender@example.org"},
+        },
+    }
+    a = MockedAPIService({100: 100}, {100: 90}, regions=[100])
+    p = MockedPopulationService(population={100: 100})
+    delivered = []
+
+    class MockedDeliveryService(MetricsMixin):
+        def send(self, messages):
+            results = [DeliveryResult(x, True, 1) for x, _ in messages]
+            delivered.extend(r.notification for r in results)
+            return results
+
+    state = AlertStateService(c)
+    state.connect(os.path.join(tmpdir, 'population.state.sqlite3'))
+    try:
+        svc = AlertService(c, a, p, MockedDeliveryService())
+        svc.set_state(state)
+        # dry runs do not record anything
+        assert len(svc.run(dry_run=True)) == 1
+        assert len(svc.run(dry_run=False)) == 1
+        assert len(delivered) == 1
+        # the same alert is suppressed by the next runs, dry or not
+        assert svc.run(dry_run=True) == []
+        assert svc.run(dry_run=False) == []
+        assert len(delivered) == 1
+        # until it is resolved, and fires again
+        a._foodsecurity_data = {100: 90}
+        assert svc.run(dry_run=False) == []
+        a._foodsecurity_data = {100: 100}
+        assert len(svc.run(dry_run=False)) == 1
+        assert len(delivered) == 2
+    finally:
+        state.close()
+
+
+def test_stream():
+    c = {
+        "countries": [
+            {"id": x, "emails": ["email%d@example.org" % x]} for x in range(1, 4)
+        ],
+        "global": {
+            "threshold": 10.0,
+            "days_ago": 30,
+            "emails": ["admin@example.org"],
+            "pipeline": {"batch_size": 1},
+        },
+    }
+    fetched = []
+
+    class MockedStreamingAPIService(MockedAPIService):
+        def get_regions_by_country_id(self, country_id: int):
+            fetched.append(country_id)
+            return self._regions
+
+    a = MockedStreamingAPIService({100: 100}, {100: 90}, regions=[100])
+    p = MockedPopulationService(population={100: 100})
+    stream = AlertService(c, a, p).stream(dry_run=True)
+    # the first country is evaluated before the regions of the others arrive
+    assert next(stream)['country_id'] == 1
+    assert fetched == [1]
+    assert [x['country_id'] for x in stream] == [2, 3]
+    assert fetched == [1, 2, 3]
+
+
+def test_stream_delivery():
+    server = SMTPServer().start()
+    try:
+        c = {
+            "countries": [
+                {"id": x, "emails": ["email%d@example.org" % x]} for x in range(1, 4)
+            ],
+            "global": {
+                "threshold": 10.0,
+                "days_ago": 30,
+                "emails": ["admin@example.org"],
+                "pipeline": {"batch_size": 2, "queue_size": 1},
+                "smtp": {
+                    "sender": "sender@example.org",
+                    "host": "127.0.0.1",
+                    "port": server.port,
+                },
+            },
+        }
+        a = MockedAPIService({100: 100}, {100: 90}, regions=[100])
+        p = MockedPopulationService(population={100: 100})
+        notifications = AlertService(c, a, p).run()
+        assert [x['country_id'] for x in notifications] == [1, 2, 3]
+        assert sorted(msg['To'] for msg in server.messages) == [
+            'email1@example.org',
+            'email2@example.org',
+            'email3@example.org',
+        ]
+    finally:
+        server.stop()
+
+
+def test_run_all_countries():
+    c = with_all_countries(
+        {
+            "countries": [{"id": 2, "emails": ["email2@example.org"]}],
+            "global": {
+                "threshold": 10.0,
+                "days_ago": 30,
+                "emails": ["admin@example.org"],
+                "all_countries": True,
+                "smtp": {"sender": "sender@example.org"},
+            },
+        },
+        {1: (100,), 2: (200, 201), 3: (300,)},
+    )
+    assert [country['id'] for country in c['countries']] == [2, 1, 3]
+
+    class MockedIndexAPIService(MockedAPIService):
+        def iter_regions_by_country_ids(self, country_ids: list):
+            raise AssertionError('the regions are read from the index')
+
+        def get_region_index(self):
+            return {1: (100,), 2: (200, 201), 3: (300,)}
+
+    a = MockedIndexAPIService(
+        {100: 100, 200: 50, 201: 50, 300: 10},
+        {100: 90, 200: 40, 201: 40, 300: 10},
+        regions=None,
+    )
+    p = MockedPopulationService({100: 100, 200: 100, 201: 100, 300: 100})
+    svc = AlertService(c, a, p)
+    notifications = svc.run(dry_run=True)
+    assert [(x['country_id'], x['recipients']) for x in notifications] == [
+        (2, 'email2@example.org'),
+        (1, ''),
+    ]
+    # the countries which are not configured are notified to the admins only
+    msg = svc.build_message(notifications[1])
+    assert msg['To'] == 'admin@example.org'
+    assert msg['Cc'] is None
+
+
+def test_run_all_countries_missing_from_index():
+    c = {
+        "countries": [{"id": 2, "emails": ["email2@example.org"]}],
+        "global": {
+            "threshold": 10.0,
+            "days_ago": 30,
+            "emails": ["admin@example.org"],
+            "all_countries": True,
+        },
+    }
+
+    class MockedIndexAPIService(MockedAPIService):
+        def get_region_index(self):
+            return {}
+
+    a = MockedIndexAPIService({200: 100}, {200: 90}, regions=(200,))
+    p = MockedPopulationService({200: 100})
+    svc = AlertService(c, a, p)
+    metrics = Metrics()
+    svc.set_metrics(metrics)
+    # the configured country is not in the index yet: its regions are fetched
+    notifications = svc.run(dry_run=True)
+    assert [x['country_id'] for x in notifications] == [2]
+    assert metrics.counter('wfp_countries_skipped_total') == 0
+
+
+def test_run_report(tmpdir):
+    c = {
+        "countries": [
+            {"id": x, "emails": ["email%d@example.org" % x]} for x in range(1, 5)
+        ],
+        "global": {
+            "rules": [
+                {"days_ago": 7, "threshold": 5.0},
+                {"days_ago": 30, "threshold": 50.0},
+            ],
+            "emails": ["admin@example.org"],
+        },
+    }
+
+    class MockedRegionsAPIService(MockedAPIService):
+        def get_regions_by_country_id(self, country_id: int):
+            return {1: (100,), 2: (200,), 3: (), 4: (400,)}[country_id]
+
+        def get_foodsecurity_data(self, days_ago: int = None):
+            if days_ago == 30:
+                return {100: 80}
+            return super(MockedRegionsAPIService, self).get_foodsecurity_data(days_ago)
+
+    a = MockedRegionsAPIService(
+        {100: 100, 200: 100, 400: 10}, {100: 90, 200: 100, 400: 10}, regions=None
+    )
+    p = MockedPopulationService(population={100: 100, 400: 100})
+    path = os.path.join(tmpdir, 'report.jsonl')
+    report = open_report(path)
+    svc = AlertService(c, a, p)
+    svc.set_report(report)
+    notifications = svc.run(dry_run=True)
+    report.close()
+    with open(path) as f:
+        rows = [json.loads(line) for line in f]
+    assert [(x['country_id'], x['days_ago']) for x in notifications] == [(1, 7)]
+    assert [
+        (row['country_id'], row['days_ago'], row['skip_reason'], row['alert'])
+        for row in rows
+    ] == [
+        (1, 7, None, True),
+        (1, 30, None, False),
+        (2, 7, 'missing_population', False),
+        (2, 30, 'missing_population', False),
+        (3, 7, 'missing_regions', False),
+        (3, 30, 'missing_regions', False),
+        (4, 7, None, False),
+        (4, 30, 'missing_data_days_ago', False),
+    ]
+    assert rows[0]['p_food_security_variation'] == 10.0
+    assert rows[1]['p_food_security_days_ago'] == 80.0
+
+
+def test_run_report_suppressed(tmpdir):
+    c = {
+        "countries": [{"id": 1, "emails": ["email@example.org"]}],
+        "global": {"threshold": 10.0, "days_ago": 30, "emails": ["admin@example.org"]},
+    }
+    a = MockedAPIService({100: 100}, {100: 90}, regions=[100])
+    p = MockedPopulationService(population={100: 100})
+    path = os.path.join(tmpdir, 'report.jsonl')
+    state = AlertStateService(c)
+    state.connect(os.path.join(tmpdir, 'population.state.sqlite3'))
+    try:
+        svc = AlertService(c, a, p)
+        svc.set_state(state)
+        state.record(svc.run(dry_run=True))
+        report = open_report(path)
+        svc.set_report(report)
+        # the alert fires again, and is left out by the suppression
+        assert svc.run(dry_run=True) == []
+        report.close()
+    finally:
+        state.close()
+    with open(path) as f:
+        rows = [json.loads(line) for line in f]
+    assert [(row['alert'], row['suppressed']) for row in rows] == [(True, True)]
@@ -1,4 +1,10 @@
+import json
+import os
+import pytest
+import requests
+
 from wfp_food_security_alerts.api import APIService
+from wfp_food_security_alerts.topology import TopologyService
 
 
 API_FOOD_SECURITY = "https://api.hungermapdata.org/swe-notifications/foodsecurity"
@@ -45,3 +51,204 @@ def test_api_get_regions_by_country_id_not_found():
     result = a.get_regions_by_country_id(0)
     assert result is not None
     assert len(result) == 0
+
+
+class MockedStreamingResponse:
+    status_code = 200
+    encoding = None
+
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size: int = 1):
+        # split the content in small chunks, also in the middle of characters
+        for i in range(0, len(self.content), 3):
+            yield self.content[i : i + 3]
+
+    def close(self):
+        pass
+
+
+def test_api_get_foodsecurity_data_streaming(monkeypatch):
+    data = [
+        {"region_id": 1, "food_insecure_people": 100, "name": "Región"},
+        {"region_id": 5, "food_insecure_people": 500},
+    ]
+    content = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    monkeypatch.setattr(
+        requests.Session, 'get', lambda *a, **kw: MockedStreamingResponse(content)
+    )
+    c = {"global": {"api": {"foodsecurity": API_FOOD_SECURITY}}}
+    a = APIService(c)
+    result = a.get_foodsecurity_data(days_ago=30)
+    assert result == {1: 100, 5: 500}
+    assert result.get(2) is None
+
+
+def test_api_get_foodsecurity_data_invalid_items(monkeypatch):
+    data = [
+        {"region_id": 1, "food_insecure_people": 100},
+        {"region_id": -2, "food_insecure_people": 200},
+        {"region_id": 3, "food_insecure_people": None},
+        {"region_id": 4, "food_insecure_people": -400},
+        {"region_id": 5},
+        [6, 600],
+        "7",
+        {"region_id": 8, "food_insecure_people": 800},
+    ]
+    content = json.dumps(data).encode('utf-8')
+    monkeypatch.setattr(
+        requests.Session, 'get', lambda *a, **kw: MockedStreamingResponse(content)
+    )
+    c = {"global": {"api": {"foodsecurity": API_FOOD_SECURITY}}}
+    a = APIService(c)
+    # the invalid items are skipped, and the invalid documents are ignored
+    assert a.get_foodsecurity_data() == {1: 100, 8: 800}
+    content = content[:-10]
+    assert a.get_foodsecurity_data() == {}
+
+
+class MockedResponse:
+    def __init__(self, url: str, headers: dict = None):
+        self.url = url
+        self.country_id = int(url.split('/')[-2])
+        self.headers = {'ETag': '"%d"' % self.country_id}
+        if self.country_id == 0:
+            self.status_code = 404
+        elif (headers or {}).get('If-None-Match') == self.headers['ETag']:
+            self.status_code = 304
+        else:
+            self.status_code = 200
+
+    def raise_for_status(self):
+        if self.country_id == 0:
+            raise requests.exceptions.HTTPError('404 Client Error: %s' % self.url)
+
+    @property
+    def content(self):
+        regions = [{"region_id": self.country_id * 10 + n} for n in range(2)]
+        return json.dumps({"regions": regions}).encode()
+
+
+def mocked_get(session, url, headers: dict = None, **kw):
+    requested_urls.append(url)
+    return MockedResponse(url, headers)
+
+
+requested_urls: list = []
+
+
+def test_api_get_regions_by_country_ids(monkeypatch):
+    monkeypatch.setattr(requests.Session, 'get', mocked_get)
+    c = {"global": {"api": {"country_regions": API_COUNTRY_REGIONS}}}
+    a = APIService(c)
+    result = a.get_regions_by_country_ids([3, 0, 1, 2])
+    assert result == [(30, 31), (), (10, 11), (20, 21)]
+
+
+def test_api_get_regions_by_country_ids_max_concurrency(monkeypatch):
+    monkeypatch.setattr(requests.Session, 'get', mocked_get)
+    c = {
+        "global": {
+            "api": {"country_regions": API_COUNTRY_REGIONS, "max_concurrency": 1}
+        }
+    }
+    a = APIService(c)
+    assert a.max_concurrency == 1
+    assert a.get_regions_by_country_ids(range(1, 4)) == [
+        (10, 11),
+        (20, 21),
+        (30, 31),
+    ]
+    assert a.get_regions_by_country_ids([]) == []
+
+
+def test_api_get_regions_by_country_id_connection_error(monkeypatch):
+    def get(session, url, **kw):
+        raise requests.exceptions.ConnectionError('connection reset by peer')
+
+    monkeypatch.setattr(requests.Session, 'get', get)
+    c = {"global": {"api": {"country_regions": API_COUNTRY_REGIONS, "retries": 0}}}
+    a = APIService(c)
+    assert a.get_regions_by_country_id(4) == tuple()
+
+
+def test_api_get_regions_by_country_ids_topology_cache(monkeypatch, tmpdir):
+    monkeypatch.setattr(requests.Session, 'get', mocked_get)
+    c = {"global": {"api": {"country_regions": API_COUNTRY_REGIONS}}}
+    a = APIService(c)
+    topology = TopologyService(ttl=3600)
+    topology.connect(os.path.join(tmpdir, 'topology.sqlite3'))
+    a.set_topology(topology)
+    try:
+        del requested_urls[:]
+        assert a.get_regions_by_country_ids([1, 2, 0]) == [(10, 11), (20, 21), ()]
+        assert len(requested_urls) == 3
+        entry = topology.get(1)
+        assert entry.regions == (10, 11)
+        assert entry.etag == '"1"'
+        # warm run: fresh entries are not requested again
+        del requested_urls[:]
+        assert a.get_regions_by_country_ids([1, 2]) == [(10, 11), (20, 21)]
+        assert requested_urls == []
+        # refresh: entries are revalidated with conditional requests
+        assert a.get_regions_by_country_ids([1, 2], refresh=True) == [
+            (10, 11),
+            (20, 21),
+        ]
+        assert len(requested_urls) == 2
+        assert topology.get(2).fetched_at >= entry.fetched_at
+    finally:
+        topology.close()
+
+
+API_REGION_COUNTRY = "https://api.hungermapdata.org/swe-notifications/region/%s/country"
+
+
+class MockedRegionResponse:
+    def __init__(self, url: str):
+        self.region_id = int(url.split('/')[-2])
+        self.status_code = 404 if self.region_id == 0 else 200
+
+    def raise_for_status(self):
+        pass
+
+    @property
+    def content(self):
+        # the country is given at the top level, or nested
+        country_id = self.region_id // 10
+        if country_id == 9:
+            return json.dumps({"country": {"id": country_id}}).encode()
+        return json.dumps({"country_id": country_id}).encode()
+
+
+def test_api_build_region_index(monkeypatch, tmpdir):
+    def get(session, url, **kw):
+        requested_urls.append(url)
+        return MockedRegionResponse(url)
+
+    monkeypatch.setattr(requests.Session, 'get', get)
+    c = {"global": {"api": {"region_country": API_REGION_COUNTRY}}}
+    a = APIService(c)
+    # the index is stored in the topology cache
+    with pytest.raises(ValueError):
+        a.build_region_index([10])
+    topology = TopologyService(ttl=3600)
+    topology.connect(os.path.join(tmpdir, 'topology.sqlite3'))
+    a.set_topology(topology)
+    try:
+        del requested_urls[:]
+        assert a.build_region_index([10, 11, 20, 0, 99]) == 5
+        assert len(requested_urls) == 5
+        assert a.get_region_index() == {1: (10, 11), 2: (20,), 9: (99,)}
+        # only the regions missing from the index are fetched
+        del requested_urls[:]
+        assert a.build_region_index([10, 11, 20, 0, 99, 21]) == 1
+        assert requested_urls == [API_REGION_COUNTRY % 21]
+        assert a.get_region_index()[2] == (20, 21)
+        assert a.build_region_index([10, 21], refresh=True) == 2
+    finally:
+        topology.close()
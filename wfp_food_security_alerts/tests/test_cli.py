@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+from typing import Set
+
+
+# modules which must not be loaded when the command line interface starts
+HEAVY_MODULES = ('requests', 'yaml', 'smtplib', 'email.mime', 'numpy')
+
+
+def imported_modules(code: str) -> Set[str]:
+    # run the code in a fresh interpreter, with -X importtime listing every
+    # module imported, one per line on stderr
+    r = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return set(
+        line.rsplit('|', 1)[1].strip()
+        for line in r.stderr.splitlines()
+        if line.startswith('import time:') and '|' in line
+    )
+
+
+def test_cli_import_does_not_load_heavy_modules():
+    modules = imported_modules('import wfp_food_security_alerts.cli')
+    assert 'wfp_food_security_alerts.cli' in modules
+    for name in HEAVY_MODULES:
+        assert name not in modules
+
+
+def test_cli_help_does_not_load_heavy_modules():
+    modules = imported_modules(
+        'from wfp_food_security_alerts.cli import cli\n'
+        'cli(["--db-population=population.sqlite3", "--help"], standalone_mode=False)'
+    )
+    for name in HEAVY_MODULES:
+        assert name not in modules
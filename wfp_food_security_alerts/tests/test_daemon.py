@@ -0,0 +1,131 @@
+import datetime
+import json
+import os
+import pytest
+import threading
+import time
+import urllib.request
+
+from wfp_food_security_alerts.daemon import AlertDaemon, CronSchedule
+
+
+def test_cron_schedule_next_after():
+    schedule = CronSchedule('30 6 * * *')
+    dt = datetime.datetime(2020, 4, 8, 6, 30, 15)
+    assert schedule.matches(dt) is True
+    assert schedule.next_after(dt) == datetime.datetime(2020, 4, 9, 6, 30)
+    assert schedule.next_after(datetime.datetime(2020, 4, 8, 5, 0)) == (
+        datetime.datetime(2020, 4, 8, 6, 30)
+    )
+    schedule = CronSchedule('*/15 8-9 * * 1-5')
+    # 2020-04-10 is a friday
+    dt = datetime.datetime(2020, 4, 10, 9, 50)
+    assert schedule.next_after(dt) == datetime.datetime(2020, 4, 13, 8, 0)
+    schedule = CronSchedule('0 0 1 * 0')
+    # either the first day of the month or a sunday
+    dt = datetime.datetime(2020, 4, 1, 0, 0)
+    assert schedule.next_after(dt) == datetime.datetime(2020, 4, 5, 0, 0)
+
+
+def test_cron_schedule_step_from_value():
+    # a/n: every n from a to the maximum
+    schedule = CronSchedule('5/15 * * * *')
+    dt = datetime.datetime(2020, 4, 8, 6, 50)
+    minutes = [m for m in range(60) if schedule.matches(dt.replace(minute=m))]
+    assert minutes == [5, 20, 35, 50]
+    assert schedule.next_after(dt) == datetime.datetime(2020, 4, 8, 7, 5)
+
+
+@pytest.mark.parametrize(
+    'expression',
+    ['* * * *', '60 * * * *', '* * 0 * *', '5-1 * * * *', 'a * * * *', '60/5 * * * *'],
+)
+def test_cron_schedule_invalid(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+class MockedAlertService:
+    def __init__(self, config: dict):
+        self.config = config
+        self.runs = 0
+
+    def run(self, dry_run: bool = False):
+        self.runs += 1
+        return [{"country_id": 1}]
+
+
+def write_config(filename: str, schedule: str):
+    with open(filename, 'w') as f:
+        f.write('global:\n  serve:\n')
+        f.write('    schedule: "%s"\n    reload_interval: 0.05\n' % schedule)
+
+
+def test_daemon_reload(tmpdir):
+    filename = os.path.join(tmpdir, 'config.yaml')
+    write_config(filename, '0 6 * * *')
+    services = []
+
+    def factory(config):
+        services.append(MockedAlertService(config))
+        return services[-1]
+
+    daemon = AlertDaemon(filename, factory)
+    assert daemon.reload() is True
+    assert daemon.reload() is False
+    write_config(filename, '0 7 * * *')
+    os.utime(filename, ns=(0, time.time_ns() + 10 ** 9))
+    assert daemon.reload() is True
+    assert services[-1].config['global']['serve']['schedule'] == '0 7 * * *'
+    # an invalid configuration keeps the current one
+    write_config(filename, 'invalid')
+    os.utime(filename, ns=(0, time.time_ns() + 2 * 10 ** 9))
+    assert daemon.reload() is False
+    assert len(services) == 2
+    assert daemon.run_once() == [{"country_id": 1}]
+    assert services[-1].runs == 1
+
+
+def test_daemon_before_run(tmpdir):
+    filename = os.path.join(tmpdir, 'config.yaml')
+    write_config(filename, '0 6 * * *')
+    service = MockedAlertService({})
+    calls = []
+    daemon = AlertDaemon(
+        filename, lambda config: service, before_run=lambda: calls.append(service.runs)
+    )
+    daemon.reload()
+    daemon.run_once()
+    daemon.run_once()
+    assert calls == [0, 1]
+    assert service.runs == 2
+
+
+def test_daemon_http_trigger(tmpdir):
+    filename = os.path.join(tmpdir, 'config.yaml')
+    write_config(filename, '0 6 1 1 *')
+    service = MockedAlertService({})
+    daemon = AlertDaemon(filename, lambda config: service)
+    thread = threading.Thread(target=daemon.serve_forever, kwargs={'http_port': 0})
+    thread.start()
+    try:
+        for _ in range(100):
+            if daemon.http_port is not None:
+                break
+            time.sleep(0.01)
+        url = 'http://127.0.0.1:%d' % daemon.http_port
+        request = urllib.request.Request(url + '/run', method='POST')
+        with urllib.request.urlopen(request) as r:
+            assert r.status == 202
+        for _ in range(100):
+            if service.runs > 0:
+                break
+            time.sleep(0.01)
+        assert service.runs == 1
+        with urllib.request.urlopen(url + '/health') as r:
+            data = json.loads(r.read())
+        assert data['last_run']['notifications'] == 1
+    finally:
+        daemon.stop()
+        thread.join(5)
+    assert not thread.is_alive()
@@ -0,0 +1,112 @@
+import pytest
+
+from email.mime.text import MIMEText
+
+from wfp_food_security_alerts.delivery import DeliveryQueue, SMTPDeliveryService
+from wfp_food_security_alerts.tests.smtpserver import SMTPServer
+
+
+@pytest.fixture
+def smtp_server():
+    server = SMTPServer().start()
+    yield server
+    server.stop()
+
+
+def config(port: int, **kw) -> dict:
+    smtp = {"host": "127.0.0.1", "port": port, "backoff": 0, "pool_size": 3}
+    smtp.update(kw)
+    return {"global": {"smtp": smtp}}
+
+
+def messages(count: int) -> list:
+    result = []
+    for n in range(count):
+        msg = MIMEText('notification %d' % n)
+        msg['From'] = 'sender@example.org'
+        msg['To'] = 'country%d@example.org' % n
+        msg['Subject'] = 'notification %d' % n
+        result.append(({"country_id": n}, msg))
+    return result
+
+
+def test_send(smtp_server):
+    svc = SMTPDeliveryService(config(smtp_server.port, max_in_flight=2))
+    results = svc.send(messages(10))
+    assert [r.notification['country_id'] for r in results] == list(range(10))
+    assert all(r.sent and r.attempts == 1 for r in results)
+    subjects = sorted(m['Subject'] for m in smtp_server.messages)
+    assert subjects == sorted('notification %d' % n for n in range(10))
+    # connections are reused
+    assert smtp_server.connections <= 3
+
+
+def test_send_reconnect_on_dropped_connection(smtp_server):
+    smtp_server.drop = 2
+    svc = SMTPDeliveryService(config(smtp_server.port))
+    results = svc.send(messages(5))
+    assert all(r.sent for r in results)
+    assert sum(r.attempts for r in results) == 7
+    assert len(smtp_server.messages) == 5
+
+
+def test_send_retry_on_transient_error(smtp_server):
+    smtp_server.fail = 1
+    svc = SMTPDeliveryService(config(smtp_server.port, pool_size=1))
+    results = svc.send(messages(2))
+    assert [(r.sent, r.attempts) for r in results] == [(True, 2), (True, 1)]
+
+
+def test_send_give_up(smtp_server):
+    smtp_server.fail = 100
+    svc = SMTPDeliveryService(config(smtp_server.port, pool_size=1, retries=2))
+    results = svc.send(messages(1))
+    assert results[0].sent is False
+    assert results[0].attempts == 3
+    assert '451' in results[0].error
+
+
+def test_send_recipient_refused(smtp_server):
+    smtp_server.refused = ['country0@example.org']
+    svc = SMTPDeliveryService(config(smtp_server.port, pool_size=1, retries=2))
+    results = svc.send(messages(2))
+    assert [(r.sent, r.attempts) for r in results] == [(False, 1), (True, 1)]
+    assert 'country0@example.org' in results[0].error
+    # the permanent failure is not retried, and the connection is reused
+    assert smtp_server.recipients == 2
+    assert smtp_server.connections == 1
+
+
+def test_send_connection_refused():
+    server = SMTPServer()
+    port = server.port
+    server.server_close()
+    svc = SMTPDeliveryService(config(port, retries=0))
+    results = svc.send(messages(2))
+    assert [r.sent for r in results] == [False, False]
+    assert 'unable to connect' in results[0].error
+
+
+def test_delivery_queue(smtp_server):
+    svc = SMTPDeliveryService(config(smtp_server.port))
+    rendered = dict((n['country_id'], msg) for n, msg in messages(5))
+    queue = DeliveryQueue(svc.send, lambda n: rendered[n['country_id']], maxsize=1)
+    queue.start()
+    for n in range(5):
+        queue.put({"country_id": n})
+    results = queue.close()
+    assert [r.notification['country_id'] for r in results] == list(range(5))
+    assert all(r.sent for r in results)
+    assert len(smtp_server.messages) == 5
+
+
+def test_delivery_queue_error():
+    def send(messages):
+        raise RuntimeError("broken")
+
+    queue = DeliveryQueue(send, lambda n: None, maxsize=1).start()
+    # the producer is not blocked by a failed delivery
+    for n in range(5):
+        queue.put({"country_id": n})
+    with pytest.raises(RuntimeError):
+        queue.close()
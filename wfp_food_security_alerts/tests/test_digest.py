@@ -0,0 +1,59 @@
+from wfp_food_security_alerts.digest import DigestTemplate, group_by_recipient
+
+
+def notification(country_id: int, recipients: str) -> dict:
+    return {
+        'country_id': country_id,
+        'days_ago': 30,
+        'food_security': 100,
+        'food_security_days_ago': 90,
+        'food_security_variation': 10,
+        'p_food_security': 100.0,
+        'p_food_security_days_ago': 90.0,
+        'p_food_security_variation': 10.0,
+        'population_country': 100,
+        'recipients': recipients,
+        'threshold': 10.0,
+    }
+
+
+def test_group_by_recipient():
+    notifications = [
+        notification(1, 'a@example.org, b@example.org'),
+        notification(2, 'b@example.org'),
+        notification(3, 'admin@example.org'),
+    ]
+    groups = group_by_recipient(notifications, ['admin@example.org'])
+    assert groups == {
+        'a@example.org': [0],
+        'b@example.org': [0, 1],
+        'admin@example.org': [0, 1, 2],
+    }
+
+
+def test_digest_template():
+    template = DigestTemplate()
+    text = template.render([notification(1, ''), notification(22, '')])
+    lines = text.splitlines()
+    assert lines[0] == (
+        "Food security decreases significantly in 2 of your countries."
+    )
+    assert lines[2].split() == [
+        'country', 'days', 'ago', 'population', '%', 'then', '%', 'today',
+        'variation', 'threshold',
+    ]
+    assert lines[4].split() == [
+        '1', '30', '100', '90.00', '100.00', '10.00', '10.00'
+    ]
+    assert lines[5].split()[0] == '22'
+    # the columns are aligned
+    assert len(set(len(line) for line in lines[2:6])) == 1
+
+
+def test_digest_template_count_countries():
+    # two rules of the same country are one country
+    rows = [notification(1, ''), dict(notification(1, ''), days_ago=7)]
+    text = DigestTemplate().render(rows)
+    assert text.startswith(
+        "Food security decreases significantly in 1 of your countries."
+    )
@@ -1,4 +1,6 @@
+import json
 import logging
+import logging.handlers
 
 from wfp_food_security_alerts import logger
 
@@ -18,3 +20,33 @@ def test_logging_mixin():
     obj.log_info("")
     obj.log_warning("")
     obj.log_error("")
+
+
+def test_logging_setup_idempotent():
+    lg = logger.setup(False)
+    assert logger.setup(True) is lg
+    queue_handlers = [
+        h for h in lg.handlers if isinstance(h, logging.handlers.QueueHandler)
+    ]
+    assert len(queue_handlers) == 1
+    assert lg.level == logging.DEBUG
+
+
+def test_logging_json(capsys):
+    lg = logger.setup(False, logger.JSON)
+    lg.info("new notification: %r", {"country_id": 1})
+    logger.shutdown()
+    line = capsys.readouterr().out.splitlines()[-1]
+    data = json.loads(line)
+    assert data['level'] == 'INFO'
+    assert data['message'] == "new notification: {'country_id': 1}"
+
+
+def test_logging_mixin_disabled_level():
+    class Unprintable:
+        def __repr__(self):
+            raise AssertionError("formatted a disabled message")
+
+    obj = logger.LoggerMixin()
+    obj.set_logger(logger.setup(False))
+    obj.log_debug("%r", Unprintable())
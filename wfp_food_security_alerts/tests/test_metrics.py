@@ -0,0 +1,100 @@
+import json
+import os
+import pickle
+
+from wfp_food_security_alerts.metrics import NULL_METRICS, Metrics
+
+
+def test_metrics_counters():
+    m = Metrics()
+    m.inc('wfp_alerts_fired_total')
+    m.inc('wfp_alerts_fired_total', 2)
+    m.inc('wfp_http_requests_total', endpoint='foodsecurity', status=200)
+    assert m.counter('wfp_alerts_fired_total') == 3
+    assert m.counter('wfp_http_requests_total', endpoint='foodsecurity', status=200)
+    assert not m.counter('wfp_http_requests_total', endpoint='api', status=200)
+
+
+def test_metrics_histograms():
+    m = Metrics()
+    m.observe('wfp_stage_duration_seconds', 0.2, stage='aggregation')
+    m.observe('wfp_stage_duration_seconds', 60.0, stage='aggregation')
+    with m.timer('wfp_stage_duration_seconds', stage='evaluation'):
+        pass
+    h = m.histogram('wfp_stage_duration_seconds', stage='aggregation')
+    assert h.count == 2
+    assert h.sum == 60.2
+    assert sum(h.counts) == 1
+    assert m.histogram('wfp_stage_duration_seconds', stage='evaluation').count == 1
+
+
+def test_metrics_to_prometheus():
+    m = Metrics()
+    m.inc('wfp_alerts_fired_total', 2)
+    m.observe('wfp_stage_duration_seconds', 0.2, stage='aggregation')
+    lines = m.to_prometheus().splitlines()
+    assert '# HELP wfp_alerts_fired_total alerts fired' in lines
+    assert '# TYPE wfp_alerts_fired_total counter' in lines
+    assert 'wfp_alerts_fired_total 2' in lines
+    assert '# TYPE wfp_stage_duration_seconds histogram' in lines
+    assert 'wfp_stage_duration_seconds_bucket{stage="aggregation",le="0.1"} 0' in lines
+    assert 'wfp_stage_duration_seconds_bucket{stage="aggregation",le="0.25"} 1' in lines
+    assert 'wfp_stage_duration_seconds_bucket{stage="aggregation",le="+Inf"} 1' in lines
+    assert 'wfp_stage_duration_seconds_count{stage="aggregation"} 1' in lines
+
+
+def test_metrics_mixed_label_types():
+    # the transport records the status code, or 'error' without a response
+    m = Metrics()
+    m.inc('wfp_http_requests_total', endpoint='foodsecurity', status=200)
+    m.inc('wfp_http_requests_total', endpoint='foodsecurity', status='error')
+    m.observe('wfp_http_request_duration_seconds', 0.1, status=200)
+    m.observe('wfp_http_request_duration_seconds', 0.1, status='error')
+    lines = m.to_prometheus().splitlines()
+    name = 'wfp_http_requests_total'
+    assert '%s{endpoint="foodsecurity",status="200"} 1' % name in lines
+    assert '%s{endpoint="foodsecurity",status="error"} 1' % name in lines
+    assert m.counter(name, endpoint='foodsecurity', status=200) == 1
+    m.to_json()
+
+
+def test_metrics_write(tmpdir):
+    m = Metrics()
+    m.inc('wfp_mails_sent_total', 3)
+    m.write(os.path.join(tmpdir, 'metrics.prom'))
+    m.write(os.path.join(tmpdir, 'metrics.json'))
+    assert sorted(os.listdir(tmpdir)) == ['metrics.json', 'metrics.prom']
+    with open(os.path.join(tmpdir, 'metrics.prom')) as f:
+        assert 'wfp_mails_sent_total 3\n' in f.read()
+    with open(os.path.join(tmpdir, 'metrics.json')) as f:
+        data = json.load(f)
+    assert data['counters']['wfp_mails_sent_total'] == [{'labels': {}, 'value': 3}]
+
+
+def test_metrics_merge():
+    # the registries of the worker processes are pickled to the parent
+    worker = Metrics()
+    worker.inc('wfp_http_requests_total', endpoint='country_regions', status=200)
+    worker.observe('wfp_stage_duration_seconds', 0.2, stage='evaluation')
+    worker = pickle.loads(pickle.dumps(worker))
+    m = Metrics()
+    m.inc('wfp_http_requests_total', endpoint='country_regions', status=200)
+    m.observe('wfp_stage_duration_seconds', 0.02, stage='evaluation')
+    m.merge(worker)
+    m.merge(worker)
+    assert m.counter(
+        'wfp_http_requests_total', endpoint='country_regions', status=200
+    ) == 3
+    h = m.histogram('wfp_stage_duration_seconds', stage='evaluation')
+    assert h.count == 3 and round(h.sum, 2) == 0.42
+    assert h.counts[2] == 1 and h.counts[5] == 2
+    worker.inc('wfp_alerts_fired_total')
+    assert m.counter('wfp_alerts_fired_total') == 0
+
+
+def test_null_metrics():
+    NULL_METRICS.inc('wfp_alerts_fired_total')
+    with NULL_METRICS.timer('wfp_stage_duration_seconds', stage='evaluation'):
+        pass
+    assert NULL_METRICS.counter('wfp_alerts_fired_total') == 0
+    assert NULL_METRICS.histogram('wfp_stage_duration_seconds') is None
@@ -0,0 +1,52 @@
+import os
+
+from wfp_food_security_alerts.delivery import DeliveryResult
+from wfp_food_security_alerts.outbox import OutboxService
+
+
+def connect(tmpdir, **kw) -> OutboxService:
+    outbox = OutboxService({"global": {"outbox": kw}})
+    outbox.connect(os.path.join(tmpdir, 'outbox.sqlite3'))
+    return outbox
+
+
+def test_outbox_enqueue_and_drain(tmpdir):
+    outbox = connect(tmpdir, batch_size=2)
+    try:
+        assert outbox.enqueue([{"country_id": n} for n in range(5)], now=100) == 5
+        assert outbox.due(now=99) == []
+        batches = []
+
+        def send(notifications):
+            batches.append([x['country_id'] for x in notifications])
+            return [DeliveryResult(x, True, 1) for x in notifications]
+
+        stats = outbox.drain(send, now=100)
+        assert batches == [[0, 1], [2, 3], [4]]
+        assert stats == {'sent': 5, 'pending': 0, 'dead': 0}
+        assert outbox.due(now=1000) == []
+    finally:
+        outbox.close()
+
+
+def test_outbox_retry_and_dead_letter(tmpdir):
+    outbox = connect(tmpdir, max_attempts=2, backoff=10)
+    try:
+        outbox.enqueue([{"country_id": 1}, {"country_id": 2}], now=100)
+
+        def send(notifications):
+            return [
+                DeliveryResult(x, x['country_id'] == 2, 1, 'error')
+                for x in notifications
+            ]
+
+        stats = outbox.drain(send, now=100)
+        assert stats == {'sent': 1, 'pending': 1, 'dead': 0}
+        # rescheduled with a backoff
+        assert outbox.due(now=109) == []
+        assert outbox.due(now=110) == [(1, {"country_id": 1})]
+        stats = outbox.drain(send, now=110)
+        assert stats == {'sent': 0, 'pending': 0, 'dead': 1}
+        assert outbox.counts() == {'sent': 1, 'dead': 1}
+    finally:
+        outbox.close()
@@ -1,6 +1,48 @@
 import os
+import pytest
+import sqlite3
 
-from wfp_food_security_alerts.population import PopulationService
+from wfp_food_security_alerts.metrics import Metrics
+from wfp_food_security_alerts.population import PopulationChanges, PopulationService
+from wfp_food_security_alerts.population_index import write_population_index
+
+
+class MockedResponse:
+    def __init__(self, content: bytes, headers: dict, status_code: int = 200):
+        self.content = content
+        self.headers = headers
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size: int = 1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class MockedTransport:
+    def __init__(self):
+        self.content = b''
+        self.etag = None
+        self.requests = []
+
+    def set_logger(self, logger):
+        pass
+
+    def set_metrics(self, metrics):
+        pass
+
+    def get(self, url: str, endpoint: str = None, headers: dict = None, **kw):
+        self.requests.append(headers)
+        headers = headers or {}
+        if self.etag is not None and headers.get('If-None-Match') == self.etag:
+            return MockedResponse(b'', {}, 304)
+        etag = {'ETag': self.etag} if self.etag is not None else {}
+        return MockedResponse(self.content, etag)
 
 
 def test_write_rows_to_sqlite_and_get_population_by_region(tmpdir):
@@ -25,6 +67,49 @@ def test_write_rows_to_sqlite_and_get_population_by_region(tmpdir):
         db.close()
 
 
+def test_get_populations(tmpdir):
+    database = os.path.join(tmpdir, 'population.sqlite3')
+    iterator = [{"region_id": n, "population": n * 10} for n in range(1200)]
+    db = PopulationService()
+    db.connect(database)
+    try:
+        db.write_rows_to_sqlite(iterator)
+    finally:
+        db.close()
+    #
+    db.connect(database, read_only=True)
+    try:
+        value = db.get_populations(list(range(0, 1300, 2)))
+        assert value == dict((n, n * 10) for n in range(0, 1200, 2))
+        assert db.get_populations([]) == {}
+        with pytest.raises(sqlite3.OperationalError):
+            db.write_rows_to_sqlite(iterator)
+    finally:
+        db.close()
+
+
+def test_write_rows_to_sqlite_replaces_data(tmpdir):
+    database = os.path.join(tmpdir, 'population.sqlite3')
+    db = PopulationService()
+    db.connect(database)
+    reader = PopulationService()
+    try:
+        db.write_rows_to_sqlite([{"region_id": 1, "population": 1000}])
+        reader.connect(database, read_only=True)
+        iterator = ({"region_id": n, "population": n} for n in range(2, 25000))
+        rows = db.write_rows_to_sqlite(iterator)
+        assert 24998 == rows
+        assert reader.get_population_by_region_id(1) is None
+        assert reader.get_population_by_region_id(24999) == 24999
+        tables = db._db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table';"
+        ).fetchall()
+        assert tables == [('population',)]
+    finally:
+        reader.close()
+        db.close()
+
+
 def test_get_rows_from_url():
     db = PopulationService()
     iterator = db.get_rows_from_url(
@@ -34,3 +119,132 @@ def test_get_rows_from_url():
     assert item is not None
     assert item['region_id'] is not None
     assert item['population'] is not None
+
+
+def test_download_incremental(tmpdir):
+    database = os.path.join(tmpdir, 'population.sqlite3')
+    transport = MockedTransport()
+    db = PopulationService(transport=transport)
+    db.connect(database)
+    try:
+        # first download: everything is inserted
+        transport.content = b"region_id,population\r\n1,1000\r\n2,2000\r\n"
+        transport.etag = '"v1"'
+        assert db.download('http://localhost/') == PopulationChanges(2, 0, 0)
+        # not modified: conditional request
+        assert db.download('http://localhost/') == PopulationChanges(0, 0, 0)
+        assert transport.requests[-1] == {'If-None-Match': '"v1"'}
+        # modified: only the changes are applied
+        transport.content = b"region_id,population\n1,1000\n2,2500\n3,3000\n"
+        transport.etag = '"v2"'
+        assert db.download('http://localhost/') == PopulationChanges(1, 1, 0)
+        transport.content = b"region_id,population\n2,2500\n3,3000\n"
+        transport.etag = None
+        assert db.download('http://localhost/') == PopulationChanges(0, 0, 1)
+        # same content without validators: nothing is written
+        assert db.download('http://localhost/') == PopulationChanges(0, 0, 0)
+        assert db.get_populations([1, 2, 3]) == {2: 2500, 3: 3000}
+    finally:
+        db.close()
+
+
+def test_download_incremental_index(tmpdir):
+    database = os.path.join(tmpdir, 'population.popidx')
+    transport = MockedTransport()
+    db = PopulationService(transport=transport)
+    db.connect(database)
+    try:
+        transport.content = b"region_id,population\r\n1,1000\r\n2,2000\r\n"
+        transport.etag = '"v1"'
+        assert db.download('http://localhost/') == PopulationChanges(2, 0, 0)
+        assert db.download('http://localhost/') == PopulationChanges(0, 0, 0)
+        assert transport.requests[-1] == {'If-None-Match': '"v1"'}
+        # a duplicated region is counted once, the last population wins
+        transport.content = b"region_id,population\n1,1000\n2,2500\n3,1\n3,3000\n"
+        transport.etag = '"v2"'
+        assert db.download('http://localhost/') == PopulationChanges(1, 1, 0)
+        transport.content = b"region_id,population\n2,2500\n3,3000\n"
+        transport.etag = None
+        assert db.download('http://localhost/') == PopulationChanges(0, 0, 1)
+        assert db.download('http://localhost/') == PopulationChanges(0, 0, 0)
+        assert db.get_populations([1, 2, 3]) == {2: 2500, 3: 3000}
+        assert db.get_population_by_region_id(3) == 3000
+    finally:
+        db.close()
+    # the alerting path reads the same index
+    db = PopulationService()
+    db.connect(database, read_only=True)
+    try:
+        assert db.get_populations([1, 2, 3]) == {2: 2500, 3: 3000}
+    finally:
+        db.close()
+    assert not os.path.exists(os.path.join(tmpdir, 'population.sqlite3'))
+
+
+def test_reload_replaced_index(tmpdir):
+    database = os.path.join(tmpdir, 'population.popidx')
+    write_population_index(database, [(1, 1000), (2, 2000)])
+    db = PopulationService()
+    db.connect(database, read_only=True)
+    try:
+        assert db.reload() is False
+        # replaced by download-population in another process
+        write_population_index(database, [(2, 2500), (3, 3000)])
+        assert db.get_populations([1, 2, 3]) == {1: 1000, 2: 2000}
+        assert db.reload() is True
+        assert db.get_populations([1, 2, 3]) == {2: 2500, 3: 3000}
+        assert db.reload() is False
+    finally:
+        db.close()
+
+
+def test_get_rows_from_lines_invalid_rows():
+    db = PopulationService()
+    lines = ["region_id,population", "1,1000", "2", "x,2000", "3,3000", "4,-4000"]
+    assert list(db.get_rows_from_lines(lines)) == [
+        {"region_id": 1, "population": 1000},
+        {"region_id": 3, "population": 3000},
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_download_invalid_rows(tmpdir, workers):
+    database = os.path.join(tmpdir, 'population.sqlite3')
+    transport = MockedTransport()
+    transport.content = (
+        b"region_id,population\n1,1000\n2\nx,2000\n3,3000\n"
+        b"4,-4000\n5,99999999999999999999\n"
+    )
+    metrics = Metrics()
+    db = PopulationService(transport=transport)
+    db.set_metrics(metrics)
+    db.connect(database)
+    try:
+        changes = db.download('http://localhost/', workers=workers)
+        assert changes == PopulationChanges(2, 0, 0)
+        assert db.get_populations([1, 2, 3]) == {1: 1000, 3: 3000}
+    finally:
+        db.close()
+    rejected = 'wfp_population_rows_rejected_total'
+    assert metrics.counter(rejected, reason='wrong_columns') == 1
+    assert metrics.counter(rejected, reason='not_integer') == 1
+    assert metrics.counter(rejected, reason='out_of_range') == 2
+
+
+@pytest.mark.parametrize("filename", ["population.sqlite3", "population.popidx"])
+def test_download_missing_column(tmpdir, filename):
+    database = os.path.join(tmpdir, filename)
+    transport = MockedTransport()
+    db = PopulationService(transport=transport)
+    db.connect(database)
+    try:
+        transport.content = b"region_id,population\n1,1000\n"
+        assert db.download('http://localhost/') == PopulationChanges(1, 0, 0)
+        # the data is kept, and the source is downloaded again next time
+        transport.content = b"region,population\n1,2000\n"
+        assert db.download('http://localhost/') == PopulationChanges()
+        assert db.get_populations([1]) == {1: 1000}
+        transport.content = b"region_id,population\n1,2000\n"
+        assert db.download('http://localhost/') == PopulationChanges(0, 1, 0)
+    finally:
+        db.close()
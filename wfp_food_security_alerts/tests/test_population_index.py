@@ -0,0 +1,106 @@
+import os
+import pytest
+
+from wfp_food_security_alerts import population_index
+from wfp_food_security_alerts.population import sibling_database
+from wfp_food_security_alerts.population_index import (
+    DENSE,
+    SORTED,
+    PopulationIndex,
+    PopulationIndexError,
+    is_population_index,
+    write_population_index,
+)
+
+
+@pytest.mark.parametrize(
+    "rows, layout",
+    [
+        ([(1, 1000), (2, 2000), (4, 4000)], DENSE),
+        ([(1, 1000), (2, 2000), (1000000, 4000)], SORTED),
+    ],
+)
+def test_write_and_read(tmpdir, rows, layout):
+    path = os.path.join(tmpdir, 'population.popidx')
+    assert write_population_index(path, rows, {"url": "http://localhost/"}) == 3
+    index = PopulationIndex(path)
+    try:
+        assert index.layout == layout
+        assert len(index) == 3
+        assert index.metadata == {"url": "http://localhost/"}
+        assert index.get(2) == 2000
+        assert index.get(3) is None
+        assert index.get(-1) is None
+        assert index.get(2000000) is None
+        assert list(index.items()) == rows
+        ids = [id for id, _ in rows]
+        expected = dict(rows)
+        assert index.get_many(ids + [3, 2000000]) == expected
+        assert index.get_many([]) == {}
+    finally:
+        index.close()
+
+
+def test_get_many_without_numpy(tmpdir, monkeypatch):
+    path = os.path.join(tmpdir, 'population.popidx')
+    write_population_index(path, [(1, 1000), (1000000, 2000)])
+    monkeypatch.setattr(population_index, 'numpy', None)
+    index = PopulationIndex(path)
+    try:
+        assert index.get_many([1, 2, 1000000]) == {1: 1000, 1000000: 2000}
+    finally:
+        index.close()
+
+
+def test_last_row_wins_and_invalid_rows(tmpdir):
+    path = os.path.join(tmpdir, 'population.popidx')
+    write_population_index(path, [(1, 1000), (1, 1500)])
+    index = PopulationIndex(path)
+    try:
+        assert index.get(1) == 1500
+    finally:
+        index.close()
+    # negative ids or populations are skipped, not failing the whole file
+    assert write_population_index(path, [(-1, 1000), (2, -2000), (3, 3000)]) == 1
+    index = PopulationIndex(path)
+    try:
+        assert list(index.items()) == [(3, 3000)]
+    finally:
+        index.close()
+
+
+def test_empty_index(tmpdir):
+    path = os.path.join(tmpdir, 'population.popidx')
+    assert write_population_index(path, []) == 0
+    index = PopulationIndex(path)
+    try:
+        assert len(index) == 0
+        assert index.get(1) is None
+        assert index.get_many([1]) == {}
+    finally:
+        index.close()
+
+
+def test_corrupted_index(tmpdir):
+    path = os.path.join(tmpdir, 'population.popidx')
+    write_population_index(path, [(1, 1000), (2, 2000)])
+    with open(path, 'r+b') as f:
+        f.seek(-3, os.SEEK_END)
+        f.write(b'xyz')
+    with pytest.raises(PopulationIndexError):
+        PopulationIndex(path)
+    with open(path, 'wb') as f:
+        f.write(b'not an index')
+    with pytest.raises(PopulationIndexError):
+        PopulationIndex(path)
+    open(path, 'wb').close()
+    with pytest.raises(PopulationIndexError):
+        PopulationIndex(path)
+
+
+def test_sibling_database():
+    assert is_population_index('population.popidx')
+    assert not is_population_index('population.sqlite3')
+    assert sibling_database('population.popidx', 'topology') == (
+        'population.topology.sqlite3'
+    )
@@ -0,0 +1,76 @@
+import io
+import pytest
+
+from wfp_food_security_alerts.population_ingest import (
+    NOT_INTEGER,
+    OUT_OF_RANGE,
+    WRONG_COLUMNS,
+    ingest,
+    iter_chunks,
+    parse_chunk,
+    parse_header,
+)
+
+
+CSV = b"region_id,population\r\n" + b"".join(
+    b"%d,%d\r\n" % (n, n * 10) for n in range(1, 1001)
+)
+
+
+def test_parse_chunk():
+    data = b"1,1000\n2\nx,2000\n3,3000\n4,4000,5\n"
+    result = parse_chunk(data, ['region_id', 'population'])
+    assert list(result.region_ids) == [1, 3]
+    assert list(result.populations) == [1000, 3000]
+    assert result.rows == 5
+    assert (result.wrong_columns, result.not_integer, result.rejected) == (2, 1, 3)
+    assert result.reported == [
+        (1, WRONG_COLUMNS, ['2']),
+        (2, NOT_INTEGER, ['x', '2000']),
+        (4, WRONG_COLUMNS, ['4', '4000', '5']),
+    ]
+
+
+def test_parse_chunk_out_of_range():
+    data = b"1,-1000\n-2,2000\n3,9223372036854775808\n9223372036854775807,0\n"
+    result = parse_chunk(data, ['region_id', 'population'])
+    assert list(result.region_ids) == [9223372036854775807]
+    assert list(result.populations) == [0]
+    assert (result.out_of_range, result.rejected) == (3, 3)
+    assert [(n, reason) for n, reason, _ in result.reported] == [
+        (0, OUT_OF_RANGE),
+        (1, OUT_OF_RANGE),
+        (2, OUT_OF_RANGE),
+    ]
+
+
+def test_parse_chunk_columns_order():
+    result = parse_chunk(b'"1000","1"\n', ['population', 'region_id'])
+    assert list(result.region_ids) == [1]
+    assert list(result.populations) == [1000]
+
+
+def test_parse_header():
+    assert parse_header(b"region_id,population\r\n") == ['region_id', 'population']
+    with pytest.raises(ValueError):
+        parse_header(b"region,population\n")
+
+
+def test_iter_chunks():
+    chunks = list(iter_chunks(io.BytesIO(CSV), chunk_size=100))
+    assert len(chunks) > 10
+    assert all(chunk.endswith(b'\r\n') for chunk in chunks)
+    assert b''.join(chunks) == CSV
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_ingest(workers):
+    results = list(ingest(io.BytesIO(CSV), workers=workers, chunk_size=100))
+    assert len(results) > 10
+    assert sum(result.rows for result in results) == 1000
+    region_ids = [id for result in results for id in result.region_ids]
+    assert region_ids == list(range(1, 1001))
+
+
+def test_ingest_empty():
+    assert list(ingest(io.BytesIO(b''))) == []
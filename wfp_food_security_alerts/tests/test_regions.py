@@ -0,0 +1,55 @@
+import pytest
+
+from wfp_food_security_alerts.regions import RegionArray, iter_json_array
+
+
+def test_region_array():
+    data = RegionArray([(3, 30), (1, 10)])
+    data[1000] = 0
+    assert len(data) == 3
+    assert data[3] == 30
+    assert data.get(1000) == 0
+    assert data.get(2) is None
+    assert data.get(5000) is None
+    assert 1 in data
+    assert 2 not in data
+    assert sorted(data.keys()) == [1, 3, 1000]
+    assert data == {1: 10, 3: 30, 1000: 0}
+    data[3] = 33
+    assert len(data) == 3
+    with pytest.raises(KeyError):
+        data[4]
+    with pytest.raises(ValueError):
+        data[-1] = 1
+    with pytest.raises(TypeError):
+        data[2] = None
+
+
+def test_region_array_sparse():
+    # the regions with ids too large for the array are kept apart
+    data = RegionArray([(3, 30), (10 ** 12, 12), (1, 10)])
+    assert len(data.values_array) < 10
+    assert data.sparse_items() == {10 ** 12: 12}
+    assert len(data) == 3
+    assert data[10 ** 12] == 12 and 10 ** 12 in data
+    assert list(data.keys()) == [1, 3, 10 ** 12]
+    copy = RegionArray.frombytes(data.tobytes())
+    assert copy == data and len(copy) == 3
+    assert RegionArray.frombytes(RegionArray([(1, 10)]).tobytes()) == {1: 10}
+
+
+def test_iter_json_array():
+    text = '[ {"region_id": 1, "values": [1, 2]} , {"region_id": 2, "name": "a,]"}]'
+    expected = [{"region_id": 1, "values": [1, 2]}, {"region_id": 2, "name": "a,]"}]
+    # the result does not depend on how the stream is split
+    for size in (1, 2, 7, len(text)):
+        chunks = (text[i : i + size] for i in range(0, len(text), size))
+        assert list(iter_json_array(chunks)) == expected
+    assert list(iter_json_array(['', '[', ']'])) == []
+
+
+def test_iter_json_array_invalid():
+    with pytest.raises(ValueError):
+        list(iter_json_array(['{"region_id": 1}']))
+    with pytest.raises(ValueError):
+        list(iter_json_array(['[{"region_id": 1}, {"reg']))
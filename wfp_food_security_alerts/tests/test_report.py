@@ -0,0 +1,74 @@
+import csv
+import json
+import os
+import pytest
+
+from wfp_food_security_alerts.report import (
+    CSVReportWriter,
+    JSONLinesReportWriter,
+    REPORT_COLUMNS,
+    open_report,
+)
+
+
+ROWS = [
+    {"country_id": 1, "days_ago": 30, "threshold": 5.0, "alert": True},
+    {"country_id": 2, "skip_reason": "missing_population", "alert": False},
+]
+
+
+def test_open_report(tmpdir):
+    assert isinstance(
+        open_report(os.path.join(tmpdir, 'report.jsonl')), JSONLinesReportWriter
+    )
+    assert isinstance(open_report(os.path.join(tmpdir, 'report.csv')), CSVReportWriter)
+    with pytest.raises(ValueError):
+        open_report(os.path.join(tmpdir, 'report.txt'))
+
+
+def test_jsonl_report(tmpdir):
+    path = os.path.join(tmpdir, 'report.jsonl')
+    report = open_report(path)
+    for row in ROWS:
+        report.write(dict(row, recipients='x@example.org'))
+    # the report is replaced only when it is complete
+    assert not os.path.exists(path)
+    report.close()
+    with open(path) as f:
+        rows = [json.loads(line) for line in f]
+    assert [list(row) for row in rows] == [[x for x, _ in REPORT_COLUMNS]] * 2
+    assert rows[0]['alert'] is True and rows[0]['skip_reason'] is None
+    assert rows[1]['skip_reason'] == 'missing_population'
+
+
+def test_csv_report(tmpdir):
+    path = os.path.join(tmpdir, 'report.csv')
+    report = open_report(path)
+    for row in ROWS:
+        report.write(row)
+    report.close()
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [row['country_id'] for row in rows] == ['1', '2']
+    assert rows[1]['skip_reason'] == 'missing_population'
+    assert rows[1]['days_ago'] == ''
+
+
+def test_parquet_report(tmpdir):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    path = os.path.join(tmpdir, 'report.parquet')
+    report = open_report(path)
+    for row in ROWS:
+        report.write(row)
+    report.close()
+    table = parquet.read_table(path)
+    assert table.column_names == [x for x, _ in REPORT_COLUMNS]
+    assert table.column('country_id').to_pylist() == [1, 2]
+
+
+def test_abort_report(tmpdir):
+    path = os.path.join(tmpdir, 'report.csv')
+    report = open_report(path)
+    report.write(ROWS[0])
+    report.abort()
+    assert os.listdir(tmpdir) == []
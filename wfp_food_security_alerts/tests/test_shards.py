@@ -0,0 +1,136 @@
+import os
+
+import pytest
+
+from wfp_food_security_alerts.alerts import AlertService
+from wfp_food_security_alerts.shards import (
+    merge_notifications,
+    missing_shards,
+    parse_shard,
+    read_notifications,
+    select_shard,
+    shard_of,
+    write_notifications,
+)
+from wfp_food_security_alerts.state import AlertStateService
+from wfp_food_security_alerts.tests.test_alerts import (
+    MockedAPIService,
+    MockedPopulationService,
+)
+
+
+def build_config(countries: int) -> dict:
+    return {
+        "countries": [
+            {"id": x, "emails": ["email%d@example.org" % x]}
+            for x in range(1, countries + 1)
+        ],
+        "global": {
+            "threshold": 10.0,
+            "days_ago": 30,
+            "rules": [
+                {"days_ago": 7, "threshold": 1.0},
+                {"days_ago": 30, "threshold": 10.0},
+            ],
+            "emails": ["admin@example.org"],
+        },
+    }
+
+
+def test_parse_shard():
+    assert parse_shard('0/1') == (0, 1)
+    assert parse_shard('3/4') == (3, 4)
+    for value in ('4/4', '-1/4', '1/0', '1', 'a/b'):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_select_shard():
+    c = build_config(100)
+    shards = [select_shard(c, (i, 4)) for i in range(4)]
+    # every country belongs to exactly one shard, always the same one
+    ids = sorted(x['id'] for shard in shards for x in shard['countries'])
+    assert ids == list(range(1, 101))
+    assert all(len(shard['countries']) > 0 for shard in shards)
+    assert shard_of(42, 4) == shard_of(42, 4)
+    assert c['countries'][0]['id'] == 1
+
+
+def test_sharded_run_matches_single_run():
+    c = build_config(20)
+    a = MockedAPIService(
+        foodsecurity_data={100: 100},
+        foodsecurity_data_days_ago={100: 90},
+        regions=[100],
+    )
+    p = MockedPopulationService(population={100: 100})
+    expected = AlertService(c, a, p).run(dry_run=True)
+    assert len(expected) == 40
+    groups = [
+        AlertService(select_shard(c, (i, 3)), a, p).run(dry_run=True)
+        for i in (2, 0, 1)
+    ]
+    # a shard evaluated twice does not duplicate the notifications
+    groups.append(groups[0])
+    assert merge_notifications(c, groups) == expected
+
+
+def test_read_write_notifications(tmpdir):
+    path = os.path.join(tmpdir, 'shard-1.jsonl')
+    notifications = [{"country_id": 1, "days_ago": 7, "threshold": 1.0}]
+    write_notifications(path, (1, 3), notifications, [(2, 30, 10.0)])
+    assert read_notifications(path) == ((1, 3), notifications, [(2, 30, 10.0)])
+    write_notifications(path, (2, 3), [])
+    assert read_notifications(path) == ((2, 3), [], [])
+    assert os.listdir(tmpdir) == ['shard-1.jsonl']
+
+
+def test_sharded_run_clears_resolved(tmpdir):
+    c = build_config(6)
+    a = MockedAPIService(
+        foodsecurity_data={100: 100},
+        foodsecurity_data_days_ago={100: 90},
+        regions=[100],
+    )
+    p = MockedPopulationService(population={100: 100})
+    state = AlertStateService(c)
+    state.connect(os.path.join(tmpdir, 'population.state.sqlite3'))
+    try:
+        state.record(AlertService(c, a, p).run(dry_run=True))
+        # the alerts resolve: each shard returns its resolved alerts with its
+        # notifications, and they are forgotten by the process which delivers
+        a._foodsecurity_data = {100: 90}
+        resolved = []
+        for i in range(3):
+            path = os.path.join(tmpdir, 'shard-%d.jsonl' % i)
+            svc = AlertService(select_shard(c, (i, 3)), a, p)
+            notifications = svc.run(dry_run=True)
+            write_notifications(path, (i, 3), notifications, svc.get_resolved())
+            resolved.extend(read_notifications(path)[2])
+        assert len(resolved) == 12
+        assert len(state.get(resolved)) == 12
+        svc = AlertService(c, a, p)
+        svc.set_state(state)
+        svc.clear_resolved(resolved)
+        assert state.get(resolved) == {}
+    finally:
+        state.close()
+
+
+def test_missing_shards():
+    assert missing_shards([(0, 3), (2, 3)]) == [(1, 3)]
+    assert missing_shards([(1, 2), (0, 2)]) == []
+    assert missing_shards([None]) == []
+
+
+def test_merge_notifications_countries_not_configured():
+    c = {"countries": [{"id": 5, "emails": []}]}
+    groups = [
+        [{"country_id": 9, "days_ago": 30, "threshold": 1.0}],
+        [
+            {"country_id": 3, "days_ago": 30, "threshold": 1.0},
+            {"country_id": 5, "days_ago": 30, "threshold": 1.0},
+        ],
+    ]
+    merged = merge_notifications(c, groups)
+    assert [x['country_id'] for x in merged] == [5, 3, 9]
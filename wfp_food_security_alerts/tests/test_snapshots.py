@@ -0,0 +1,56 @@
+import datetime
+import os
+
+from wfp_food_security_alerts.regions import RegionArray
+from wfp_food_security_alerts.snapshots import SnapshotService
+
+
+TODAY = datetime.date(2020, 4, 8)
+
+
+def connect(tmpdir, **kw) -> SnapshotService:
+    snapshots = SnapshotService({"global": {"snapshots": kw}})
+    snapshots.connect(os.path.join(tmpdir, 'snapshots.sqlite3'))
+    return snapshots
+
+
+def test_snapshots_store_and_get(tmpdir):
+    snapshots = connect(tmpdir)
+    try:
+        assert snapshots.get(TODAY) is None
+        snapshots.store(TODAY, {1: 10, 5000: 50})
+        data = snapshots.get(TODAY)
+        assert isinstance(data, RegionArray)
+        assert data == {1: 10, 5000: 50}
+        assert len(data) == 2
+        assert snapshots.has(TODAY) is True
+    finally:
+        snapshots.close()
+
+
+def test_snapshots_prune(tmpdir):
+    snapshots = connect(tmpdir, retention_days=10)
+    try:
+        for n in range(15):
+            snapshots.store(TODAY - datetime.timedelta(days=n), {1: n})
+        assert snapshots.prune(TODAY) == 4
+        assert snapshots.days()[0] == TODAY - datetime.timedelta(days=10)
+    finally:
+        snapshots.close()
+
+
+def test_snapshots_backfill(tmpdir):
+    snapshots = connect(tmpdir)
+    requested = []
+
+    def fetch(days_ago=None):
+        requested.append(days_ago)
+        return {} if days_ago == 2 else {1: days_ago or 0}
+
+    try:
+        snapshots.store(TODAY - datetime.timedelta(days=1), {1: 1})
+        assert snapshots.backfill(fetch, range(4), today=TODAY) == 2
+        assert requested == [None, 2, 3]
+        assert snapshots.get(TODAY - datetime.timedelta(days=3)) == {1: 3}
+    finally:
+        snapshots.close()
@@ -0,0 +1,57 @@
+import os
+
+from wfp_food_security_alerts.state import AlertStateService, alert_key
+
+
+def notification(country_id: int, variation: float) -> dict:
+    return {
+        'country_id': country_id,
+        'days_ago': 30,
+        'threshold': 10.0,
+        'p_food_security': 50.0 + variation,
+        'p_food_security_days_ago': 50.0,
+        'p_food_security_variation': variation,
+    }
+
+
+def connect(tmpdir, **suppression) -> AlertStateService:
+    svc = AlertStateService({"global": {"suppression": suppression}})
+    svc.connect(os.path.join(tmpdir, 'population.state.sqlite3'))
+    return svc
+
+
+def test_state_renotify_interval(tmpdir):
+    svc = connect(tmpdir, renotify_interval=3600)
+    try:
+        send, suppressed = svc.filter([notification(1, 10.0)], now=1000)
+        assert len(send) == 1 and suppressed == []
+        svc.record(send, now=1000)
+        # unchanged alert: suppressed until the interval elapses
+        send, suppressed = svc.filter([notification(1, 10.0)], now=2000)
+        assert send == [] and len(suppressed) == 1
+        assert suppressed[0][1].startswith("already notified")
+        send, suppressed = svc.filter([notification(1, 10.0)], now=4600)
+        assert len(send) == 1
+        # an escalation is notified at once
+        send, suppressed = svc.filter([notification(1, 12.0)], now=2000)
+        assert len(send) == 1
+        # resolved alerts are forgotten
+        svc.clear([alert_key(notification(1, 10.0))])
+        send, suppressed = svc.filter([notification(1, 10.0)], now=2000)
+        assert len(send) == 1
+    finally:
+        svc.close()
+
+
+def test_state_escalation_only(tmpdir):
+    svc = connect(tmpdir, escalation_only=True, renotify_interval=0)
+    try:
+        svc.record([notification(1, 10.0), notification(2, 10.0)], now=1000)
+        send, suppressed = svc.filter(
+            [notification(1, 10.0), notification(2, 11.0), notification(3, 10.0)],
+            now=10 ** 9,
+        )
+        assert [x['country_id'] for x in send] == [2, 3]
+        assert [x['country_id'] for x, _ in suppressed] == [1]
+    finally:
+        svc.close()
@@ -0,0 +1,57 @@
+import os
+
+from wfp_food_security_alerts.topology import (
+    TopologyEntry,
+    TopologyService,
+    with_all_countries,
+)
+
+
+def test_topology_store_and_get(tmpdir):
+    topology = TopologyService()
+    topology.connect(os.path.join(tmpdir, 'topology.sqlite3'))
+    try:
+        assert topology.get(1) is None
+        entry = TopologyEntry((10, 11), '"etag"', None, 1000.0)
+        topology.store(1, entry)
+        topology.commit()
+        assert topology.get(1) == entry
+    finally:
+        topology.close()
+
+
+def test_topology_is_fresh():
+    topology = TopologyService(ttl=60)
+    entry = TopologyEntry((1, 2), fetched_at=1000.0)
+    assert topology.is_fresh(entry, now=1059.0) is True
+    assert topology.is_fresh(entry, now=1060.0) is False
+
+
+def test_topology_region_index(tmpdir):
+    topology = TopologyService(ttl=60)
+    topology.connect(os.path.join(tmpdir, 'topology.sqlite3'))
+    try:
+        topology.store_region_country(10, 1, 1000.0)
+        topology.store_region_country(20, 2, 1000.0)
+        topology.store_region_country(11, 1, 1050.0)
+        topology.store_region_country(30, None, 1050.0)
+        topology.commit()
+        assert topology.get_region_index() == {1: (10, 11), 2: (20,)}
+        assert topology.stale_regions([10, 11, 20, 30, 40], now=1100.0) == [
+            10,
+            20,
+            40,
+        ]
+    finally:
+        topology.close()
+
+
+def test_with_all_countries():
+    config = {"countries": [{"id": 2, "emails": ["x@example.org"]}], "global": {}}
+    result = with_all_countries(config, {3: (30,), 1: (10,), 2: (20,)})
+    assert result['countries'] == [
+        {"id": 2, "emails": ["x@example.org"]},
+        {"id": 1, "emails": []},
+        {"id": 3, "emails": []},
+    ]
+    assert config['countries'] == [{"id": 2, "emails": ["x@example.org"]}]
@@ -0,0 +1,106 @@
+import pytest
+import requests
+
+from typing import List
+
+from wfp_food_security_alerts.metrics import Metrics
+from wfp_food_security_alerts.transport import HTTPTransport
+
+
+class MockedResponse:
+    def __init__(self, status_code: int, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+def mocked_transport(monkeypatch, responses: list, config: dict = None):
+    calls = []
+
+    def get(session, url, **kw):
+        calls.append(kw)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(requests.Session, 'get', get)
+    t = HTTPTransport(config)
+    sleeps: List[float] = []
+    t._sleep = sleeps.append
+    return t, calls, sleeps
+
+
+def test_transport_retry_on_server_errors(monkeypatch):
+    responses = [MockedResponse(503), MockedResponse(429), MockedResponse(200)]
+    t, calls, sleeps = mocked_transport(monkeypatch, responses)
+    r = t.get('http://localhost/')
+    assert r.status_code == 200
+    assert len(calls) == 3
+    assert len(sleeps) == 2
+
+
+def test_transport_retry_on_connection_reset(monkeypatch):
+    responses = [requests.exceptions.ConnectionError('reset'), MockedResponse(200)]
+    t, calls, sleeps = mocked_transport(monkeypatch, responses)
+    assert t.get('http://localhost/').status_code == 200
+    assert len(calls) == 2
+
+
+def test_transport_gives_up(monkeypatch):
+    config = {"global": {"api": {"retries": 1}}}
+    responses = [MockedResponse(500), MockedResponse(500)]
+    t, calls, sleeps = mocked_transport(monkeypatch, responses, config)
+    assert t.get('http://localhost/').status_code == 500
+    responses = [requests.exceptions.ConnectionError('reset')] * 2
+    t, calls, sleeps = mocked_transport(monkeypatch, responses, config)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        t.get('http://localhost/')
+
+
+def test_transport_no_retry_on_client_errors(monkeypatch):
+    t, calls, sleeps = mocked_transport(monkeypatch, [MockedResponse(404)])
+    assert t.get('http://localhost/').status_code == 404
+    assert sleeps == []
+
+
+def test_transport_retry_after(monkeypatch):
+    responses = [MockedResponse(429, {'Retry-After': '2'}), MockedResponse(200)]
+    t, calls, sleeps = mocked_transport(monkeypatch, responses)
+    t.get('http://localhost/')
+    assert sleeps == [2.0]
+
+
+def test_transport_timeouts(monkeypatch):
+    config = {
+        "global": {"api": {"timeouts": {"default": 10, "foodsecurity": [1, 60]}}}
+    }
+    responses = [MockedResponse(200), MockedResponse(200)]
+    t, calls, sleeps = mocked_transport(monkeypatch, responses, config)
+    t.get('http://localhost/', endpoint='foodsecurity')
+    t.get('http://localhost/', endpoint='country_regions')
+    assert calls[0]['timeout'] == (1.0, 60.0)
+    assert calls[1]['timeout'] == (10.0, 10.0)
+    assert HTTPTransport().timeout() == (3.05, 30.0)
+
+
+def test_transport_backoff():
+    t = HTTPTransport({"global": {"api": {"backoff": 1, "backoff_max": 5}}})
+    for attempt in range(10):
+        assert 0 <= t.backoff(attempt) <= 5
+
+
+def test_transport_metrics(monkeypatch):
+    responses = [MockedResponse(503), MockedResponse(200)]
+    t, calls, sleeps = mocked_transport(monkeypatch, responses)
+    m = Metrics()
+    t.set_metrics(m)
+    t.get('http://localhost/', endpoint='foodsecurity')
+    for status in (503, 200):
+        labels = dict(endpoint='foodsecurity', status=status)
+        assert m.counter('wfp_http_requests_total', **labels) == 1
+    assert m.counter('wfp_http_retries_total', endpoint='foodsecurity') == 1
+    h = m.histogram('wfp_http_request_duration_seconds', endpoint='foodsecurity')
+    assert h.count == 2
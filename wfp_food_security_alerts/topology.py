@@ -0,0 +1,138 @@
+import sqlite3
+import time
+
+from array import array
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from .logger import LoggerMixin
+
+
+DEFAULT_TTL = 7 * 24 * 3600
+
+
+class TopologyEntry(NamedTuple):
+    regions: tuple
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    fetched_at: float = 0.0
+
+
+def with_all_countries(config: dict, regions_by_country: Dict[int, tuple]) -> dict:
+    # copy of the configuration with the countries of the reverse index which
+    # are not configured, with the global rules and no recipients but the admins
+    result = dict(config)
+    countries = list(config.get('countries') or [])
+    configured = set(country['id'] for country in countries)
+    result['countries'] = countries + [
+        {"id": country_id, "emails": []}
+        for country_id in sorted(regions_by_country)
+        if country_id not in configured
+    ]
+    return result
+
+
+class TopologyService(LoggerMixin):
+
+    # regions of each country, cached from the country_regions end-point, and
+    # the reverse index with the country of each region, from the
+    # region_country end-point
+
+    _db: Optional[sqlite3.Connection]
+    _ttl: float
+
+    def __init__(self, ttl: Optional[float] = None):
+        super(TopologyService, self).__init__()
+        self._db = None
+        self._ttl = DEFAULT_TTL if ttl is None else float(ttl)
+
+    def connect(self, db_topology: str) -> sqlite3.Connection:
+        db = sqlite3.connect(db_topology)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS topology (country_id INTEGER PRIMARY KEY, "
+            "regions BLOB, etag TEXT, last_modified TEXT, fetched_at REAL);"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS region_country (region_id INTEGER PRIMARY KEY, "
+            "country_id INTEGER, fetched_at REAL);"
+        )
+        db.commit()
+        self._db = db
+        return db
+
+    def close(self):
+        self._db.close()
+        self._db = None
+
+    def get(self, country_id: int) -> Optional[TopologyEntry]:
+        assert self._db is not None
+        c = self._db.execute(
+            "SELECT regions, etag, last_modified, fetched_at FROM topology "
+            "WHERE country_id = ?;",
+            [country_id],
+        )
+        row = c.fetchone()
+        if row is None:
+            return None
+        regions = array('q')
+        regions.frombytes(row[0])
+        return TopologyEntry(tuple(regions), row[1], row[2], row[3])
+
+    def is_fresh(self, entry: TopologyEntry, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        return now - entry.fetched_at < self._ttl
+
+    def store(self, country_id: int, entry: TopologyEntry):
+        assert self._db is not None
+        self._db.execute(
+            "INSERT OR REPLACE INTO topology "
+            "(country_id, regions, etag, last_modified, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?);",
+            [
+                country_id,
+                array('q', entry.regions).tobytes(),
+                entry.etag,
+                entry.last_modified,
+                entry.fetched_at,
+            ],
+        )
+
+    def commit(self):
+        self._db.commit()
+
+    def stale_regions(
+        self, region_ids: Iterable[int], now: Optional[float] = None
+    ) -> List[int]:
+        # regions missing from the reverse index, or older than the ttl
+        assert self._db is not None
+        now = time.time() if now is None else now
+        c = self._db.execute(
+            "SELECT region_id FROM region_country WHERE fetched_at > ?;",
+            [now - self._ttl],
+        )
+        fresh = set(row[0] for row in c)
+        return [region_id for region_id in region_ids if region_id not in fresh]
+
+    def store_region_country(
+        self, region_id: int, country_id: Optional[int], fetched_at: float
+    ):
+        # country_id is None for the regions which do not belong to a country
+        assert self._db is not None
+        self._db.execute(
+            "INSERT OR REPLACE INTO region_country (region_id, country_id, "
+            "fetched_at) VALUES (?, ?, ?);",
+            [region_id, country_id, fetched_at],
+        )
+
+    def get_region_index(self) -> Dict[int, tuple]:
+        # regions of each country, according to the reverse index
+        assert self._db is not None
+        c = self._db.execute(
+            "SELECT country_id, region_id FROM region_country "
+            "WHERE country_id IS NOT NULL ORDER BY country_id, region_id;"
+        )
+        return dict(
+            (country_id, tuple(map(itemgetter(1), rows)))
+            for country_id, rows in groupby(c, key=itemgetter(0))
+        )
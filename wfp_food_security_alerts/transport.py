@@ -0,0 +1,121 @@
+import random
+import requests
+import time
+
+from requests.adapters import HTTPAdapter
+from typing import Callable, Dict, Optional, Tuple
+
+from .logger import LoggerMixin
+from .metrics import MetricsMixin
+
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_BACKOFF_MAX = 30.0
+DEFAULT_TIMEOUT = (3.05, 30.0)
+
+# HTTP status codes worth retrying: rate limiting and server-side errors
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+
+# shared, keep-alive HTTP client used to talk to the external APIs: connections
+# are pooled in a single session, every request has a (connect, read) timeout
+# which can be configured per end-point, and failures due to rate limiting,
+# server errors or dropped connections are retried with exponential backoff
+class HTTPTransport(LoggerMixin, MetricsMixin):
+
+    _session: requests.Session
+    _retries: int
+    _backoff: float
+    _backoff_max: float
+    _timeouts: Dict[str, Tuple[float, float]]
+    _sleep: Callable[[float], None]
+
+    def __init__(self, config: Optional[dict] = None):
+        super(HTTPTransport, self).__init__()
+        api = ((config or {}).get('global') or {}).get('api') or {}
+        pool_size = int(
+            api.get('pool_size') or api.get('max_concurrency') or DEFAULT_POOL_SIZE
+        )
+        self._retries = int(api.get('retries', DEFAULT_RETRIES))
+        self._backoff = float(api.get('backoff', DEFAULT_BACKOFF))
+        self._backoff_max = float(api.get('backoff_max', DEFAULT_BACKOFF_MAX))
+        self._timeouts = dict(
+            (endpoint, self._parse_timeout(value))
+            for endpoint, value in (api.get('timeouts') or {}).items()
+        )
+        self._sleep = time.sleep
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    @staticmethod
+    def _parse_timeout(value) -> Tuple[float, float]:
+        # a single number is used for both the connect and the read timeout
+        if isinstance(value, (list, tuple)):
+            connect, read = value
+            return (float(connect), float(read))
+        return (float(value), float(value))
+
+    def timeout(self, endpoint: Optional[str] = None) -> Tuple[float, float]:
+        if endpoint is not None and endpoint in self._timeouts:
+            return self._timeouts[endpoint]
+        return self._timeouts.get('default', DEFAULT_TIMEOUT)
+
+    def close(self):
+        self._session.close()
+
+    def get(
+        self, url: str, endpoint: Optional[str] = None, **kw
+    ) -> requests.Response:
+        kw.setdefault('timeout', self.timeout(endpoint))
+        attempt = 0
+        while True:
+            try:
+                with self._metrics.timer(
+                    'wfp_http_request_duration_seconds', endpoint=endpoint
+                ):
+                    r = self._session.get(url, **kw)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                self._metrics.inc(
+                    'wfp_http_requests_total', endpoint=endpoint, status='error'
+                )
+                if attempt >= self._retries:
+                    raise
+                self.log_warning('request to %s failed, retrying: %s', url, e)
+                delay = self.backoff(attempt)
+            else:
+                self._metrics.inc(
+                    'wfp_http_requests_total', endpoint=endpoint, status=r.status_code
+                )
+                if r.status_code not in RETRY_STATUS_CODES or attempt >= self._retries:
+                    return r
+                self.log_warning(
+                    'request to %s returned %d, retrying', url, r.status_code
+                )
+                retry_after = self._retry_after(r)
+                if retry_after is not None:
+                    delay = retry_after
+                else:
+                    delay = self.backoff(attempt)
+                r.close()
+            self._metrics.inc('wfp_http_retries_total', endpoint=endpoint)
+            self._sleep(min(delay, self._backoff_max))
+            attempt += 1
+
+    def backoff(self, attempt: int) -> float:
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self._backoff_max, self._backoff * 2 ** attempt))
+
+    @staticmethod
+    def _retry_after(r: requests.Response) -> Optional[float]:
+        value = r.headers.get('Retry-After')
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None